@@ -0,0 +1,75 @@
+#==========================================================#
+# Benchmark of the download of the satellite images
+#==========================================================#
+
+# Downloads the images of a site from the offline stand-in for the GEE server (tests/fake_ee.py)
+# with different numbers of workers and reports the number of images and bytes downloaded per
+# second. The latency, bandwidth, throttling and failures of the server can be changed below.
+
+#%% 1. Settings
+
+# load modules
+import os
+import sys
+import time
+import shutil
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from coastsat import SDS_download
+import fake_ee
+
+# region of interest (longitude, latitude in WGS84)
+polygon = [[[151.301454, -33.700754],
+            [151.311453, -33.702075],
+            [151.307237, -33.739761],
+            [151.294220, -33.736329],
+            [151.301454, -33.700754]]]
+
+# date range and satellite missions
+dates = ['2017-01-01', '2018-01-01']
+sat_list = ['L8', 'S2']
+
+# number of workers to compare
+n_workers_list = [1, 2, 4, 8, 16]
+
+# simulated server
+server = {
+    'latency': 0.5,             # delay of each request in seconds
+    'bandwidth': 2e6,           # download speed of each request in bytes/second
+    'max_concurrent': 8,        # maximum number of downloads at the same time (HTTP 429 above)
+    'failure_rate': 0.02,       # probability of a failed request
+    }
+
+# shorter pauses than with the GEE server, so that the benchmark runs quickly
+SDS_download.RETRY_POLICY.update({'base_delay':0.1, 'max_delay':2, 'rate_limit_delay':1})
+
+#%% 2. Benchmark
+
+results = []
+for n_workers in n_workers_list:
+    # new server and empty directory for each run
+    SDS_download.ee = fake_ee.FakeEE(**server)
+    SDS_download.RATE_LIMIT['until'] = 0
+    filepath_data = tempfile.mkdtemp()
+    inputs = {'polygon': polygon, 'dates': dates, 'sat_list': sat_list,
+              'sitename': 'BENCH', 'filepath': filepath_data, 'n_workers': n_workers}
+    t0 = time.time()
+    metadata = SDS_download.retrieve_images(inputs)
+    duration = time.time() - t0
+    # images and bytes downloaded
+    n_images = sum([len(metadata[_]['filenames']) for _ in metadata.keys()])
+    n_bytes = 0
+    for root, dirs, files in os.walk(os.path.join(filepath_data, 'BENCH')):
+        n_bytes = n_bytes + sum([os.path.getsize(os.path.join(root, _)) for _ in files
+                                 if _.endswith('.tif')])
+    stats = SDS_download.ee.stats
+    results.append([n_workers, n_images, duration, n_images/duration, n_bytes/duration/1e6,
+                    stats['throttled'], stats['failed']])
+    SDS_download.ee.close()
+    shutil.rmtree(filepath_data)
+
+print('\n%10s %10s %10s %12s %10s %10s %10s' % ('n_workers', 'images', 'time (s)', 'images/sec',
+                                                'MB/sec', 'throttled', 'failed'))
+for result in results:
+    print('%10d %10d %10.1f %12.2f %10.2f %10d %10d' % tuple(result))
@@ -0,0 +1,77 @@
+#==========================================================#
+# Validation of the float32 processing mode
+#==========================================================#
+
+# Maps the shorelines of a site that was already downloaded (e.g. with example.py) in double
+# precision (float64, default) and in single precision (float32) and compares the processing
+# time and the shorelines: for each image, the distance from each float32 shoreline point to the
+# closest float64 shoreline point.
+
+#%% 1. Settings
+
+# load modules
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from coastsat import SDS_download, SDS_shoreline, SDS_tools
+
+# site downloaded by example.py
+inputs = {'sitename': 'NARRA', 'filepath': os.path.join(os.getcwd(), 'data')}
+
+# settings of the shoreline extraction (no figures, no cache)
+settings = {'cloud_thresh': 0.5, 'output_epsg': 28356, 'check_detection': False,
+            'save_figure': False, 'inputs': inputs, 'min_beach_area': 4500, 'buffer_size': 150,
+            'min_length_sl': 200, 'cloud_mask_issue': False, 'sand_color': 'default',
+            'cache_dir': None}
+
+# maximum distance (in metres) between the float32 and float64 shorelines
+tolerance = 1
+
+#%% 2. Benchmark
+
+metadata = SDS_download.get_metadata(inputs)
+results = dict([])
+durations = dict([])
+for dtype in [np.float64, np.float32]:
+    settings['dtype'] = dtype
+    results[dtype] = dict([])
+    t0 = time.time()
+    for satname in metadata.keys():
+        filepath = SDS_tools.get_filepath(inputs, satname)
+        clf, pixel_size = SDS_shoreline.load_classifier(satname, settings)
+        for i, filename in enumerate(metadata[satname]['filenames']):
+            results[dtype][filename] = SDS_shoreline.map_shoreline(filename, filepath, satname,
+                                           metadata[satname]['epsg'][i], settings, clf,
+                                           pixel_size)
+    durations[dtype] = time.time() - t0
+
+# compare the shorelines
+n_images = 0
+n_different = 0
+distances = []
+for filename in results[np.float64].keys():
+    result64 = results[np.float64][filename]
+    result32 = results[np.float32][filename]
+    if result64 is None and result32 is None:
+        continue
+    n_images = n_images + 1
+    if result64 is None or result32 is None or len(result64[0]) == 0 or len(result32[0]) == 0:
+        n_different = n_different + 1
+        print('%s: mapped with only one of the data types' % filename)
+        continue
+    sl64 = result64[0]
+    sl32 = result32[0]
+    dist = np.min(np.linalg.norm(sl32[:,None,:2] - sl64[None,:,:2], axis=2), axis=1)
+    distances.append(np.max(dist))
+    if np.max(dist) > tolerance:
+        n_different = n_different + 1
+        print('%s: maximum distance of %.2f m' % (filename, np.max(dist)))
+
+print('\nfloat64: %.1f s, float32: %.1f s (speed-up x%.2f)' % (durations[np.float64],
+      durations[np.float32], durations[np.float64]/durations[np.float32]))
+if len(distances) > 0:
+    print('distance between the shorelines: median %.3f m, max %.3f m' % (np.median(distances),
+          np.max(distances)))
+print('%d of %d shorelines differ by more than %.1f m' % (n_different, n_images, tolerance))
@@ -0,0 +1,101 @@
+#==========================================================#
+# Benchmark of the PCA pansharpening
+#==========================================================#
+
+# Compares the closed-form PCA pansharpening of SDS_preprocess.pansharpen with the previous
+# implementation based on sklearn.decomposition.PCA (fit on all the cloud-free pixels then
+# inverse transform), on a synthetic scene of the size of a full Landsat scene (pan band) or on
+# the pan and ms files of a downloaded Landsat 8 image, as well as the closed-form PCA with the
+# approximate histogram matching (hist_bins) and by blocks (block_size). Reports the time, the
+# peak memory and the maximum difference of each pansharpened image with the one of the
+# previous implementation. The sign of the 1st component given by sklearn depends on its
+# version and could invert the brightness of the image, so the 1st PC of the previous
+# implementation is oriented like the pan band (as in SDS_preprocess.pansharpen_pca) and the
+# differences are only rounding errors (and the error of the approximate histogram matching).
+
+#%% 1. Settings
+
+# load modules
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import sklearn.decomposition as decomposition
+import skimage.transform as transform
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from coastsat import SDS_preprocess
+
+# size (in pixels) of the synthetic scene (a full Landsat scene is about 15000 x 15000 pixels
+# at 15 m), or filenames of a Landsat 8 image ([pan, ms]) to use instead
+scene_size = 8000
+fn_image = None
+
+# fraction of cloudy pixels in the synthetic scene
+cloud_fraction = 0.1
+
+# number of bins of the approximate histogram matching and number of rows of the blocks
+hist_bins = 1024
+block_size = 1000
+
+#%% 2. Previous implementation (sklearn PCA)
+
+def pansharpen_sklearn(im_ms, im_pan, cloud_mask):
+    # reshape image into vector and apply cloud mask
+    vec = im_ms.reshape(im_ms.shape[0] * im_ms.shape[1], im_ms.shape[2])
+    vec_mask = cloud_mask.reshape(im_ms.shape[0] * im_ms.shape[1])
+    vec = vec[~vec_mask, :]
+    # apply PCA to multispectral bands
+    pca = decomposition.PCA()
+    vec_pcs = pca.fit_transform(vec)
+    # replace 1st PC with pan band (after matching histograms)
+    vec_pan = im_pan.reshape(im_pan.shape[0] * im_pan.shape[1])
+    vec_pan = vec_pan[~vec_mask]
+    # 1st PC positively correlated with the pan band
+    if np.dot(vec_pcs[:,0], vec_pan - np.mean(vec_pan)) < 0:
+        vec_pcs[:,0] = -vec_pcs[:,0]
+        pca.components_[0] = -pca.components_[0]
+    vec_pcs[:,0] = SDS_preprocess.hist_match(vec_pan, vec_pcs[:,0])
+    vec_ms_ps = pca.inverse_transform(vec_pcs)
+    # reshape vector into image
+    vec_ms_ps_full = np.ones((len(vec_mask), im_ms.shape[2])) * np.nan
+    vec_ms_ps_full[~vec_mask,:] = vec_ms_ps
+    im_ms_ps = vec_ms_ps_full.reshape(im_ms.shape[0], im_ms.shape[1], im_ms.shape[2])
+    return im_ms_ps
+
+#%% 3. Benchmark
+
+# load or create the scene (Blue, Green, Red bands at the resolution of the pan band)
+if fn_image is not None:
+    im_pan = SDS_preprocess.read_image(fn_image[0], [1])[0][:,:,0].astype(np.float64)
+    im_ms = SDS_preprocess.read_image(fn_image[1])[0]
+    cloud_mask = SDS_preprocess.create_cloud_mask(im_ms[:,:,5], 'L8', False)
+    im_ms = transform.resize(im_ms[:,:,[0,1,2]], im_pan.shape, order=1, preserve_range=True,
+                             mode='constant')
+    cloud_mask = transform.resize(cloud_mask, im_pan.shape, order=0, preserve_range=True,
+                                  mode='constant').astype(bool)
+else:
+    rng = np.random.RandomState(0)
+    im_pan = rng.rand(scene_size, scene_size)
+    im_ms = np.stack([0.5*im_pan + 0.1*rng.rand(scene_size, scene_size) + 0.05*k
+                      for k in range(3)], 2)
+    cloud_mask = rng.rand(scene_size, scene_size) < cloud_fraction
+
+results = []
+outputs = []
+for name, function, arguments in [['sklearn PCA', pansharpen_sklearn, []],
+                                  ['closed-form PCA', SDS_preprocess.pansharpen, []],
+                                  ['approximate hist', SDS_preprocess.pansharpen, [hist_bins]],
+                                  ['blocks', SDS_preprocess.pansharpen,
+                                   [hist_bins, 'pca', block_size]]]:
+    tracemalloc.start()
+    t0 = time.time()
+    outputs.append(function(im_ms, im_pan, cloud_mask, *arguments))
+    duration = time.time() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append([name, duration, peak/2**20])
+
+print('\n%16s %10s %16s %14s' % ('method', 'time (s)', 'peak memory (MB)', 'max difference'))
+for result, output in zip(results, outputs):
+    print('%16s %10.2f %16.0f %14.2e' % tuple(result + [np.nanmax(np.abs(output - outputs[0]))]))
@@ -0,0 +1,71 @@
+#==========================================================#
+# Comparison of the pansharpening methods
+#==========================================================#
+
+# Maps the shorelines on the Landsat 7 and 8 images of a site that was already downloaded (e.g.
+# with example.py) with each pansharpening method (settings['pansharpen_method']) and compares
+# the processing time and the shorelines with the ones of the PCA pansharpening (default): for
+# each image, the distance from each shoreline point to the closest point of the PCA shoreline.
+
+#%% 1. Settings
+
+# load modules
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from coastsat import SDS_download, SDS_preprocess, SDS_shoreline, SDS_tools
+
+# site downloaded by example.py
+inputs = {'sitename': 'NARRA', 'filepath': os.path.join(os.getcwd(), 'data')}
+
+# settings of the shoreline extraction (no figures, no cache)
+settings = {'cloud_thresh': 0.5, 'output_epsg': 28356, 'check_detection': False,
+            'save_figure': False, 'inputs': inputs, 'min_beach_area': 4500, 'buffer_size': 150,
+            'min_length_sl': 200, 'cloud_mask_issue': False, 'sand_color': 'default',
+            'cache_dir': None}
+
+#%% 2. Benchmark
+
+metadata = SDS_download.get_metadata(inputs)
+results = dict([])
+durations = dict([])
+for method in SDS_preprocess.PANSHARPEN_METHODS:
+    settings['pansharpen_method'] = method
+    results[method] = dict([])
+    t0 = time.time()
+    for satname in ['L7', 'L8']:
+        if not satname in metadata.keys():
+            continue
+        filepath = SDS_tools.get_filepath(inputs, satname)
+        clf, pixel_size = SDS_shoreline.load_classifier(satname, settings)
+        for i, filename in enumerate(metadata[satname]['filenames']):
+            results[method][filename] = SDS_shoreline.map_shoreline(filename, filepath, satname,
+                                            metadata[satname]['epsg'][i], settings, clf,
+                                            pixel_size)
+    durations[method] = time.time() - t0
+
+# compare the shorelines with the ones of the PCA pansharpening
+reference = SDS_preprocess.PANSHARPEN_METHODS[0]
+print('\n%8s %10s %8s %14s %14s %10s' % ('method', 'time (s)', 'speed-up', 'median dist (m)',
+                                        'max dist (m)', 'n mapped'))
+for method in SDS_preprocess.PANSHARPEN_METHODS:
+    distances = []
+    n_mapped = 0
+    for filename in results[reference].keys():
+        result_ref = results[reference][filename]
+        result = results[method][filename]
+        if result is None or len(result[0]) == 0:
+            continue
+        n_mapped = n_mapped + 1
+        if result_ref is None or len(result_ref[0]) == 0:
+            continue
+        dist = np.min(np.linalg.norm(result[0][:,None,:2] - result_ref[0][None,:,:2], axis=2),
+                      axis=1)
+        distances.append(np.max(dist))
+    if len(distances) == 0:
+        distances = [np.nan]
+    print('%8s %10.1f %8.2f %14.2f %14.2f %10d' % (method, durations[method],
+          durations[reference]/durations[method], np.median(distances), np.max(distances),
+          n_mapped))
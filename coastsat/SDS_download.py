@@ -7,32 +7,243 @@ Earth Engine Server
 # load modules
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-import pdb
 
 # earth engine modules
 import ee
-from urllib.request import urlretrieve
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
 import zipfile
+import zlib
+import struct
+import tempfile
+import shutil
+import hashlib
+import json
 import copy
-from coastsat import gdal_merge
+import sqlite3
+from osgeo import gdal
 
 # additional modules
 from datetime import datetime
 import pytz
 import pickle
 import skimage.morphology as morphology
+from shapely import geometry
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import threading
+import random
+import time
+import socket
 
 # own modules
 from coastsat import SDS_preprocess, SDS_tools
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
+# prefix of the temporary files in which the images are written during the download
+TEMP_PREFIX = 'tmp_download_'
+# timeout (in seconds) of the connection to the download server
+DOWNLOAD_TIMEOUT = 300
 
-def download_tif(image, polygon, bandsId, filepath):
+# maximum size (in bytes) of the image requested in a single download, larger areas are split
+# in tiles (the ee server rejects requests larger than 32 MB)
+MAX_REQUEST_SIZE = 24*2**20
+
+# size (in pixels) of the internal tiles of the compressed GeoTIFFs, overviews are built down to
+# this size
+BLOCK_SIZE = 256
+
+# retry policy for the requests to the ee server (see retry):
+# max_attempts: maximum number of attempts before giving up
+# base_delay, max_delay: bounds (in seconds) of the exponential backoff between attempts
+# rate_limit_delay: minimum pause (in seconds) of all the requests when the server is throttling
+RETRY_POLICY = {'max_attempts':6, 'base_delay':1, 'max_delay':60, 'rate_limit_delay':30}
+
+# Earth Engine collection of each satellite mission, with the bands downloaded (indices in the
+# list of bands of the collection) in each file of an image, the subfolder and filename
+# suffix of each file, the name of the QA band and the pixel size (in metres) of the
+# preprocessed images (see SDS_preprocess.preprocess_single)
+SATELLITES = {
+    'L5': {'alias':'Landsat5', 'collection':'LANDSAT/LT05/C01/T1_TOA',
+           'cloud_property':'CLOUD_COVER', 'bands':[[0,1,2,3,4,7]],
+           'folders':['30m'], 'suffixes':[''], 'qa_band':'BQA', 'pixel_size':15},
+    'L7': {'alias':'Landsat7', 'collection':'LANDSAT/LE07/C01/T1_RT_TOA',
+           'cloud_property':'CLOUD_COVER', 'bands':[[8], [0,1,2,3,4,9]],
+           'folders':['pan', 'ms'], 'suffixes':['_pan', '_ms'], 'qa_band':'BQA',
+           'pixel_size':15},
+    'L8': {'alias':'Landsat8', 'collection':'LANDSAT/LC08/C01/T1_RT_TOA',
+           'cloud_property':'CLOUD_COVER', 'bands':[[7], [1,2,3,4,5,11]],
+           'folders':['pan', 'ms'], 'suffixes':['_pan', '_ms'], 'qa_band':'BQA',
+           'pixel_size':15},
+    'S2': {'alias':'Sentinel2', 'collection':'COPERNICUS/S2',
+           'cloud_property':'CLOUDY_PIXEL_PERCENTAGE', 'bands':[[1,2,3,7], [11], [15]],
+           'folders':['10m', '20m', '60m'], 'suffixes':['_10m', '_20m', '_60m'],
+           'qa_band':'QA60', 'pixel_size':10},
+    }
+
+# area (in km2) of the area of interest above which a warning is printed by estimate_cost
+MAX_AREA = 100
+
+# margin added to the cloud cover threshold when screening the images before the download (the
+# cloud cover is estimated at a coarse scale, see SCREENING_SCALE, so only the images that will
+# certainly be rejected by extract_shorelines are skipped)
+SCREENING_MARGIN = 0.05
+
+# scale (in metres) at which the cloud cover is computed for the screening (coarser than the QA
+# bands so that the reductions stay cheap on the ee server) and number of images whose cloud
+# cover is computed in each request
+SCREENING_SCALE = 100
+SCREENING_CHUNK = 50
+# maximum number of QA pixels averaged into each coarse pixel (large enough for the coarser
+# scales used by bestEffort on large areas)
+SCREENING_MAX_PIXELS = 65536
+
+# time until which all requests are paused after the server signalled a rate limit
+RATE_LIMIT = {'until':0}
+RATE_LIMIT_LOCK = threading.Lock()
+
+
+class ZipMemberNotFound(Exception):
+    """Raised when a complete zip archive does not contain the requested file."""
+    pass
+
+
+class StreamNotSupported(Exception):
+    """Raised when a zip archive cannot be read sequentially from a stream."""
+    pass
+
+
+class DownloadCancelled(Exception):
+    """Raised when a download is cancelled (see download_images)."""
+    pass
+
+
+def classify_error(error):
     """
-    Downloads a .TIF image from the ee server and stores it in a temp file
-        
+    Classifies an error raised by a request to the ee server, to decide if it should be retried.
+
+    Arguments:
+    -----------
+        error: Exception
+            error raised by the request
+
+    Returns:
+    -----------
+        error_type: str
+            'rate_limit' if the server is throttling the requests (retried after a longer pause),
+            'transient' for network and server errors (retried) and 'fatal' for errors that
+            will not disappear by retrying (e.g. invalid request)
+
+    """
+
+    message = str(error).lower()
+    if isinstance(error, HTTPError):
+        if error.code == 429:
+            return 'rate_limit'
+        elif error.code >= 500:
+            return 'transient'
+        else:
+            return 'fatal'
+    elif isinstance(error, ee.EEException):
+        if any(_ in message for _ in ['too many', 'quota', 'rate limit', 'concurrent']):
+            return 'rate_limit'
+        elif any(_ in message for _ in ['must be less than', 'limit exceeded', 'not found']):
+            return 'fatal'
+        else:
+            return 'transient'
+    elif isinstance(error, (URLError, HTTPException, socket.timeout, ConnectionError,
+                            TimeoutError, zipfile.BadZipFile)):
+        # BadZipFile is raised for an incomplete archive and HTTPException (IncompleteRead) when
+        # the connection is closed during the download (a complete archive without the
+        # requested file raises ZipMemberNotFound, which is fatal)
+        return 'transient'
+    else:
+        return 'fatal'
+
+
+def retry(func, args, policy=RETRY_POLICY, rate_limit=None):
+    """
+    Calls a function that sends a request to the ee server and retries it with an exponential
+    backoff (with random jitter) when it fails with a transient error. When the server signals a
+    rate limit, all the requests (from all threads) are paused before retrying. With a
+    rate_limit, the requests that share it (from all threads) are spaced so that no more than
+    its max_rate requests are sent per second.
+
+    Arguments:
+    -----------
+        func: function
+            function to call
+        args: list
+            arguments of the function
+        policy: dict
+            retry policy (see RETRY_POLICY)
+        rate_limit: dict (optional)
+            maximum request rate shared by several requests (see get_rate_limit)
+
+    Returns:
+    -----------
+        output of func(*args), the error of the last attempt is raised if all attempts fail
+
+    """
+
+    for attempt in range(policy['max_attempts']):
+        # wait if the server is throttling the requests
+        with RATE_LIMIT_LOCK:
+            t_request = max(time.time(), RATE_LIMIT['until'])
+        # reserve the next slot allowed by the maximum request rate
+        if rate_limit is not None:
+            with rate_limit['lock']:
+                t_request = max(t_request, rate_limit['next'])
+                rate_limit['next'] = t_request + 1/rate_limit['max_rate']
+        pause = t_request - time.time()
+        if pause > 0:
+            time.sleep(pause)
+        try:
+            return func(*args)
+        except Exception as error:
+            error_type = classify_error(error)
+            if error_type == 'fatal' or attempt == policy['max_attempts'] - 1:
+                raise
+            # exponential backoff with full jitter
+            delay = random.uniform(0, min(policy['max_delay'], policy['base_delay']*2**attempt))
+            if error_type == 'rate_limit':
+                # honour the Retry-After header if the server provides one
+                if isinstance(error, HTTPError) and error.headers.get('Retry-After', '').isdigit():
+                    delay = max(delay, float(error.headers['Retry-After']))
+                delay = max(delay, policy['rate_limit_delay']*random.uniform(0.5, 1))
+                with RATE_LIMIT_LOCK:
+                    RATE_LIMIT['until'] = max(RATE_LIMIT['until'], time.time() + delay)
+            time.sleep(delay)
+
+
+def get_rate_limit(max_rate):
+    """
+    Creates a maximum request rate, to be shared by the requests of a download (see retry).
+
+    Arguments:
+    -----------
+        max_rate: float
+            maximum number of requests sent to the ee server per second, None for no limit
+
+    Returns:
+    -----------
+        rate_limit: dict
+            contains the fields 'max_rate', 'next' (time of the next request allowed by this
+            limit) and 'lock', None if max_rate is None
+
+    """
+
+    if max_rate is None:
+        return None
+
+    return {'max_rate':max_rate, 'next':0, 'lock':threading.Lock()}
+
+
+def get_download_url(image, polygon, bandsId):
+    """
+    Requests a download url for a .TIF image from the ee server.
+
     Arguments:
     -----------
         image: ee.Image
@@ -42,10 +253,14 @@ def download_tif(image, polygon, bandsId, filepath):
             longitudes in the first column and latitudes in the second column
         bandsId: list of dict
             list of bands to be downloaded
-        filepath: location where the temporary file should be saved
-            
+
+    Returns:
+    -----------
+        url: str
+            url from which the zipped .TIF image can be downloaded
+
     """
-    
+
     url = ee.data.makeDownloadUrl(ee.data.getDownloadId({
         'image': image.serialize(),
         'region': polygon,
@@ -53,661 +268,1970 @@ def download_tif(image, polygon, bandsId, filepath):
         'filePerBand': 'false',
         'name': 'data',
         }))
-    local_zip, headers = urlretrieve(url)
-    with zipfile.ZipFile(local_zip) as local_zipfile:
-        return local_zipfile.extract('data.tif', filepath)
+
+    return url
+
+
+def extract_zip_stream(stream, member, f_out):
+    """
+    Extracts one file from a zip archive while it is being read from a stream (e.g. an HTTP
+    response), without storing the archive. The entries of the archive are read sequentially
+    using their local headers, the entries located before the requested file are skipped.
+    Only stored and deflated entries are supported, a StreamNotSupported exception is raised
+    for archives that cannot be read sequentially.
+
+    Arguments:
+    -----------
+        stream: file-like object
+            stream containing the zip archive, read with stream.read(n)
+        member: str
+            name of the file to extract from the archive
+        f_out: file object
+            file (opened in binary mode) where the extracted file is written
+
+    Returns:
+    -----------
+
+    """
+
+    chunk_size = 2**20
+    # bytes read from the stream but not consumed yet
+    buffer = [b'']
+
+    def read(n):
+        # read at most n bytes (less only at the end of the stream)
+        data = buffer[0][:n]
+        buffer[0] = buffer[0][n:]
+        while len(data) < n:
+            chunk = stream.read(max(n - len(data), chunk_size))
+            if not chunk:
+                break
+            buffer[0] = chunk[n - len(data):]
+            data = data + chunk[:n - len(data)]
+        return data
+
+    def read_exactly(n):
+        data = read(n)
+        if len(data) < n:
+            raise zipfile.BadZipFile('unexpected end of the zip archive')
+        return data
+
+    while True:
+        # read the local header of the next entry
+        header = read(30)
+        if header[:4] in [b'PK\x01\x02', b'PK\x05\x06']:
+            # central directory: all the entries were read
+            raise ZipMemberNotFound('%s was not found in the zip archive' % member)
+        if len(header) < 30 or not header[:4] == b'PK\x03\x04':
+            raise zipfile.BadZipFile('unexpected end of the zip archive')
+        (flags, method, crc, comp_size, size,
+         name_length, extra_length) = struct.unpack('<2xHH4xIIIHH', header[4:])
+        name = read_exactly(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = read_exactly(extra_length)
+        # sizes of large files are stored in the zip64 extra field, whose presence also means
+        # that the sizes in the data descriptor are stored on 8 bytes
+        zip64 = False
+        k = 0
+        while k + 4 <= len(extra):
+            tag, length = struct.unpack('<HH', extra[k:k+4])
+            if tag == 1:
+                zip64 = True
+                if (comp_size == 0xFFFFFFFF or size == 0xFFFFFFFF) and length >= 16:
+                    size, comp_size = struct.unpack('<QQ', extra[k+4:k+20])
+                break
+            k = k + 4 + length
+        if (comp_size == 0xFFFFFFFF or size == 0xFFFFFFFF) and not zip64:
+            raise StreamNotSupported('sizes of %s are missing from the zip64 extra field' % name)
+        # flag bit 3: sizes and crc are stored in a data descriptor after the data
+        descriptor = flags & 0x08
+        if not method in [0, 8] or (method == 0 and descriptor):
+            raise StreamNotSupported('%s cannot be extracted from a stream' % name)
+
+        # decompress the entry (written to f_out if it is the requested file)
+        out = f_out if name == member else None
+        crc_out = 0
+        decompressor = zlib.decompressobj(-15) if method == 8 else None
+        n_left = None if descriptor else comp_size
+        while True:
+            if n_left is None:
+                data = read(chunk_size)
+                if not data:
+                    raise zipfile.BadZipFile('unexpected end of the zip archive')
+            elif n_left > 0:
+                data = read_exactly(min(n_left, chunk_size))
+                n_left = n_left - len(data)
+            else:
+                break
+            if decompressor is not None:
+                data_out = decompressor.decompress(data)
+            else:
+                data_out = data
+            if out is not None:
+                out.write(data_out)
+                crc_out = zlib.crc32(data_out, crc_out)
+            if decompressor is not None and decompressor.eof:
+                # give back the bytes located after the compressed data
+                buffer[0] = decompressor.unused_data + buffer[0]
+                break
+        if descriptor:
+            # data descriptor (with or without signature)
+            data = read_exactly(4)
+            if data == b'PK\x07\x08':
+                data = read_exactly(4)
+            crc = struct.unpack('<I', data)[0]
+            # compressed and uncompressed sizes
+            read_exactly(16 if zip64 else 8)
+        if out is not None:
+            if not crc_out == crc:
+                raise zipfile.BadZipFile('bad CRC-32 for %s' % name)
+            return
+
+
+def download_tif(image, polygon, bandsId, filepath, filename):
+    """
+    Downloads a .TIF image from the ee server and saves it under filepath/filename. The zip
+    archive returned by the server is decompressed while it is being downloaded and written to
+    a temporary file in the same directory, which is renamed at the end, so that each image is
+    written only once and an interrupted download never leaves an incomplete image.
+        
+    Arguments:
+    -----------
+        image: ee.Image
+            Image object to be downloaded
+        polygon: list
+            polygon containing the lon/lat coordinates to be extracted
+            longitudes in the first column and latitudes in the second column
+        bandsId: list of dict
+            list of bands to be downloaded
+        filepath: str
+            directory where the image is saved
+        filename: str
+            name of the .TIF file
+
+    Returns:
+    -----------
+        fn: str
+            filepath + filename of the downloaded .TIF file
+            
+    """
+    
+    url = get_download_url(image, polygon, bandsId)
+    fn = os.path.join(filepath, filename)
+    fd, fn_temp = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.tif', dir=filepath)
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            try:
+                with urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+                    extract_zip_stream(response, 'data.tif', f_out)
+            except StreamNotSupported:
+                # the archive cannot be read sequentially, download it again (in memory if
+                # possible) and extract it with zipfile
+                f_out.seek(0)
+                f_out.truncate()
+                with urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+                    with tempfile.SpooledTemporaryFile(max_size=2**28, dir=filepath) as f_zip:
+                        shutil.copyfileobj(response, f_zip)
+                        with zipfile.ZipFile(f_zip) as local_zipfile:
+                            try:
+                                f_tif = local_zipfile.open('data.tif')
+                            except KeyError:
+                                raise ZipMemberNotFound('data.tif was not found in the zip '
+                                                        'archive')
+                            with f_tif:
+                                shutil.copyfileobj(f_tif, f_out)
+        # rename (overwrites a previous download of the same image)
+        os.replace(fn_temp, fn)
+    except:
+        os.remove(fn_temp)
+        raise
+
+    return fn
+
+
+def write_tif(data, fn, compression=None):
+    """
+    Writes a GDAL dataset in a GeoTIFF file. With compression, the GeoTIFF is internally tiled,
+    compressed (with a predictor) and contains overviews (nearest neighbour, so that the QA bits
+    are preserved), so that only the blocks or the resolution needed can be read.
+
+    Arguments:
+    -----------
+        data: gdal.Dataset
+            dataset to write
+        fn: str
+            filepath + filename of the GeoTIFF
+        compression: str (optional)
+            compression of the GeoTIFF ('DEFLATE' or 'ZSTD'), None for an uncompressed GeoTIFF
+
+    Returns:
+    -----------
+        fn: str
+            filepath + filename of the GeoTIFF
+
+    """
+
+    options = []
+    if compression is not None:
+        # floating point predictor for the reflectance bands, horizontal differencing otherwise
+        if gdal.GetDataTypeName(data.GetRasterBand(1).DataType).startswith('Float'):
+            predictor = 3
+        else:
+            predictor = 2
+        options = ['TILED=YES', 'BLOCKXSIZE=%d' % BLOCK_SIZE, 'BLOCKYSIZE=%d' % BLOCK_SIZE,
+                   'COMPRESS=%s' % compression, 'PREDICTOR=%d' % predictor, 'BIGTIFF=IF_SAFER']
+    data_out = gdal.Translate(fn, data, format='GTiff', creationOptions=options)
+    if data_out is None:
+        raise RuntimeError('could not write %s' % fn)
+    if compression is not None:
+        # internal overviews (compressed like the full resolution image)
+        factors = []
+        factor = 2
+        while max(data_out.RasterXSize, data_out.RasterYSize)/factor >= BLOCK_SIZE:
+            factors.append(factor)
+            factor = 2*factor
+        if len(factors) > 0:
+            data_out.BuildOverviews('NEAREST', factors)
+    # close the dataset to flush the file to disk
+    data_out = None
+
+    return fn
+
+
+def compress_tif(fn, compression):
+    """
+    Converts a .TIF file into an internally tiled and compressed GeoTIFF with overviews (see
+    write_tif). The new file is written in a temporary file which then replaces the original.
+
+    Arguments:
+    -----------
+        fn: str
+            filepath + filename of the .TIF file
+        compression: str
+            compression of the GeoTIFF ('DEFLATE' or 'ZSTD')
+
+    Returns:
+    -----------
+        fn: str
+            filepath + filename of the .TIF file
+
+    """
+
+    fd, fn_temp = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.tif', dir=os.path.dirname(fn))
+    os.close(fd)
+    try:
+        data = gdal.Open(fn)
+        write_tif(data, fn_temp, compression)
+        data = None
+        os.replace(fn_temp, fn)
+    except:
+        if os.path.exists(fn_temp):
+            os.remove(fn_temp)
+        raise
+
+    return fn
+
+
+def download_image_file(im_id, polygon, bandsId, filepath, filename, compression=None,
+                        rate_limit=None):
+    """
+    Downloads one .TIF file of a satellite image and saves it under its final filename
+    (optionally converted to a compressed GeoTIFF, see compress_tif).
+
+    Arguments:
+    -----------
+        im_id: str
+            id of the image in the ee database
+        polygon: list
+            polygon containing the lon/lat coordinates to be extracted
+            longitudes in the first column and latitudes in the second column
+        bandsId: list of dict
+            list of bands to be downloaded
+        filepath: str
+            directory where the image is saved
+        filename: str
+            name of the .TIF file
+        compression: str (optional)
+            compression of the GeoTIFF ('DEFLATE' or 'ZSTD'), None to keep the file returned by
+            the ee server
+        rate_limit: dict (optional)
+            maximum request rate (see get_rate_limit)
+
+    Returns:
+    -----------
+        fn: str
+            filepath + filename of the downloaded .TIF file
+
+    """
+
+    # find the image in ee database and download it (retried if the request fails)
+    im = ee.Image(im_id)
+    fn = retry(download_tif, [im, polygon, bandsId, filepath, filename], rate_limit=rate_limit)
+    if compression is not None:
+        compress_tif(fn, compression)
+
+    return fn
+
+
+def split_polygon(polygon, bandsId):
+    """
+    Splits the area of interest in tiles when the image requested is larger than
+    MAX_REQUEST_SIZE. The tiles are rectangles that cover the bounding box of the polygon (with
+    an overlap of 2 pixels), only the tiles intersecting the polygon are kept.
+
+    Arguments:
+    -----------
+        polygon: list
+            polygon containing the lon/lat coordinates to be extracted
+            longitudes in the first column and latitudes in the second column
+        bandsId: list of dict
+            list of bands to be downloaded
+
+    Returns:
+    -----------
+        polygons: list
+            polygons of the tiles (same format as polygon), only the original polygon if the
+            image can be requested at once
+
+    """
+
+    coords = np.array(polygon[0])
+    lon_min, lat_min = np.min(coords, axis=0)
+    lon_max, lat_max = np.max(coords, axis=0)
+    # approximate size of the image in pixels (finest resolution of the bands)
+    res = min([np.abs(_['crs_transform'][0]) for _ in bandsId])
+    width, height = get_bbox_size(polygon)
+    nx = width/res
+    ny = height/res
+    # 4 bytes per pixel and band (32-bit data types)
+    n_bytes = nx*ny*len(bandsId)*4
+    if n_bytes <= MAX_REQUEST_SIZE:
+        return [polygon]
+
+    # size of the tiles in pixels and number of tiles in each direction
+    tile_size = np.sqrt(MAX_REQUEST_SIZE/(len(bandsId)*4)) - 4
+    n_tiles_x = int(np.ceil(nx/tile_size))
+    n_tiles_y = int(np.ceil(ny/tile_size))
+    dx = (lon_max - lon_min)/n_tiles_x
+    dy = (lat_max - lat_min)/n_tiles_y
+    m_per_deg_lon, m_per_deg_lat = get_metres_per_degree((lat_min + lat_max)/2)
+    overlap_x = 2*res/m_per_deg_lon
+    overlap_y = 2*res/m_per_deg_lat
+    shape = geometry.Polygon(coords)
+    polygons = []
+    for i in range(n_tiles_x):
+        for j in range(n_tiles_y):
+            x0 = float(max(lon_min + i*dx - overlap_x, lon_min))
+            x1 = float(min(lon_min + (i+1)*dx + overlap_x, lon_max))
+            y0 = float(max(lat_min + j*dy - overlap_y, lat_min))
+            y1 = float(min(lat_min + (j+1)*dy + overlap_y, lat_max))
+            if not shape.intersects(geometry.box(x0, y0, x1, y1)):
+                continue
+            polygons.append([[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]])
+
+    return polygons
+
+
+def mosaic_tiles(fn_tiles, fn, compression=None):
+    """
+    Mosaics the tiles of an image downloaded in several parts into a single .TIF file and
+    removes the tiles.
+
+    Arguments:
+    -----------
+        fn_tiles: list of str
+            filepaths + filenames of the tiles
+        fn: str
+            filepath + filename of the mosaicked .TIF file
+        compression: str (optional)
+            compression of the GeoTIFF ('DEFLATE' or 'ZSTD'), None for an uncompressed GeoTIFF
+
+    Returns:
+    -----------
+        fn: str
+            filepath + filename of the mosaicked .TIF file
+
+    """
+
+    merge_rasters(fn_tiles, fn, None, compression)
+    for fn_tile in fn_tiles:
+        os.remove(fn_tile)
+
+    return fn
+
+
+def crop_image_file(fn_in, polygon, epsg, filepath, filename, compression=None):
+    """
+    Crops a .TIF file to the area of interest of a site, in the same way as the ee server (all
+    the pixels intersecting the bounding box of the polygon in the coordinate reference system
+    of the image). Used to extract the images of each site from an image downloaded once for
+    several sites.
+
+    Arguments:
+    -----------
+        fn_in: str
+            filepath + filename of the .TIF file to crop
+        polygon: list
+            polygon containing the lon/lat coordinates of the area of interest
+            longitudes in the first column and latitudes in the second column
+        epsg: int
+            epsg code of the coordinate reference system of the image
+        filepath: str
+            directory where the cropped image is saved
+        filename: str
+            name of the cropped .TIF file
+        compression: str (optional)
+            compression of the GeoTIFF ('DEFLATE' or 'ZSTD'), None for an uncompressed GeoTIFF
+
+    Returns:
+    -----------
+        fn: str
+            filepath + filename of the cropped .TIF file
+
+    """
+
+    data = gdal.Open(fn_in)
+    georef = data.GetGeoTransform()
+    # bounding box of the polygon in the coordinate reference system of the image
+    points = SDS_tools.convert_epsg(np.array(polygon[0]), 4326, epsg)[:,:2]
+    x_min, y_min = np.min(points, axis=0)
+    x_max, y_max = np.max(points, axis=0)
+    # pixels intersecting the bounding box (the rows go from north to south)
+    col_min = max(int(np.floor((x_min - georef[0])/georef[1])), 0)
+    col_max = min(int(np.ceil((x_max - georef[0])/georef[1])), data.RasterXSize)
+    row_min = max(int(np.floor((y_max - georef[3])/georef[5])), 0)
+    row_max = min(int(np.ceil((y_min - georef[3])/georef[5])), data.RasterYSize)
+    if col_max <= col_min or row_max <= row_min:
+        raise RuntimeError('the area of interest is outside of %s' % fn_in)
+    data_crop = gdal.Translate('', data, format='VRT',
+                               srcWin=[col_min, row_min, col_max - col_min, row_max - row_min])
+    # write the cropped image in a temporary file, renamed once complete
+    fn = os.path.join(filepath, filename)
+    fn_temp = os.path.join(filepath, TEMP_PREFIX + filename)
+    try:
+        write_tif(data_crop, fn_temp, compression)
+        data_crop = None
+        data = None
+        os.replace(fn_temp, fn)
+    except:
+        if os.path.exists(fn_temp):
+            os.remove(fn_temp)
+        raise
+
+    return fn
+
+
+def crop_shared_file(fn_shared, targets):
+    """
+    Crops an image downloaded once for several sites (see share_downloads) to the area of
+    interest of each site and removes the shared image.
+
+    Arguments:
+    -----------
+        fn_shared: str
+            filepath + filename of the shared .TIF file
+        targets: list
+            list of [polygon, epsg, filepath, filename, compression] for each site (see
+            crop_image_file)
+
+    Returns:
+    -----------
+        fn_list: list of str
+            filepaths + filenames of the cropped .TIF files
+
+    """
+
+    fn_list = []
+    try:
+        for polygon, epsg, filepath, filename, compression in targets:
+            fn_list.append(crop_image_file(fn_shared, polygon, epsg, filepath, filename,
+                                           compression))
+    finally:
+        os.remove(fn_shared)
+
+    return fn_list
+
+
+def share_downloads(jobs, filepath_cache):
+    """
+    Finds the images that are downloaded for several sites (same image id) and prepares a single
+    download of each of them, covering the bounding box of the areas of interest of all these
+    sites. The shared images are cropped locally for each site (see crop_shared_file).
+    An image is shared only if the bounding box of all the sites is not larger than the sum of
+    the bounding boxes of each site (adjacent or overlapping sites), otherwise each site is
+    downloaded separately.
+
+    Arguments:
+    -----------
+        jobs: list of dict
+            images to download (see download_images)
+        filepath_cache: str
+            directory where the shared images are saved until they are cropped
+
+    Returns:
+    -----------
+        shared: dict
+            one entry per shared .TIF file, the keys are (image id, index of the file in the
+            job), with the fields 'polygon' (polygon downloaded), 'fn' (filepath + filename of
+            the shared file) and 'users' (indices of the jobs of the sites using the file)
+
+    """
+
+    # jobs of each image
+    groups = dict([])
+    for i,job in enumerate(jobs):
+        if not job['id'] in groups.keys():
+            groups[job['id']] = []
+        groups[job['id']].append(i)
+
+    shared = dict([])
+    for im_id in groups.keys():
+        idx = groups[im_id]
+        if len(idx) < 2:
+            continue
+        # bounding box of all the sites
+        boxes = [geometry.box(*geometry.Polygon(jobs[_]['polygon'][0]).bounds) for _ in idx]
+        bounds = np.array([_.bounds for _ in boxes])
+        box_all = geometry.box(np.min(bounds[:,0]), np.min(bounds[:,1]),
+                               np.max(bounds[:,2]), np.max(bounds[:,3]))
+        if box_all.area > sum([_.area for _ in boxes]):
+            continue
+        polygon = [[[float(_[0]), float(_[1])] for _ in box_all.exterior.coords]]
+        # temporary files (removed in the next run if the download is interrupted)
+        name = im_id.replace('/', '_')
+        for k in range(len(jobs[idx[0]]['files'])):
+            fn = os.path.join(filepath_cache, TEMP_PREFIX + name + '_%d.tif' % k)
+            shared[(im_id, k)] = {'polygon':polygon, 'fn':fn, 'users':idx}
+
+    return shared
+
+
+def download_images(jobs, n_workers, shared=None, rate_limit=None, cancel=None):
+    """
+    Downloads a list of satellite images (of one or several sites) using a pool of n_workers
+    threads. The tasks are run in the order of the list of images. Each .TIF file
+    (e.g. pan and ms bands, or 10m, 20m and 60m bands) is downloaded as a separate task, and the
+    metadata .txt file of an image is written once all its files have been downloaded, and the
+    image is then recorded in the download manifest and in the metadata index. Images that could
+    not be downloaded (after retrying, see retry) are recorded as failed in the manifest instead
+    of stopping the download.
+    When the area of interest is too large for a single request (see split_polygon), each tile
+    is downloaded as a separate task and the tiles are then mosaicked into the .TIF file.
+    The files shared by several sites (see share_downloads) are downloaded once and then
+    cropped for each site.
+
+    Arguments:
+    -----------
+        jobs: list of dict
+            one dict per image with the following fields:
+        'id': str
+            id of the image in the ee database
+        'satname': str
+            short name of the satellite mission
+        'date': str
+            date of acquisition in format 'yyyy-mm-dd-HH-MM-SS'
+        'timestamp': datetime
+            date of acquisition (UTC)
+        'files': list
+            list of [bandsId, filepath, filename] for each .TIF file of the image
+        'filepath_meta': str
+            directory where the metadata .txt file is saved
+        'filename_txt': str
+            name of the metadata .txt file (without extension)
+        'metadict': dict
+            metadata of the image, written in the .txt file
+        'sitename': str
+            name of the site
+        'polygon': list
+            polygon containing the lon/lat coordinates to be extracted
+            longitudes in the first column and latitudes in the second column
+        'fn_manifest': str
+            filepath + filename of the download manifest, which is updated after each image
+        'fn_index': str
+            filepath + filename of the metadata index, which is updated after each image
+        'compression': str
+            compression of the GeoTIFFs ('DEFLATE' or 'ZSTD'), None to keep the files returned
+            by the ee server
+        'callback': function (optional)
+            called with the metadata of the image (see get_image_info) once it is downloaded
+        n_workers: int
+            maximum number of files downloaded at the same time
+        shared: dict (optional)
+            files downloaded once for several sites (see share_downloads)
+        rate_limit: dict (optional)
+            maximum request rate of the downloads (see get_rate_limit)
+        cancel: threading.Event (optional)
+            when it is set, the files that are not being downloaded yet are cancelled and
+            DownloadCancelled is raised once the files being downloaded are finished
+
+    Returns:
+    -----------
+        failed: list of dict
+            jobs of the images that could not be downloaded
+
+    """
+
+    if shared is None:
+        shared = dict([])
+    n_img = len(jobs)
+    count = 0
+    idx_failed = []
+    # number of images left and failed for each site (progress of each site)
+    sites = dict([])
+    for job in jobs:
+        if not job['fn_manifest'] in sites.keys():
+            sites[job['fn_manifest']] = {'sitename':job['sitename'], 'n_img':0, 'n_left':0,
+                                         'n_failed':0}
+        sites[job['fn_manifest']]['n_img'] = sites[job['fn_manifest']]['n_img'] + 1
+        sites[job['fn_manifest']]['n_left'] = sites[job['fn_manifest']]['n_left'] + 1
+    # tiles of the files that are downloaded in several parts
+    tiles = dict([])
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # submit one task per file (or per tile), in the order of the images
+        # (each task is recorded with the images it belongs to, its tiled file and its shared file)
+        futures = dict([])
+        for i,job in enumerate(jobs):
+            for k,(bands, filepath, filename) in enumerate(job['files']):
+                idx = [i]
+                group = None
+                polygon = job['polygon']
+                compression = job['compression']
+                if (job['id'], k) in shared.keys():
+                    # shared file, downloaded once (with the first site) in the cache directory
+                    group = (job['id'], k)
+                    if shared[group]['users'][0] != i:
+                        continue
+                    idx = shared[group]['users']
+                    polygon = shared[group]['polygon']
+                    filepath, filename = os.path.split(shared[group]['fn'])
+                    compression = None
+                polygons = split_polygon(polygon, bands)
+                if len(polygons) == 1:
+                    future = executor.submit(download_image_file, job['id'], polygon,
+                                             bands, filepath, filename, compression,
+                                             rate_limit)
+                    futures[future] = [idx, None, group]
+                    continue
+                # temporary files (removed in the next run if the download is interrupted)
+                fn_tiles = [TEMP_PREFIX + filename.replace('.tif', '_tile%d.tif' % j)
+                            for j in range(len(polygons))]
+                tiles[(i,k)] = {'n_left':len(polygons), 'error':None,
+                                'fn_tiles':[os.path.join(filepath, _) for _ in fn_tiles],
+                                'fn':os.path.join(filepath, filename),
+                                'compression':compression}
+                for j in range(len(polygons)):
+                    future = executor.submit(download_image_file, job['id'], polygons[j], bands,
+                                             filepath, fn_tiles[j], None, rate_limit)
+                    futures[future] = [idx, (i,k), group]
+        # number of files still to be downloaded for each image
+        n_left = [len(job['files']) for job in jobs]
+        pending = set(futures.keys())
+        while len(pending) > 0:
+            if cancel is not None and cancel.is_set():
+                for future in pending:
+                    future.cancel()
+                raise DownloadCancelled('the download was cancelled')
+            done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx, key, group = futures[future]
+                error = future.exception()
+                if key is not None:
+                    # mosaic the tiles of a file once they have all been downloaded
+                    tiles[key]['n_left'] = tiles[key]['n_left'] - 1
+                    if error is not None:
+                        tiles[key]['error'] = error
+                    if tiles[key]['n_left'] > 0:
+                        continue
+                    if tiles[key]['error'] is None:
+                        future = executor.submit(mosaic_tiles, tiles[key]['fn_tiles'],
+                                                 tiles[key]['fn'], tiles[key]['compression'])
+                        futures[future] = [idx, None, group]
+                        pending.add(future)
+                        continue
+                    error = tiles[key]['error']
+                    for fn_tile in tiles[key]['fn_tiles']:
+                        if os.path.exists(fn_tile):
+                            os.remove(fn_tile)
+                if group is not None and error is None:
+                    # crop the shared file for each site once it has been downloaded
+                    targets = [[jobs[i]['polygon'], jobs[i]['metadict']['epsg']] +
+                               jobs[i]['files'][group[1]][1:] + [jobs[i]['compression']]
+                               for i in idx]
+                    future = executor.submit(crop_shared_file, shared[group]['fn'], targets)
+                    futures[future] = [idx, None, None]
+                    pending.add(future)
+                    continue
+                for i in idx:
+                    n_left[i] = n_left[i] - 1
+                    if error is not None and not i in idx_failed:
+                        # record the failed image (it will be downloaded again in the next run)
+                        idx_failed.append(i)
+                        site = sites[jobs[i]['fn_manifest']]
+                        site['n_failed'] = site['n_failed'] + 1
+                        print('\nCould not download image %s: %s' % (jobs[i]['id'], error))
+                        record = {'id':jobs[i]['id'], 'satname':jobs[i]['satname'],
+                                  'date':jobs[i]['date'], 'status':'failed', 'error':str(error),
+                                  'files':[]}
+                        update_manifest(jobs[i]['fn_manifest'], record)
+                    if n_left[i] > 0:
+                        continue
+                    count = count + 1
+                    print('\r%d%%' % (int((count/n_img)*100)), end='')
+                    # progress of the site (when downloading several sites)
+                    site = sites[jobs[i]['fn_manifest']]
+                    site['n_left'] = site['n_left'] - 1
+                    if len(sites) > 1 and site['n_left'] == 0:
+                        print('\n%s: %d images downloaded (%d failed)' % (site['sitename'],
+                              site['n_img'] - site['n_failed'], site['n_failed']))
+                    if i in idx_failed:
+                        continue
+                    # write metadata in .txt file
+                    metadict = jobs[i]['metadict']
+                    fn_txt = os.path.join(jobs[i]['filepath_meta'], jobs[i]['filename_txt'] + '.txt')
+                    with open(fn_txt, 'w') as f:
+                        for key in metadict.keys():
+                            f.write('%s\t%s\n'%(key,metadict[key]))
+                    # record the complete image in the manifest (files in the same order)
+                    files = [get_file_info(os.path.join(_[1], _[2]), jobs[i]['fn_manifest'])
+                             for _ in jobs[i]['files']]
+                    record = {'id':jobs[i]['id'], 'satname':jobs[i]['satname'],
+                              'date':jobs[i]['date'], 'status':'complete', 'files':files}
+                    update_manifest(jobs[i]['fn_manifest'], record)
+                    # add the image to the metadata index
+                    im_meta = {'dates':[jobs[i]['timestamp']],
+                               'acc_georef':[metadict['acc_georef']],
+                               'epsg':[metadict['epsg']], 'filenames':[metadict['filename']]}
+                    update_metadata_index(jobs[i]['fn_index'], {jobs[i]['satname']:im_meta})
+                    # pass the image on for processing
+                    if 'callback' in jobs[i].keys():
+                        jobs[i]['callback'](get_image_info(jobs[i]['satname'], im_meta, 0))
+    print('')
+    if len(idx_failed) > 0:
+        print('%d images could not be downloaded' % len(idx_failed))
+
+    failed = [jobs[_] for _ in idx_failed]
+
+    return failed
+
+
+def get_file_info(fn, fn_manifest):
+    """
+    Describes a downloaded file for the download manifest: its location relative to the site
+    directory, its size and its md5 checksum.
+
+    Arguments:
+    -----------
+        fn: str
+            filepath + filename of the downloaded file
+        fn_manifest: str
+            filepath + filename of the download manifest (stored in the site directory)
+
+    Returns:
+    -----------
+        file_info: dict
+            contains the fields 'filename', 'folder', 'size' and 'md5'
+
+    """
+
+    md5 = hashlib.md5()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            md5.update(chunk)
+    folder = os.path.relpath(os.path.dirname(fn), os.path.dirname(fn_manifest))
+    file_info = {'filename':os.path.basename(fn), 'folder':folder.replace(os.sep, '/'),
+                 'size':os.path.getsize(fn), 'md5':md5.hexdigest()}
+
+    return file_info
+
+
+def load_manifest(fn_manifest):
+    """
+    Loads the download manifest of a site. The manifest is a text file with one JSON record per
+    line, appended every time an image is downloaded (or merged), so that an interrupted run
+    loses at most the record being written. When an image appears several times, the last
+    record is kept.
+
+    Arguments:
+    -----------
+        fn_manifest: str
+            filepath + filename of the download manifest
+
+    Returns:
+    -----------
+        manifest: dict
+            contains one record per image id, with the fields 'id', 'satname', 'date', 'status'
+            ('complete', 'merged' or 'failed') and 'files' (see get_file_info)
+
+    """
+
+    manifest = dict([])
+    if not os.path.exists(fn_manifest):
+        return manifest
+    with open(fn_manifest, 'r') as f:
+        for line in f:
+            # skip a record truncated by an interrupted run
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            manifest[record['id']] = record
+
+    return manifest
+
+
+def update_manifest(fn_manifest, record):
+    """
+    Appends a record to the download manifest of a site.
+
+    Arguments:
+    -----------
+        fn_manifest: str
+            filepath + filename of the download manifest
+        record: dict
+            record of the image (see load_manifest)
+
+    Returns:
+    -----------
+
+    """
+
+    # start a new line if the last record was truncated by an interrupted run
+    newline = ''
+    if os.path.exists(fn_manifest) and os.path.getsize(fn_manifest) > 0:
+        with open(fn_manifest, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if not f.read(1) == b'\n':
+                newline = '\n'
+    with open(fn_manifest, 'a') as f:
+        f.write(newline + json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_downloaded_images(manifest, im_col, filepath_site):
+    """
+    Finds the images of a collection that were completely downloaded in a previous run: they are
+    listed in the manifest and all their files are present with the recorded size. Images that
+    were merged into an overlapping image are also considered as downloaded.
+
+    Arguments:
+    -----------
+        manifest: dict
+            download manifest of the site (see load_manifest)
+        im_col: list of dict
+            images of the collection (features returned by getInfo)
+        filepath_site: str
+            directory of the site
+
+    Returns:
+    -----------
+        im_done: dict
+            filenames of the downloaded images, with the image id as key
+
+    """
+
+    im_done = dict([])
+    for im_dic in im_col:
+        if not im_dic['id'] in manifest.keys():
+            continue
+        record = manifest[im_dic['id']]
+        if record['status'] == 'failed':
+            continue
+        if not record['status'] == 'merged':
+            complete = True
+            for file_info in record['files']:
+                fn = os.path.join(filepath_site, *file_info['folder'].split('/'),
+                                  file_info['filename'])
+                if not os.path.exists(fn) or not os.path.getsize(fn) == file_info['size']:
+                    complete = False
+                    break
+            if not complete:
+                continue
+        im_done[im_dic['id']] = [_['filename'] for _ in record['files']]
+
+    return im_done
+
+
+def remove_temp_files(filepath_site):
+    """
+    Removes the temporary files left in the site directory by an interrupted download.
+
+    Arguments:
+    -----------
+        filepath_site: str
+            directory of the site
+
+    Returns:
+    -----------
+
+    """
+
+    for root, dirs, files in os.walk(filepath_site):
+        for fn in files:
+            if fn.startswith(TEMP_PREFIX):
+                os.remove(os.path.join(root, fn))
+
+
+def filter_S2_collection(im_list):
+    """
+    Removes the duplicates in the list of images of the Sentinel-2 collection.
+    The same image is often provided in different UTM zones, only the images projected in the
+    selected UTM zone (the one with the largest EPSG code) are kept. Then, for each group of
+    images acquired within one day, only the first 2 images of the group are kept.
+
+    The groups are formed in the same way as in the original loop (each group is centred on the
+    first image that is not yet in a group) but the images are sorted by time so that each group
+    is found with a binary search instead of comparing every pair of timestamps.
+
+    Arguments:
+    -----------
+        im_list: list of dict
+            images of the Sentinel-2 collection (features returned by getInfo)
+
+    Returns:
+    -----------
+        im_list_filtered: list of dict
+            images of the collection without the duplicates (in the same order as im_list)
+
+    """
+
+    if len(im_list) == 0:
+        return im_list
+
+    # time of acquisition (UNIX time in milliseconds) and utm zone of each image
+    timestamps = np.array([_['properties']['system:time_start'] for _ in im_list], dtype=np.int64)
+    utm_zones = np.array([int(_['bands'][0]['crs'][5:]) for _ in im_list])
+    # images that are not in the selected utm zone are removed
+    same_utm = utm_zones == np.max(utm_zones)
+    idx_delete = ~same_utm
+
+    # sort the images by time to find the images acquired within one day with a binary search
+    idx_sorted = np.argsort(timestamps, kind='stable')
+    timestamps_sorted = timestamps[idx_sorted]
+    one_day = 24*60*60*1000
+    idx_covered = np.zeros(len(im_list)).astype(bool)
+    i = 0
+    while i < len(im_list):
+        # group of images acquired less than one day before or after image i
+        start = np.searchsorted(timestamps_sorted, timestamps[i] - one_day, side='right')
+        end = np.searchsorted(timestamps_sorted, timestamps[i] + one_day, side='left')
+        idx_group = np.sort(idx_sorted[start:end])
+        idx_covered[idx_group] = True
+        # if more than 2 images with same date and same utm, drop the last ones
+        idx_keep = idx_group[same_utm[idx_group]]
+        idx_delete[idx_keep[2:]] = True
+        # move to the next image that is not yet in a group
+        while i < len(im_list) and idx_covered[i]:
+            i += 1
+
+    im_list_filtered = [x for k,x in enumerate(im_list) if not idx_delete[k]]
+
+    return im_list_filtered
+
+
+def add_cloud_cover(satname, im_col, polygon, screening, rate_limit=None):
+    """
+    Adds the cloud cover inside the area of interest (property AOI_CLOUD_COVER) and, optionally,
+    inside the buffer around the reference shoreline (property REF_CLOUD_COVER) to the images of
+    a collection. The cloud cover is computed on the ee server from the QA band (same cloud
+    values as SDS_preprocess.create_cloud_mask): the cloud mask is computed at the resolution of
+    the QA band and averaged at a coarse scale (SCREENING_SCALE, with bestEffort), in one
+    request per chunk of SCREENING_CHUNK images.
+
+    Arguments:
+    -----------
+        satname: str
+            short name of the satellite mission (L5, L7, L8 or S2)
+        im_col: list of dict
+            images of the collection (features returned by getInfo), their properties are
+            updated
+        polygon: list
+            polygon containing the lon/lat coordinates to be extracted
+            longitudes in the first column and latitudes in the second column
+        screening: dict
+            same keys as the settings of extract_shorelines, the reference shoreline buffer is
+            used if screening contains 'reference_shoreline' and 'output_epsg' ('max_dist_ref'
+            is 100 m by default)
+        rate_limit: dict (optional)
+            maximum request rate (see get_rate_limit)
+
+    Returns:
+    -----------
+        im_col: list of dict
+            images of the collection with the cloud cover properties
+
+    """
+
+    qa_band = SATELLITES[satname]['qa_band']
+    cloud_values = SDS_preprocess.CLOUD_VALUES[satname]
+    aoi = ee.Geometry.Polygon(polygon)
+    # buffer around the reference shoreline
+    ref_buffer = None
+    if 'reference_shoreline' in screening.keys() and 'output_epsg' in screening.keys():
+        if 'max_dist_ref' in screening.keys():
+            max_dist_ref = screening['max_dist_ref']
+        else:
+            max_dist_ref = 100
+        ref_sl = np.array(screening['reference_shoreline'])[:,:2].tolist()
+        ref_buffer = ee.Geometry.LineString(ref_sl, 'EPSG:%d' % screening['output_epsg'],
+                                            False).buffer(max_dist_ref)
+    geometries = [aoi] if ref_buffer is None else [aoi, ref_buffer]
+
+    def get_cloud_cover(im_id):
+        qa = ee.Image(im_id).select(qa_band)
+        # the QA values are bit-packed and cannot be resampled: the cloud mask is computed at the
+        # native resolution of the QA band (reproject) and then averaged over each coarse pixel
+        cloud = qa.remap(cloud_values, [1]*len(cloud_values), 0).rename('cloud')
+        cloud = cloud.reproject(qa.projection()).reduceResolution(reducer=ee.Reducer.mean(),
+                                                                  maxPixels=SCREENING_MAX_PIXELS)
+        return ee.List([cloud.reduceRegion(reducer=ee.Reducer.mean(), geometry=_,
+                                           scale=SCREENING_SCALE, maxPixels=1e9,
+                                           bestEffort=True).get('cloud') for _ in geometries])
+
+    keys = ['AOI_CLOUD_COVER', 'REF_CLOUD_COVER']
+    for i in range(0, len(im_col), SCREENING_CHUNK):
+        chunk = im_col[i:i+SCREENING_CHUNK]
+        request = ee.List([get_cloud_cover(_['id']) for _ in chunk])
+        cloud_covers = retry(request.getInfo, [], rate_limit=rate_limit)
+        for im_dic, values in zip(chunk, cloud_covers):
+            for key, value in zip(keys, values):
+                im_dic['properties'][key] = value
+
+    return im_col
+
+
+def screen_images(im_col, im_done, screening):
+    """
+    Removes the images that will certainly be rejected by extract_shorelines because of clouds,
+    using the cloud cover computed on the ee server (see add_cloud_cover): the images with more
+    cloud in the area of interest than screening['cloud_thresh'] (+ SCREENING_MARGIN) and, if
+    the detection is not checked by the user, the images with clouds over the reference
+    shoreline buffer (more than SCREENING_MARGIN). Images already downloaded are kept.
+
+    Arguments:
+    -----------
+        im_col: list of dict
+            images of the collection (see query_collection)
+        im_done: dict
+            filenames of the images already downloaded (see get_downloaded_images)
+        screening: dict
+            same keys as the settings of extract_shorelines ('cloud_thresh' is needed)
+
+    Returns:
+    -----------
+        im_col_kept: list of dict
+            images of the collection that are kept
+        n_skipped: int
+            number of images removed
+
+    """
+
+    check_detection = 'check_detection' in screening.keys() and screening['check_detection']
+    im_col_kept = []
+    for im_dic in im_col:
+        properties = im_dic['properties']
+        skip = False
+        if not im_dic['id'] in im_done.keys():
+            # the cloud cover is missing if there are no valid pixels in the area
+            if properties.get('AOI_CLOUD_COVER') is not None:
+                skip = properties['AOI_CLOUD_COVER'] > screening['cloud_thresh'] + SCREENING_MARGIN
+            if properties.get('REF_CLOUD_COVER') is not None and not check_detection:
+                skip = skip or properties['REF_CLOUD_COVER'] > SCREENING_MARGIN
+        if not skip:
+            im_col_kept.append(im_dic)
+    n_skipped = len(im_col) - len(im_col_kept)
+
+    return im_col_kept, n_skipped
+
+
+def query_collection(satname, polygon, dates, screening=None, rate_limit=None):
+    """
+    Queries the ee server for the images of a satellite mission covering the area of interest
+    and acquired between the specified dates. Very cloudy images (>95% cloud) are removed and,
+    for Sentinel-2, the duplicates of the collection (same image in different UTM zones).
+    If screening is provided, the cloud cover inside the area of interest is then computed for
+    each image (see add_cloud_cover). If this computation fails, the images are returned
+    without cloud cover and are all downloaded (no screening).
+        
+    Arguments:
+    -----------
+        satname: str
+            short name of the satellite mission (L5, L7, L8 or S2)
+        polygon: list
+            polygon containing the lon/lat coordinates to be extracted
+            longitudes in the first column and latitudes in the second column
+        dates: list of str
+            list that contains 2 strings with the initial and final dates in format 'yyyy-mm-dd'
+        screening: dict (optional)
+            settings of the cloud screening (see add_cloud_cover)
+        rate_limit: dict (optional)
+            maximum request rate (see get_rate_limit)
+    
+    Returns:
+    -----------
+        im_col: list of dict
+            images of the collection (features returned by getInfo)
+           
+    """
+    
+    input_col = ee.ImageCollection(SATELLITES[satname]['collection'])
+    # filter by location and dates
+    flt_col = input_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(dates[0],dates[1])
+    # get all images in the filtered collection (retried if the request fails)
+    im_all = retry(flt_col.getInfo, [], rate_limit=rate_limit).get('features')
+    
+    # remove duplicates in the collection (there are many in S2 collection)
+    if satname == 'S2':
+        im_all = filter_S2_collection(im_all)
+        
+    # remove very cloudy images (>95% cloud)
+    cloud_cover = [_['properties'][SATELLITES[satname]['cloud_property']] for _ in im_all]
+    if np.any([_ > 95 for _ in cloud_cover]):
+        idx_delete = np.where([_ > 95 for _ in cloud_cover])[0]
+        im_col = [x for k,x in enumerate(im_all) if k not in idx_delete]
+    else:
+        im_col = im_all
+
+    # compute the cloud cover in the area of interest on the server
+    if screening is not None:
+        try:
+            add_cloud_cover(satname, im_col, polygon, screening, rate_limit)
+        except Exception as error:
+            print('%s: the cloud screening failed (%s), the images are downloaded without '
+                  'screening' % (satname, error))
+            for im_dic in im_col:
+                for key in ['AOI_CLOUD_COVER', 'REF_CLOUD_COVER']:
+                    im_dic['properties'].pop(key, None)
+
+    return im_col
+
+
+def get_georef_accuracy(satname, properties):
+    """
+    Gets the georeferencing accuracy of an image from its properties.
+
+    Arguments:
+    -----------
+        satname: str
+            short name of the satellite mission (L5, L7, L8 or S2)
+        properties: dict
+            properties of the image (as returned by getInfo)
+
+    Returns:
+    -----------
+        acc_georef: float
+            RMSE of the geometric model for Landsat (12m if not provided), and for Sentinel-2
+            1 if the geometric quality control was passed and -1 if failed
+
+    """
+
+    if not satname == 'S2':
+        # get geometric accuracy
+        if 'GEOMETRIC_RMSE_MODEL' in properties.keys():
+            acc_georef = properties['GEOMETRIC_RMSE_MODEL']
+        else:
+            acc_georef = 12 # default value of accuracy (RMSE = 12m)
+    else:
+        # Sentinel-2 products don't provide a georeferencing accuracy (RMSE as in Landsat)
+        # but they have a flag indicating if the geometric quality control was passed or failed
+        # if passed a value of 1 is stored if failed a value of -1 is stored in the metadata
+        if 'GEOMETRIC_QUALITY_FLAG' in properties.keys():
+            if properties['GEOMETRIC_QUALITY_FLAG'] == 'PASSED':
+                acc_georef = 1
+            else:
+                acc_georef = -1
+        elif 'quality_check' in properties.keys():
+            if properties['quality_check'] == 'PASSED':
+                acc_georef = 1
+            else:
+                acc_georef = -1
+        else:
+            acc_georef = -1
+        
+    return acc_georef
+
+
+def plan_downloads(satname, im_col, im_done, sitename, filepath_site):
+    """
+    Prepares the download of the images of a satellite mission: filenames, metadata and bands
+    to download for each image. The images already downloaded keep their filenames and are not
+    downloaded again.
+
+    Arguments:
+    -----------
+        satname: str
+            short name of the satellite mission (L5, L7, L8 or S2)
+        im_col: list of dict
+            images of the collection (see query_collection)
+        im_done: dict
+            filenames of the images already downloaded (see get_downloaded_images)
+        sitename: str
+            String containig the name of the site
+        filepath_site: str
+            directory of the site
+
+    Returns:
+    -----------
+        im_meta: dict
+            contains the fields 'ids', 'dates', 'acc_georef', 'epsg' and 'filenames' of all the
+            images of the collection (in the same order as im_col)
+        jobs: list of dict
+            images to download (see download_images)
+
+    """
+
+    sat = SATELLITES[satname]
+    filepath_meta = os.path.join(filepath_site, satname, 'meta')
+    # format in which the images are downloaded
+    suffix = '.tif'
+
+    im_meta = {'ids':[], 'dates':[], 'acc_georef':[], 'epsg':[], 'filenames':[]}
+    all_names = [im_done[_][0] for _ in im_done.keys()]
+    jobs = []
+    for im_dic in im_col:
+        # get bands
+        im_bands = im_dic['bands']
+        # get time of acquisition (UNIX time)
+        t = im_dic['properties']['system:time_start']
+        # convert to datetime
+        im_timestamp = datetime.fromtimestamp(t/1000, tz=pytz.utc)
+        im_date = im_timestamp.strftime('%Y-%m-%d-%H-%M-%S')
+        # get EPSG code of reference system
+        im_epsg = int(im_dic['bands'][0]['crs'][5:])
+        # get georeferencing accuracy
+        acc_georef = get_georef_accuracy(satname, im_dic['properties'])
+        # filenames for the images (already downloaded images keep their filenames)
+        if im_dic['id'] in im_done.keys():
+            im_filenames = im_done[im_dic['id']]
+        else:
+            im_filenames = [im_date + '_' + satname + '_' + sitename + _ + suffix
+                            for _ in sat['suffixes']]
+            # if several images taken at the same date add 'dup' in the name (duplicate),
+            # followed by a number from the third image ('_dup2', '_dup3', ...)
+            n_dup = 1
+            while im_filenames[0] in all_names:
+                dup = '_dup' if n_dup == 1 else '_dup%d' % n_dup
+                im_filenames = [im_date + '_' + satname + '_' + sitename + _ + dup + suffix
+                                for _ in sat['suffixes']]
+                n_dup = n_dup + 1
+            all_names.append(im_filenames[0])
+        # store metadata
+        im_meta['ids'].append(im_dic['id'])
+        im_meta['dates'].append(im_timestamp)
+        im_meta['acc_georef'].append(acc_georef)
+        im_meta['epsg'].append(im_epsg)
+        im_meta['filenames'].append(im_filenames[0])
+        # skip the images that were already downloaded
+        if im_dic['id'] in im_done.keys():
+            continue
+        # delete dimensions key from dictionnary, otherwise the entire image is extracted
+        for j in range(len(im_bands)): del im_bands[j]['dimensions']
+        # bands to download for each file of the image
+        files = []
+        for k in range(len(sat['folders'])):
+            bands = [im_bands[_] for _ in sat['bands'][k]]
+            files.append([bands, os.path.join(filepath_site, satname, sat['folders'][k]),
+                          im_filenames[k]])
+        # add image to the list of images to download
+        filename_txt = im_filenames[0].replace(sat['suffixes'][0],'').replace(suffix,'')
+        metadict = {'filename':im_filenames[0],'acc_georef':acc_georef,
+                    'epsg':im_epsg}
+        jobs.append({'id':im_dic['id'], 'satname':satname, 'date':im_date,
+                     'timestamp':im_timestamp, 'files':files,
+                     'filepath_meta':filepath_meta, 'filename_txt':filename_txt,
+                     'metadict':metadict})
+
+    return im_meta, jobs
+
+
+def get_image_info(satname, metadata_sat, i):
+    """
+    Gets the metadata of one image from the metadata of a satellite mission.
+
+    Arguments:
+    -----------
+        satname: str
+            short name of the satellite mission
+        metadata_sat: dict
+            metadata of the images of the mission (fields 'dates', 'acc_georef', 'epsg' and
+            'filenames')
+        i: int
+            index of the image
+
+    Returns:
+    -----------
+        image: dict
+            contains the fields 'satname', 'filename', 'date', 'acc_georef' and 'epsg' of the
+            image
+
+    """
+
+    image = {'satname':satname, 'filename':metadata_sat['filenames'][i],
+             'date':metadata_sat['dates'][i], 'acc_georef':metadata_sat['acc_georef'][i],
+             'epsg':metadata_sat['epsg'][i]}
+
+    return image
+
+
+def get_metres_per_degree(lat):
+    """
+    Computes the approximate length in metres of one degree of longitude and latitude.
+
+    Arguments:
+    -----------
+        lat: float
+            latitude in degrees
+
+    Returns:
+    -----------
+        m_per_deg_lon, m_per_deg_lat: float
+            length of one degree of longitude and latitude in metres
+
+    """
+
+    m_per_deg_lon = 111320*np.cos(np.radians(lat))
+    m_per_deg_lat = 110540
+
+    return m_per_deg_lon, m_per_deg_lat
+
+
+def get_bbox_size(polygon):
+    """
+    Computes the approximate size of the bounding box of a polygon in metres.
+
+    Arguments:
+    -----------
+        polygon: list
+            polygon containing the lon/lat coordinates
+            longitudes in the first column and latitudes in the second column
+
+    Returns:
+    -----------
+        width, height: float
+            size of the bounding box in metres (east-west and north-south)
+
+    """
+
+    coords = np.array(polygon[0])
+    lon_min, lat_min = np.min(coords, axis=0)
+    lon_max, lat_max = np.max(coords, axis=0)
+    m_per_deg_lon, m_per_deg_lat = get_metres_per_degree((lat_min + lat_max)/2)
+    width = (lon_max - lon_min)*m_per_deg_lon
+    height = (lat_max - lat_min)*m_per_deg_lat
+
+    return width, height
+
+
+def estimate_cost(inputs, processing_rate=None):
+    """
+    Estimates the cost of a run before downloading anything (dry run): only the metadata of the
+    collections is queried. For each satellite mission, prints and returns the number of images
+    (without the images already downloaded and, with inputs['screening'], the images skipped
+    because of clouds), the volume of the download (from the size of the area of interest and
+    the resolution of each band, 4 bytes per pixel) and, with processing_rate, the time needed
+    to extract the shorelines.
+
+    Arguments:
+    -----------
+        inputs: dict
+            inputs of the site (see retrieve_images)
+        processing_rate: dict (optional)
+            time (in seconds) needed to process one megapixel of the preprocessed images of
+            each mission, measured on images already downloaded (see
+            SDS_shoreline.measure_processing_rate)
+
+    Returns:
+    -----------
+        cost: dict
+            for each mission, contains the fields 'n_images' (images in the collection),
+            'n_done' (already downloaded), 'n_skipped' (skipped because of clouds),
+            'n_download' (images to download), 'bytes' (volume of the download), 'megapixels'
+            (size of each preprocessed image) and 'processing_time' (in seconds, None if not
+            estimated)
+
+    """
+
+    # initialise connection with GEE server
+    ee.Initialize()
+
+    polygon = inputs['polygon']
+    if 'screening' in inputs.keys():
+        screening = inputs['screening']
+    else:
+        screening = None
+    if processing_rate is None:
+        processing_rate = dict([])
+    filepath_site = os.path.join(inputs['filepath'], inputs['sitename'])
+    manifest = load_manifest(os.path.join(filepath_site, inputs['sitename'] + '_manifest.jsonl'))
+
+    # size of the area of interest
+    width, height = get_bbox_size(polygon)
+    area = width*height/1e6
+    print('Area of interest: %.1f x %.1f km (%.1f km2)' % (width/1e3, height/1e3, area))
+    if area > MAX_AREA:
+        print('Warning: the area of interest is larger than %d km2' % MAX_AREA)
+
+    # query the collections of all the missions at the same time
+    satnames = [_ for _ in SATELLITES.keys() if _ in inputs['sat_list']
+                or SATELLITES[_]['alias'] in inputs['sat_list']]
+    with ThreadPoolExecutor(max_workers=max(len(satnames),1)) as executor:
+        im_cols = list(executor.map(query_collection, satnames, [polygon]*len(satnames),
+                                    [inputs['dates']]*len(satnames), [screening]*len(satnames)))
+
+    cost = dict([])
+    for satname, im_col in zip(satnames, im_cols):
+        sat = SATELLITES[satname]
+        n_images = len(im_col)
+        im_done = get_downloaded_images(manifest, im_col, filepath_site)
+        n_skipped = 0
+        if screening is not None:
+            im_col, n_skipped = screen_images(im_col, im_done, screening)
+        n_download = len(im_col) - len([_ for _ in im_col if _['id'] in im_done.keys()])
+        # volume of one image (all the bands of all its files)
+        n_bytes = 0
+        if len(im_col) > 0:
+            for bands in sat['bands']:
+                for k in bands:
+                    res = np.abs(im_col[0]['bands'][k]['crs_transform'][0])
+                    n_bytes = n_bytes + 4*width*height/res**2
+        # size of the preprocessed image and processing time of all the images
+        megapixels = width*height/sat['pixel_size']**2/1e6
+        if satname in processing_rate.keys():
+            processing_time = len(im_col)*megapixels*processing_rate[satname]
+        else:
+            processing_time = None
+        cost[satname] = {'n_images':n_images, 'n_done':len(im_done), 'n_skipped':n_skipped,
+                         'n_download':n_download, 'bytes':n_download*n_bytes,
+                         'megapixels':megapixels, 'processing_time':processing_time}
+
+    # print the estimates
+    print('%6s %8s %8s %8s %10s %10s %12s' % ('', 'images', 'done', 'skipped', 'download',
+                                              'MB', 'CPU-hours'))
+    for satname in cost.keys():
+        c = cost[satname]
+        if c['processing_time'] is None:
+            hours = '-'
+        else:
+            hours = '%.2f' % (c['processing_time']/3600)
+        print('%6s %8d %8d %8d %10d %10.1f %12s' % (satname, c['n_images'], c['n_done'],
+              c['n_skipped'], c['n_download'], c['bytes']/1e6, hours))
+
+    return cost
+
+
+def retrieve_images(inputs, callback=None, cancel=None):
+    """
+    Downloads all images from Landsat 5, Landsat 7, Landsat 8 and Sentinel-2 covering the area of
+    interest and acquired between the specified dates.
+    The downloaded images are in .TIF format and organised in subfolders, divided by satellite
+    mission and pixel resolution.
+    The collections of all the missions are queried first (in parallel, see prepare_site), then
+    the images of all the missions are downloaded from a single list sorted by date.
+    Every downloaded image is recorded in a manifest (sitename_manifest.jsonl), so that images
+    downloaded in a previous run (or before an interruption) are not downloaded again.
+    With a callback, each image is passed on for processing as soon as its files are on disk
+    (the images downloaded in a previous run first). The Sentinel-2 images that overlap another
+    image are only passed once they have been merged, at the end of the download.
+
+    KV WRL 2018
+
+    Arguments:
+    -----------
+        inputs: dict
+            dictionnary that contains the following fields:
+        'sitename': str
+            String containig the name of the site
+        'polygon': list
+            polygon containing the lon/lat coordinates to be extracted,
+            longitudes in the first column and latitudes in the second column,
+            there are 5 pairs of lat/lon with the fifth point equal to the first point.
+            e.g. [[[151.3, -33.7],[151.4, -33.7],[151.4, -33.8],[151.3, -33.8],
+            [151.3, -33.7]]]
+        'dates': list of str
+            list that contains 2 strings with the initial and final dates in format 'yyyy-mm-dd'
+            e.g. ['1987-01-01', '2018-01-01']
+        'sat_list': list of str
+            list that contains the names of the satellite missions to include
+            e.g. ['L5', 'L7', 'L8', 'S2']
+        'filepath_data': str
+            Filepath to the directory where the images are downloaded
+        'n_workers': int (optional)
+            number of files downloaded at the same time (default is 1, sequential download)
+        'download_order': str (optional)
+            'oldest' to download the oldest images first (default) or 'newest' to download the
+            most recent images first
+        'screening': dict (optional)
+            skips the images that will be rejected by extract_shorelines because of clouds
+            (cloud cover computed from the QA band before the download), same keys as the
+            settings of extract_shorelines: 'cloud_thresh' and optionally
+            'reference_shoreline', 'output_epsg', 'max_dist_ref' and 'check_detection'
+        'compression': str (optional)
+            'DEFLATE' or 'ZSTD' to store the images as internally tiled and compressed
+            GeoTIFFs with overviews (default is None, the images are stored as downloaded)
+        callback: function (optional)
+            called with the metadata of each image (see get_image_info) once it is on disk
+        cancel: threading.Event (optional)
+            stops the download when it is set (DownloadCancelled is raised, see
+            download_images)
+
+    Returns:
+    -----------
+        metadata: dict
+            contains the information about the satellite images that were downloaded: filename,
+            georeferencing accuracy and image coordinate reference system
+
+    """
+
+    # initialise connection with GEE server
+    ee.Initialize()
+
+    if 'n_workers' in inputs.keys():
+        n_workers = inputs['n_workers']
+    else:
+        n_workers = 1
+
+    print('Downloading images:')
+    # query the collections and prepare the downloads
+    site = prepare_site(inputs)
+    if callback is not None:
+        # the overlapping Sentinel-2 images are modified when they are merged (finish_site)
+        merged = []
+        if 'S2' in site['im_meta'].keys():
+            filenames = site['im_meta']['S2']['filenames']
+            for pair in find_overlapping_pairs(filenames):
+                merged = merged + [filenames[_] for _ in pair]
+        # pass on the images downloaded in a previous run, then each image once downloaded
+        ids_todo = [_['id'] for _ in site['jobs']]
+        for satname in site['satnames']:
+            for i in range(len(site['im_meta'][satname]['ids'])):
+                if site['im_meta'][satname]['ids'][i] in ids_todo:
+                    continue
+                if site['im_meta'][satname]['filenames'][i] in merged:
+                    continue
+                callback(get_image_info(satname, site['im_meta'][satname], i))
+        for job in site['jobs']:
+            if not job['metadict']['filename'] in merged:
+                job['callback'] = callback
+    # download the images
+    failed = download_images(site['jobs'], n_workers, cancel=cancel)
+    # merge overlapping images and save the metadata
+    metadata = finish_site(site, [_['id'] for _ in failed])
+    if callback is not None and 'S2' in metadata.keys():
+        # pass on the merged Sentinel-2 images
+        for i in range(len(metadata['S2']['filenames'])):
+            if metadata['S2']['filenames'][i] in merged:
+                callback(get_image_info('S2', metadata['S2'], i))
+
+    return metadata
+
+
+def retrieve_images_batch(inputs_list, n_workers=4, max_rate=None, share_images=False):
+    """
+    Downloads the images of several sites (see retrieve_images) with a single connection to the
+    GEE server. The downloads of all the sites go through a single pool of n_workers threads
+    (global concurrency limit), and the images of the sites are interleaved (one image of each
+    site in turn) so that every site progresses at the same pace.
+    With share_images, the images covering several neighbouring sites are downloaded once
+    (bounding box of these sites) and cropped locally for each site (see share_downloads), the
+    folders and metadata of each site are the same as when the sites are downloaded separately.
+
+    Arguments:
+    -----------
+        inputs_list: list of dict
+            inputs of each site (see retrieve_images, 'n_workers' is ignored)
+        n_workers: int
+            maximum number of files downloaded at the same time (all sites)
+        max_rate: float (optional)
+            maximum number of requests sent to the GEE server per second (all sites)
+        share_images: bool (optional)
+            if True, downloads the images shared by adjacent or overlapping sites only once
+
+    Returns:
+    -----------
+        metadata: dict
+            metadata of each site (see retrieve_images), the keys are the names of the sites
+
+    """
+
+    # initialise connection with GEE server (once for all the sites)
+    ee.Initialize()
+
+    # maximum request rate shared by all the requests of this batch
+    rate_limit = get_rate_limit(max_rate)
+    # query the collections and prepare the downloads of each site
+    sites = []
+    for inputs in inputs_list:
+        site = prepare_site(inputs, verbose=False, rate_limit=rate_limit)
+        n_img = sum([len(site['im_meta'][_]['ids']) for _ in site['satnames']])
+        n_done = n_img - len(site['jobs'])
+        print('%s: %d images to download (%d already downloaded)' % (inputs['sitename'],
+              len(site['jobs']), n_done))
+        sites.append(site)
+
+    # interleave the images of the sites (fair scheduling)
+    jobs = []
+    for k in range(max([len(_['jobs']) for _ in sites] + [0])):
+        for site in sites:
+            if k < len(site['jobs']):
+                jobs.append(site['jobs'][k])
+    # images shared by several sites, downloaded once in a cache directory
+    shared = None
+    if share_images:
+        filepath_cache = os.path.join(inputs_list[0]['filepath'], 'shared_images')
+        if not os.path.exists(filepath_cache):
+            os.makedirs(filepath_cache)
+        remove_temp_files(filepath_cache)
+        shared = share_downloads(jobs, filepath_cache)
+        n_shared = len(set([_[0] for _ in shared.keys()]))
+        print('%d images shared by several sites' % n_shared)
+    print('Downloading %d images for %d sites:' % (len(jobs), len(sites)))
+    failed = download_images(jobs, n_workers, shared, rate_limit)
+
+    # merge overlapping images and save the metadata of each site
+    metadata = dict([])
+    for site in sites:
+        failed_site = [_['id'] for _ in failed if _['fn_manifest'] == site['fn_manifest']]
+        metadata[site['inputs']['sitename']] = finish_site(site, failed_site)
+
+    # overall summary
+    print('%d images downloaded for %d sites (%d failed)' % (len(jobs) - len(failed), len(sites),
+                                                            len(failed)))
+
+    return metadata
 
 
-def retrieve_images(inputs):
+def prepare_site(inputs, verbose=True, rate_limit=None):
     """
-    Downloads all images from Landsat 5, Landsat 7, Landsat 8 and Sentinel-2 covering the area of 
-    interest and acquired between the specified dates. 
-    The downloaded images are in .TIF format and organised in subfolders, divided by satellite 
-    mission and pixel resolution.
-    
-    KV WRL 2018
-        
+    Prepares the download of the images of a site: creates the folders, queries the collections
+    of all the missions (in parallel) and lists the images to download, without the images that
+    were already downloaded in a previous run (see the manifest).
+
     Arguments:
     -----------
-        inputs: dict 
-            dictionnary that contains the following fields:
-        'sitename': str
-            String containig the name of the site
-        'polygon': list
-            polygon containing the lon/lat coordinates to be extracted,
-            longitudes in the first column and latitudes in the second column,
-            there are 5 pairs of lat/lon with the fifth point equal to the first point.
-            e.g. [[[151.3, -33.7],[151.4, -33.7],[151.4, -33.8],[151.3, -33.8],
-            [151.3, -33.7]]]
-        'dates': list of str
-            list that contains 2 strings with the initial and final dates in format 'yyyy-mm-dd'
-            e.g. ['1987-01-01', '2018-01-01']
-        'sat_list': list of str
-            list that contains the names of the satellite missions to include 
-            e.g. ['L5', 'L7', 'L8', 'S2']
-        'filepath_data': str
-            Filepath to the directory where the images are downloaded
-    
+        inputs: dict
+            inputs of the site (see retrieve_images)
+        verbose: bool
+            if True, prints the number of images of each mission
+        rate_limit: dict (optional)
+            maximum request rate of the queries (see get_rate_limit)
+
     Returns:
     -----------
-        metadata: dict
-            contains the information about the satellite images that were downloaded: filename, 
-            georeferencing accuracy and image coordinate reference system 
-           
+        site: dict
+            contains the inputs of the site ('inputs'), the satellite missions ('satnames'), the
+            metadata of all the images of each mission ('im_meta', see plan_downloads), the
+            images to download sorted by date ('jobs', see download_images) and the filepaths
+            of the site ('filepath_site', 'fn_manifest', 'fn_index')
+
     """
-    
-    # initialise connection with GEE server
-    ee.Initialize()
-    
+
     # read inputs dictionnary
     sitename = inputs['sitename']
     polygon = inputs['polygon']
     dates = inputs['dates']
     sat_list= inputs['sat_list']
     filepath_data = inputs['filepath']
-    
-    # format in which the images are downloaded
-    suffix = '.tif'
- 
-    # initialize metadata dictionnary (stores information about each image)       
-    metadata = dict([])
-    
+    if 'download_order' in inputs.keys():
+        download_order = inputs['download_order']
+    else:
+        download_order = 'oldest'
+    if 'screening' in inputs.keys():
+        screening = inputs['screening']
+    else:
+        screening = None
+    if 'compression' in inputs.keys():
+        compression = inputs['compression']
+    else:
+        compression = None
+
     # create a new directory for this site
-    if not os.path.exists(os.path.join(filepath_data,sitename)):
-        os.makedirs(os.path.join(filepath_data,sitename))
-        
-    print('Downloading images:')
-    
-    #=============================================================================================#
-    # download L5 images
-    #=============================================================================================#
-    
-    if 'L5' in sat_list or 'Landsat5' in sat_list:
-        
-        satname = 'L5'
-        # create a subfolder to store L5 images
-        filepath = os.path.join(filepath_data, sitename, satname, '30m')
-        filepath_meta = os.path.join(filepath_data, sitename, satname, 'meta')
-        if not os.path.exists(filepath):
-            os.makedirs(filepath)
-        if not os.path.exists(filepath_meta):
-            os.makedirs(filepath_meta)
-            
-        # Landsat 5 collection
-        count_loop = 0
-        while count_loop < 1:
-            try:
-                input_col = ee.ImageCollection('LANDSAT/LT05/C01/T1_TOA')
-                # filter by location and dates
-                flt_col = input_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(dates[0],dates[1])
-                # get all images in the filtered collection
-                im_all = flt_col.getInfo().get('features')
-                count_loop = 1
-            except: 
-                count_loop = 0   
-                
-        # remove very cloudy images (>95% cloud)
-        cloud_cover = [_['properties']['CLOUD_COVER'] for _ in im_all]
-        if np.any([_ > 95 for _ in cloud_cover]):
-            idx_delete = np.where([_ > 95 for _ in cloud_cover])[0]
-            im_col = [x for k,x in enumerate(im_all) if k not in idx_delete]
-        else:
-            im_col = im_all
-        n_img = len(im_col)
-        # print how many images there are
-        print('%s: %d images'%(satname,n_img))
-       
-       # loop trough images
-        timestamps = []
-        acc_georef = []
-        filenames = []
-        all_names = []
-        im_epsg = []
-        for i in range(n_img):
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    # find each image in ee database
-                    im = ee.Image(im_col[i]['id'])
-                    count_loop = 1
-                except: 
-                    count_loop = 0 
-            # read metadata
-            im_dic = im_col[i]
-            # get bands
-            im_bands = im_dic['bands']
-            # get time of acquisition (UNIX time)
-            t = im_dic['properties']['system:time_start']
-            # convert to datetime
-            im_timestamp = datetime.fromtimestamp(t/1000, tz=pytz.utc)
-            timestamps.append(im_timestamp)
-            im_date = im_timestamp.strftime('%Y-%m-%d-%H-%M-%S')
-            # get EPSG code of reference system
-            im_epsg.append(int(im_dic['bands'][0]['crs'][5:]))
-            # get geometric accuracy
-            if 'GEOMETRIC_RMSE_MODEL' in im_dic['properties'].keys():
-                acc_georef.append(im_dic['properties']['GEOMETRIC_RMSE_MODEL'])
-            else:
-                acc_georef.append(12) # default value of accuracy (RMSE = 12m)
-            # delete dimensions key from dictionnary, otherwise the entire image is extracted
-            for j in range(len(im_bands)): del im_bands[j]['dimensions']
-            # bands for L5
-            ms_bands = [im_bands[0], im_bands[1], im_bands[2], im_bands[3], im_bands[4], im_bands[7]]
-            # filenames for the images
-            filename = im_date + '_' + satname + '_' + sitename + suffix
-            # if two images taken at the same date add 'dup' in the name (duplicate)
-            if any(filename in _ for _ in all_names):
-                filename = im_date + '_' + satname + '_' + sitename + '_dup' + suffix 
-            all_names.append(filename)
-            filenames.append(filename)
-            # download .TIF image
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    local_data = download_tif(im, polygon, ms_bands, filepath)
-                    count_loop = 1
-                except: 
-                    count_loop = 0   
-            # update filename
-            try:
-                os.rename(local_data, os.path.join(filepath, filename))
-            except:
-                os.remove(os.path.join(filepath, filename))
-                os.rename(local_data, os.path.join(filepath, filename))
-            # write metadata in .txt file
-            filename_txt = filename.replace('.tif','')
-            metadict = {'filename':filename,'acc_georef':acc_georef[i],
-                        'epsg':im_epsg[i]}
-            with open(os.path.join(filepath_meta,filename_txt + '.txt'), 'w') as f:
-                for key in metadict.keys():
-                    f.write('%s\t%s\n'%(key,metadict[key]))
-                    
-            print('\r%d%%' % (int(((i+1)/n_img)*100)), end='')
-        print('')
-        
-        # sort metadata (downloaded images are sorted by date in directory)
-        timestamps_sorted = sorted(timestamps)
-        idx_sorted = sorted(range(len(timestamps)), key=timestamps.__getitem__)
-        acc_georef_sorted = [acc_georef[j] for j in idx_sorted]
-        filenames_sorted = [filenames[j] for j in idx_sorted]
-        im_epsg_sorted = [im_epsg[j] for j in idx_sorted]
-        # save into dict
-        metadata[satname] = {'dates':timestamps_sorted, 'acc_georef':acc_georef_sorted,
-                'epsg':im_epsg_sorted, 'filenames':filenames_sorted}       
-    
-    #=============================================================================================#
-    # download L7 images
-    #=============================================================================================#
-    
-    if 'L7' in sat_list or 'Landsat7' in sat_list:
-        
-        satname = 'L7'
-        # create subfolders (one for 30m multispectral bands and one for 15m pan bands)
-        filepath = os.path.join(filepath_data, sitename, 'L7')
-        filepath_pan = os.path.join(filepath, 'pan')
-        filepath_ms = os.path.join(filepath, 'ms')
-        filepath_meta = os.path.join(filepath, 'meta')
-        if not os.path.exists(filepath_pan):
-            os.makedirs(filepath_pan)
-        if not os.path.exists(filepath_ms):
-            os.makedirs(filepath_ms)
-        if not os.path.exists(filepath_meta):
-            os.makedirs(filepath_meta)
-            
-        # landsat 7 collection
-        count_loop = 0
-        while count_loop < 1:
-            try:
-                input_col = ee.ImageCollection('LANDSAT/LE07/C01/T1_RT_TOA')
-                # filter by location and dates
-                flt_col = input_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(dates[0],dates[1])
-                # get all images in the filtered collection
-                im_all = flt_col.getInfo().get('features')
-                count_loop = 1
-            except: 
-                count_loop = 0  
-
-        # remove very cloudy images (>95% cloud)
-        cloud_cover = [_['properties']['CLOUD_COVER'] for _ in im_all]
-        if np.any([_ > 95 for _ in cloud_cover]):
-            idx_delete = np.where([_ > 95 for _ in cloud_cover])[0]
-            im_col = [x for k,x in enumerate(im_all) if k not in idx_delete]
-        else:
-            im_col = im_all
-        n_img = len(im_col)
-        # print how many images there are
-        print('%s: %d images'%(satname,n_img)) 
-        
-        # loop trough images
-        timestamps = []
-        acc_georef = []
-        filenames = []
-        all_names = []
-        im_epsg = []
-        for i in range(n_img):
-            
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    # find each image in ee database
-                    im = ee.Image(im_col[i]['id'])
-                    count_loop = 1
-                except: 
-                    count_loop = 0            
-            # read metadata
-            im_dic = im_col[i]
-            # get bands
-            im_bands = im_dic['bands']
-            # get time of acquisition (UNIX time)
-            t = im_dic['properties']['system:time_start']
-            # convert to datetime
-            im_timestamp = datetime.fromtimestamp(t/1000, tz=pytz.utc)
-            timestamps.append(im_timestamp)
-            im_date = im_timestamp.strftime('%Y-%m-%d-%H-%M-%S')
-            # get EPSG code of reference system
-            im_epsg.append(int(im_dic['bands'][0]['crs'][5:]))
-            # get geometric accuracy
-            if 'GEOMETRIC_RMSE_MODEL' in im_dic['properties'].keys():
-                acc_georef.append(im_dic['properties']['GEOMETRIC_RMSE_MODEL'])
-            else:
-                acc_georef.append(12) # default value of accuracy (RMSE = 12m)  
-            # delete dimensions key from dictionnary, otherwise the entire image is extracted
-            for j in range(len(im_bands)): del im_bands[j]['dimensions']   
-            # bands for L7
-            pan_band = [im_bands[8]]
-            ms_bands = [im_bands[0], im_bands[1], im_bands[2], im_bands[3], im_bands[4], im_bands[9]] 
-            # filenames for the images
-            filename_pan = im_date + '_' + satname + '_' + sitename + '_pan' + suffix
-            filename_ms = im_date + '_' + satname + '_' + sitename + '_ms' + suffix  
-            # if two images taken at the same date add 'dup' in the name
-            if any(filename_pan in _ for _ in all_names):
-                filename_pan = im_date + '_' + satname + '_' + sitename + '_pan' + '_dup' + suffix
-                filename_ms = im_date + '_' + satname + '_' + sitename + '_ms' + '_dup' + suffix 
-            all_names.append(filename_pan)
-            filenames.append(filename_pan)
-            # download .TIF image
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    local_data_pan = download_tif(im, polygon, pan_band, filepath_pan)
-                    local_data_ms = download_tif(im, polygon, ms_bands, filepath_ms)
-                    count_loop = 1
-                except: 
-                    count_loop = 0  
-            # update filename
-            try:
-                os.rename(local_data_pan, os.path.join(filepath_pan, filename_pan))
-            except:
-                os.remove(os.path.join(filepath_pan, filename_pan))
-                os.rename(local_data_pan, os.path.join(filepath_pan, filename_pan))
-            try:
-                os.rename(local_data_ms, os.path.join(filepath_ms, filename_ms))
-            except:
-                os.remove(os.path.join(filepath_ms, filename_ms))
-                os.rename(local_data_ms, os.path.join(filepath_ms, filename_ms))
-            # write metadata in .txt file
-            filename_txt = filename_pan.replace('_pan','').replace('.tif','')
-            metadict = {'filename':filename_pan,'acc_georef':acc_georef[i],
-                        'epsg':im_epsg[i]}
-            with open(os.path.join(filepath_meta,filename_txt + '.txt'), 'w') as f:
-                for key in metadict.keys():
-                    f.write('%s\t%s\n'%(key,metadict[key]))
-                    
-            print('\r%d%%' % (int(((i+1)/n_img)*100)), end='')
-        print('')
-            
-        # sort metadata (dowloaded images are sorted by date in directory)
-        timestamps_sorted = sorted(timestamps)
-        idx_sorted = sorted(range(len(timestamps)), key=timestamps.__getitem__)
-        acc_georef_sorted = [acc_georef[j] for j in idx_sorted]
-        filenames_sorted = [filenames[j] for j in idx_sorted]
-        im_epsg_sorted = [im_epsg[j] for j in idx_sorted]
-        # save into dict
-        metadata[satname] = {'dates':timestamps_sorted, 'acc_georef':acc_georef_sorted,
-                'epsg':im_epsg_sorted, 'filenames':filenames_sorted}        
-        
-    #=============================================================================================#
-    # download L8 images
-    #=============================================================================================#
-    
-    if 'L8' in sat_list or 'Landsat8' in sat_list:
-
-        satname = 'L8'  
-        # create subfolders (one for 30m multispectral bands and one for 15m pan bands)
-        filepath = os.path.join(filepath_data, sitename, 'L8')
-        filepath_pan = os.path.join(filepath, 'pan')
-        filepath_ms = os.path.join(filepath, 'ms')
-        filepath_meta = os.path.join(filepath, 'meta')
-        if not os.path.exists(filepath_pan):
-            os.makedirs(filepath_pan)
-        if not os.path.exists(filepath_ms):
-            os.makedirs(filepath_ms)
-        if not os.path.exists(filepath_meta):
-            os.makedirs(filepath_meta)
-            
-        # landsat 8 collection
-        count_loop = 0
-        while count_loop < 1:
-            try:
-                input_col = ee.ImageCollection('LANDSAT/LC08/C01/T1_RT_TOA')
-                # filter by location and dates
-                flt_col = input_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(dates[0],dates[1])
-                # get all images in the filtered collection
-                im_all = flt_col.getInfo().get('features')
-                count_loop = 1
-            except: 
-                count_loop = 0 
-                
-        # remove very cloudy images (>95% cloud)
-        cloud_cover = [_['properties']['CLOUD_COVER'] for _ in im_all]
-        if np.any([_ > 95 for _ in cloud_cover]):
-            idx_delete = np.where([_ > 95 for _ in cloud_cover])[0]
-            im_col = [x for k,x in enumerate(im_all) if k not in idx_delete]
-        else:
-            im_col = im_all
-        n_img = len(im_col)
-        # print how many images there are
-        print('%s: %d images'%(satname,n_img)) 
-        
-       # loop trough images
-        timestamps = []
-        acc_georef = []
-        filenames = []
-        all_names = []
-        im_epsg = []
-        for i in range(n_img):
-            
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    # find each image in ee database
-                    im = ee.Image(im_col[i]['id'])
-                    count_loop = 1
-                except: 
-                    count_loop = 0             
-            # read metadata
-            im_dic = im_col[i]
-            # get bands
-            im_bands = im_dic['bands']
-            # get time of acquisition (UNIX time)
-            t = im_dic['properties']['system:time_start']
-            # convert to datetime
-            im_timestamp = datetime.fromtimestamp(t/1000, tz=pytz.utc)
-            timestamps.append(im_timestamp)
-            im_date = im_timestamp.strftime('%Y-%m-%d-%H-%M-%S')
-            # get EPSG code of reference system
-            im_epsg.append(int(im_dic['bands'][0]['crs'][5:]))
-            # get geometric accuracy
-            if 'GEOMETRIC_RMSE_MODEL' in im_dic['properties'].keys():
-                acc_georef.append(im_dic['properties']['GEOMETRIC_RMSE_MODEL'])
-            else:
-                acc_georef.append(12) # default value of accuracy (RMSE = 12m)
-            # delete dimensions key from dictionnary, otherwise the entire image is extracted
-            for j in range(len(im_bands)): del im_bands[j]['dimensions']   
-            # bands for L8    
-            pan_band = [im_bands[7]]
-            ms_bands = [im_bands[1], im_bands[2], im_bands[3], im_bands[4], im_bands[5], im_bands[11]]
-            # filenames for the images
-            filename_pan = im_date + '_' + satname + '_' + sitename + '_pan' + suffix
-            filename_ms = im_date + '_' + satname + '_' + sitename + '_ms' + suffix  
-            # if two images taken at the same date add 'dup' in the name
-            if any(filename_pan in _ for _ in all_names):
-                filename_pan = im_date + '_' + satname + '_' + sitename + '_pan' + '_dup' + suffix
-                filename_ms = im_date + '_' + satname + '_' + sitename + '_ms' + '_dup' + suffix 
-            all_names.append(filename_pan)  
-            filenames.append(filename_pan)
-            # download .TIF image
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    local_data_pan = download_tif(im, polygon, pan_band, filepath_pan)
-                    local_data_ms = download_tif(im, polygon, ms_bands, filepath_ms)
-                    count_loop = 1
-                except: 
-                    count_loop = 0 
-
-            # update filename
-            try:
-                os.rename(local_data_pan, os.path.join(filepath_pan, filename_pan))
-            except:
-                os.remove(os.path.join(filepath_pan, filename_pan))
-                os.rename(local_data_pan, os.path.join(filepath_pan, filename_pan))
-            try:
-                os.rename(local_data_ms, os.path.join(filepath_ms, filename_ms))
-            except:
-                os.remove(os.path.join(filepath_ms, filename_ms))
-                os.rename(local_data_ms, os.path.join(filepath_ms, filename_ms))
-            # write metadata in .txt file
-            filename_txt = filename_pan.replace('_pan','').replace('.tif','')
-            metadict = {'filename':filename_pan,'acc_georef':acc_georef[i],
-                        'epsg':im_epsg[i]}
-            with open(os.path.join(filepath_meta,filename_txt + '.txt'), 'w') as f:
-                for key in metadict.keys():
-                    f.write('%s\t%s\n'%(key,metadict[key]))
-                
-            print('\r%d%%' % (int(((i+1)/n_img)*100)), end='')
-        print('')
-    
-        # sort metadata (dowloaded images are sorted by date in directory)
-        timestamps_sorted = sorted(timestamps)
-        idx_sorted = sorted(range(len(timestamps)), key=timestamps.__getitem__)
-        acc_georef_sorted = [acc_georef[j] for j in idx_sorted]
-        filenames_sorted = [filenames[j] for j in idx_sorted]
-        im_epsg_sorted = [im_epsg[j] for j in idx_sorted]
-        
-        metadata[satname] = {'dates':timestamps_sorted, 'acc_georef':acc_georef_sorted,
-                'epsg':im_epsg_sorted, 'filenames':filenames_sorted}
+    filepath_site = os.path.join(filepath_data, sitename)
+    if not os.path.exists(filepath_site):
+        os.makedirs(filepath_site)
 
-    #=============================================================================================#
-    # download S2 images
-    #=============================================================================================#
-    
-    if 'S2' in sat_list or 'Sentinel2' in sat_list:
-
-        satname = 'S2' 
-        # create subfolders for the 10m, 20m and 60m multipectral bands
-        filepath = os.path.join(filepath_data, sitename, 'S2')
-        if not os.path.exists(os.path.join(filepath, '10m')):
-            os.makedirs(os.path.join(filepath, '10m'))
-        if not os.path.exists(os.path.join(filepath, '20m')):
-            os.makedirs(os.path.join(filepath, '20m'))
-        if not os.path.exists(os.path.join(filepath, '60m')):
-            os.makedirs(os.path.join(filepath, '60m'))
-        filepath_meta = os.path.join(filepath, 'meta')
-        if not os.path.exists(filepath_meta):
-            os.makedirs(filepath_meta)
-            
-        # Sentinel2 collection
-        count_loop = 0
-        while count_loop < 1:
-            try:
-                input_col = ee.ImageCollection('COPERNICUS/S2')
-                # filter by location and dates
-                flt_col = input_col.filterBounds(ee.Geometry.Polygon(polygon)).filterDate(dates[0],dates[1])
-                # get all images in the filtered collection
-                im_all = flt_col.getInfo().get('features') 
-                count_loop = 1
-            except: 
-                count_loop = 0 
- 
-        # remove duplicates in the collection (there are many in S2 collection)
-        timestamps = [datetime.fromtimestamp(_['properties']['system:time_start']/1000,
-                                             tz=pytz.utc) for _ in im_all]
-        # utm zone projection
-        utm_zones = np.array([int(_['bands'][0]['crs'][5:]) for _ in im_all])
-        utm_zone_selected =  np.max(np.unique(utm_zones))
-        # find the images that were acquired at the same time but have different utm zones
-        idx_all = np.arange(0,len(im_all),1)
-        idx_covered = np.ones(len(im_all)).astype(bool)
-        idx_delete = []
-        i = 0
-        while 1:
-            same_time = np.abs([(timestamps[i]-_).total_seconds() for _ in timestamps]) < 60*60*24
-            idx_same_time = np.where(same_time)[0]
-            same_utm = utm_zones == utm_zone_selected
-            idx_temp = np.where([same_time[j] == True and same_utm[j] == False for j in idx_all])[0]
-            idx_keep = idx_same_time[[_ not in idx_temp for _ in idx_same_time ]]
-            # if more than 2 images with same date and same utm, drop the last ones
-            if len(idx_keep) > 2: 
-               idx_temp = np.append(idx_temp,idx_keep[-(len(idx_keep)-2):])
-            for j in idx_temp:
-                idx_delete.append(j)
-            idx_covered[idx_same_time] = False
-            if np.any(idx_covered):
-                i = np.where(idx_covered)[0][0]
-            else:
-                break
-        # update the collection by deleting all those images that have same timestamp and different
-        # utm projection
-        im_all_updated = [x for k,x in enumerate(im_all) if k not in idx_delete]
-        
-        # remove very cloudy images (>95% cloud)
-        cloud_cover = [_['properties']['CLOUDY_PIXEL_PERCENTAGE'] for _ in im_all_updated]
-        if np.any([_ > 95 for _ in cloud_cover]):
-            idx_delete = np.where([_ > 95 for _ in cloud_cover])[0]
-            im_col = [x for k,x in enumerate(im_all_updated) if k not in idx_delete]
-        else:
-            im_col = im_all_updated
-        
-        n_img = len(im_col)
-        # print how many images there are
-        print('%s: %d images'%(satname,n_img)) 
+    # load the manifest of the images already downloaded and clean up after interrupted runs
+    fn_manifest = os.path.join(filepath_site, sitename + '_manifest' + '.jsonl')
+    manifest = load_manifest(fn_manifest)
+    remove_temp_files(filepath_site)
+    # metadata index of the site (updated as the images are downloaded)
+    fn_index = os.path.join(filepath_site, sitename + '_metadata' + '.db')
+
+    # satellite missions to download
+    satnames = [_ for _ in SATELLITES.keys() if _ in sat_list or SATELLITES[_]['alias'] in sat_list]
+    # create subfolders for each mission (one per pixel resolution + one for the metadata)
+    for satname in satnames:
+        for folder in SATELLITES[satname]['folders'] + ['meta']:
+            if not os.path.exists(os.path.join(filepath_site, satname, folder)):
+                os.makedirs(os.path.join(filepath_site, satname, folder))
+
+    # query the collections of all the missions at the same time
+    with ThreadPoolExecutor(max_workers=max(len(satnames),1)) as executor:
+        im_cols = list(executor.map(query_collection, satnames, [polygon]*len(satnames),
+                                    [dates]*len(satnames), [screening]*len(satnames),
+                                    [rate_limit]*len(satnames)))
+
+    # prepare the downloads of each mission
+    im_meta = dict([])
+    jobs = []
+    for satname, im_col in zip(satnames, im_cols):
+        # images already downloaded in a previous run are not downloaded again
+        im_done = get_downloaded_images(manifest, im_col, filepath_site)
+        # skip the images that are too cloudy
+        if screening is not None:
+            n_total = len(im_col)
+            im_col, n_skipped = screen_images(im_col, im_done, screening)
+            if verbose:
+                print('%s: %d images (%d skipped because of clouds, %d already downloaded)'%(
+                      satname,n_total,n_skipped,len(im_done)))
+        elif verbose:
+            # print how many images there are
+            print('%s: %d images (%d already downloaded)'%(satname,len(im_col),len(im_done)))
+        im_meta[satname], jobs_sat = plan_downloads(satname, im_col, im_done, sitename,
+                                                    filepath_site)
+        jobs = jobs + jobs_sat
     
-       # loop trough images
-        timestamps = []
-        acc_georef = []
-        filenames = []
-        all_names = []
-        im_epsg = []
-        for i in range(n_img):
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    # find each image in ee database
-                    im = ee.Image(im_col[i]['id'])
-                    count_loop = 1
-                except: 
-                    count_loop = 0             
-            # read metadata
-            im_dic = im_col[i]
-            # get bands
-            im_bands = im_dic['bands']
-            # get time of acquisition (UNIX time)
-            t = im_dic['properties']['system:time_start']
-            # convert to datetime
-            im_timestamp = datetime.fromtimestamp(t/1000, tz=pytz.utc)
-            im_date = im_timestamp.strftime('%Y-%m-%d-%H-%M-%S')   
-            # delete dimensions key from dictionnary, otherwise the entire image is extracted
-            for j in range(len(im_bands)): del im_bands[j]['dimensions'] 
-            # bands for S2
-            bands10 = [im_bands[1], im_bands[2], im_bands[3], im_bands[7]]
-            bands20 = [im_bands[11]]
-            bands60 = [im_bands[15]]    
-            # filenames for images
-            filename10 = im_date + '_' + satname + '_' + sitename + '_' + '10m' + suffix
-            filename20 = im_date + '_' + satname + '_' + sitename + '_' + '20m' + suffix
-            filename60 = im_date + '_' + satname + '_' + sitename + '_' + '60m' + suffix
-            # if two images taken at the same date skip the second image (they are the same)
-            if any(filename10 in _ for _ in all_names):
-                filename10 = filename10[:filename10.find('.')] + '_dup' + suffix
-                filename20 = filename20[:filename20.find('.')] + '_dup' + suffix
-                filename60 = filename60[:filename60.find('.')] + '_dup' + suffix
-            all_names.append(filename10)  
-            filenames.append(filename10)
+    # images of all the missions in a single list sorted by date
+    jobs = sorted(jobs, key=lambda _: _['date'], reverse=(download_order == 'newest'))
+    for job in jobs:
+        job.update({'sitename':sitename, 'polygon':polygon, 'fn_manifest':fn_manifest,
+                    'fn_index':fn_index, 'compression':compression})
             
-            # download .TIF image and update filename
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    local_data = download_tif(im, polygon, bands10, os.path.join(filepath, '10m'))
-                    count_loop = 1
-                except: 
-                    count_loop = 0  
-                    
-            try:
-                os.rename(local_data, os.path.join(filepath, '10m', filename10))
-            except:
-                os.remove(os.path.join(filepath, '10m', filename10))
-                os.rename(local_data, os.path.join(filepath, '10m', filename10))
-                
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    local_data = download_tif(im, polygon, bands20, os.path.join(filepath, '20m'))
-                    count_loop = 1
-                except: 
-                    count_loop = 0  
-                    
-            try:
-                os.rename(local_data, os.path.join(filepath, '20m', filename20))
-            except:
-                os.remove(os.path.join(filepath, '20m', filename20))
-                os.rename(local_data, os.path.join(filepath, '20m', filename20))
-                
-            count_loop = 0
-            while count_loop < 1:
-                try:
-                    local_data = download_tif(im, polygon, bands60, os.path.join(filepath, '60m'))
-                    count_loop = 1
-                except: 
-                    count_loop = 0 
-                    
-            try:
-                os.rename(local_data, os.path.join(filepath, '60m', filename60))
-            except:
-                os.remove(os.path.join(filepath, '60m', filename60))
-                os.rename(local_data, os.path.join(filepath, '60m', filename60))
-                    
-            # save timestamp, epsg code and georeferencing accuracy (1 if passed 0 if not passed)
-            timestamps.append(im_timestamp)
-            im_epsg.append(int(im_dic['bands'][0]['crs'][5:]))
-            # Sentinel-2 products don't provide a georeferencing accuracy (RMSE as in Landsat)
-            # but they have a flag indicating if the geometric quality control was passed or failed
-            # if passed a value of 1 is stored if failed a value of -1 is stored in the metadata
-            if 'GEOMETRIC_QUALITY_FLAG' in im_dic['properties'].keys():
-                if im_dic['properties']['GEOMETRIC_QUALITY_FLAG'] == 'PASSED':
-                    acc_georef.append(1)
-                else:
-                    acc_georef.append(-1)
-            elif 'quality_check' in im_dic['properties'].keys():
-                if im_dic['properties']['quality_check'] == 'PASSED':
-                    acc_georef.append(1) 
-                else:
-                    acc_georef.append(-1)
-            else:
-                acc_georef.append(-1)
-            # write metadata in .txt file
-            filename_txt = filename10.replace('_10m','').replace('.tif','')
-            metadict = {'filename':filename10,'acc_georef':acc_georef[i],
-                        'epsg':im_epsg[i]}
-            with open(os.path.join(filepath_meta,filename_txt + '.txt'), 'w') as f:
-                for key in metadict.keys():
-                    f.write('%s\t%s\n'%(key,metadict[key]))
-                
-            print('\r%d%%' % (int(((i+1)/n_img)*100)), end='')
-        print('')
-        # sort metadata (dowloaded images are sorted by date in directory)
-        timestamps_sorted = sorted(timestamps)
-        idx_sorted = sorted(range(len(timestamps)), key=timestamps.__getitem__)
-        acc_georef_sorted = [acc_georef[j] for j in idx_sorted]
-        filenames_sorted = [filenames[j] for j in idx_sorted]
-        im_epsg_sorted = [im_epsg[j] for j in idx_sorted]
-        
-        metadata[satname] = {'dates':timestamps_sorted, 'acc_georef':acc_georef_sorted,
-                'epsg':im_epsg_sorted, 'filenames':filenames_sorted} 
+    site = {'inputs':inputs, 'satnames':satnames, 'im_meta':im_meta, 'jobs':jobs,
+            'filepath_site':filepath_site, 'fn_manifest':fn_manifest, 'fn_index':fn_index}
+
+    return site
+
+
+def finish_site(site, failed):
+    """
+    Finishes the download of the images of a site: removes the images that could not be
+    downloaded from the metadata, merges the overlapping Sentinel-2 images and saves the
+    metadata (metadata index and sitename_metadata.pkl).
+
+    Arguments:
+    -----------
+        site: dict
+            site prepared by prepare_site
+        failed: list of str
+            ids of the images of the site that could not be downloaded
+
+    Returns:
+    -----------
+        metadata: dict
+            contains the information about the satellite images that were downloaded: filename,
+            georeferencing accuracy and image coordinate reference system
+
+    """
+
+    inputs = site['inputs']
+    im_meta = site['im_meta']
+    failed = set(failed)
+
+    # initialize metadata dictionnary (stores information about each image)
+    metadata = dict([])
+    for satname in site['satnames']:
+        # remove the images that could not be downloaded from the metadata
+        idx_ok = [k for k in range(len(im_meta[satname]['ids']))
+                  if not im_meta[satname]['ids'][k] in failed]
+        # sort metadata (downloaded images are sorted by date in directory)
+        idx_sorted = sorted(idx_ok, key=im_meta[satname]['dates'].__getitem__)
+        metadata[satname] = dict([])
+        for key in ['dates', 'acc_georef', 'epsg', 'filenames']:
+            metadata[satname][key] = [im_meta[satname][key][k] for k in idx_sorted]
     
     # merge overlapping images (necessary only if the polygon is at the boundary of an image)
     if 'S2' in metadata.keys():
         metadata = merge_overlapping_images(metadata,inputs)
 
+    # add the images downloaded in previous runs to the metadata index
+    update_metadata_index(site['fn_index'], metadata)
+
     # save metadata dict
-    filepath = os.path.join(filepath_data, sitename)
-    with open(os.path.join(filepath, sitename + '_metadata' + '.pkl'), 'wb') as f:
+    fn_metadata = os.path.join(site['filepath_site'], inputs['sitename'] + '_metadata' + '.pkl')
+    with open(fn_metadata, 'wb') as f:
         pickle.dump(metadata, f)
     
     return metadata
         
             
+def merge_rasters(fn_list, fn_out, nodata, compression=None, masks=None):
+    """
+    Mosaics rasters with the same projection and pixel size. The mosaic is built in memory as a
+    GDAL virtual raster (VRT), the later rasters are placed on top of the previous ones and their
+    pixels equal to nodata are transparent. The mosaic is written only once, in a temporary file
+    with a unique name which is then moved to fn_out (fn_out can be one of the input rasters).
+    Pixels of the input rasters can also be masked (set to nodata) in the mosaic, on a copy in
+    memory, so that the input files are not rewritten.
+
+    Arguments:
+    -----------
+        fn_list: list of str
+            filepaths + filenames of the rasters to merge
+        fn_out: str
+            filepath + filename of the merged raster
+        nodata: float
+            pixel value that is ignored in the input rasters
+        compression: str (optional)
+            compression of the merged GeoTIFF ('DEFLATE' or 'ZSTD', see write_tif)
+        masks: list of np.array (optional)
+            for each input raster, array of boolean where True indicates the pixels that are
+            masked, or None to use the raster as it is
+
+    Returns:
+    -----------
+        fn_out: str
+            filepath + filename of the merged raster
+
+    """
+
+    # rasters with masked pixels are copied in memory with these pixels set to nodata
+    sources = []
+    for k, fn in enumerate(fn_list):
+        if masks is None or masks[k] is None:
+            sources.append(gdal.Open(fn))
+            continue
+        data = gdal.Translate('', fn, format='MEM')
+        if data is None:
+            raise RuntimeError('could not read %s' % fn)
+        for i in range(data.RasterCount):
+            band = data.GetRasterBand(i+1)
+            im = band.ReadAsArray()
+            im[masks[k]] = nodata
+            band.WriteArray(im)
+        sources.append(data)
+    # build the mosaic in memory
+    vrt_options = gdal.BuildVRTOptions(resolution='highest', srcNodata=nodata, hideNodata=True)
+    vrt = gdal.BuildVRT('', sources, options=vrt_options)
+    if vrt is None:
+        raise RuntimeError('could not build the mosaic of %s' % ', '.join(fn_list))
+    # write it once in a temporary file next to the output and rename it
+    fd, fn_temp = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.tif', dir=os.path.dirname(fn_out))
+    os.close(fd)
+    try:
+        write_tif(vrt, fn_temp, compression)
+        vrt = None
+        sources = None
+        os.replace(fn_temp, fn_out)
+    except:
+        if os.path.exists(fn_temp):
+            os.remove(fn_temp)
+        raise
+
+    return fn_out
+
+
+def merge_image_pair(fn_im, satname, compression=None):
+    """
+    Masks the artefacts at the edges of 2 overlapping images and merges the second image into
+    the first one. The artefacts are masked in the mosaic (see merge_rasters), the files are
+    only rewritten once, by the merge. The files of the second image (and its metadata .txt
+    file) are then deleted, the 10m band last so that an interrupted merge is done again in the
+    next run.
+
+    Arguments:
+    -----------
+        fn_im: list
+            filepaths + filenames of the 10m, 20m, 60m and metadata files of each of the 2 images
+        satname: str
+            short name of the satellite mission (only S2 at this stage)
+        compression: str (optional)
+            compression of the merged GeoTIFFs ('DEFLATE' or 'ZSTD', see write_tif)
+
+    Returns:
+    -----------
+        fn_merged: list of str
+            filepaths + filenames of the 10m, 20m and 60m files of the merged image
+
+    """
+
+    # masks of the 10m, 20m and 60m files of each image (the QA band is not masked)
+    masks = [[None, None, None] for _ in fn_im]
+    for index in range(len(fn_im)):
+        # read image
+        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single(fn_im[index], satname, False)
+
+        # in Sentinel2 images close to the edge of the image there are some artefacts,
+        # that are squares with constant pixel intensities. They need to be masked in the
+        # merged raster (GEOTIFF). It can be done using the image standard deviation, which
+        # indicates values close to 0 for the artefacts.
+
+        # First mask the 10m bands
+        if len(im_ms) > 0:
+            im_std = SDS_tools.image_std(im_ms[:,:,0],1)
+            im_binary = np.logical_or(im_std < 1e-6, np.isnan(im_std))
+            mask = morphology.dilation(im_binary, morphology.square(3))
+            for k in range(im_ms.shape[2]):
+                im_ms[mask,k] = np.nan
+            masks[index][0] = mask
+
+            # Then mask the 20m band
+            im_std = SDS_tools.image_std(im_extra,1)
+            im_binary = np.logical_or(im_std < 1e-6, np.isnan(im_std))
+            mask = morphology.dilation(im_binary, morphology.square(3))
+            im_extra[mask] = np.nan
+            masks[index][1] = mask
+
+    # merge masked 10m bands, masked 20m band (SWIR band) and QA band (60m band)
+    fn_merged = []
+    for k, nodata in enumerate([0, 0, np.nan]):
+        fn_merged.append(merge_rasters([fn_im[0][k], fn_im[1][k]], fn_im[0][k], nodata,
+                                       compression, [masks[0][k], masks[1][k]]))
+
+    # remove the files of the duplicate image (10m band last)
+    for k in [1, 2, 3, 0]:
+        os.chmod(fn_im[1][k], 0o777)
+        os.remove(fn_im[1][k])
+
+    return fn_merged
+
+
+def find_overlapping_pairs(filenames):
+    """
+    Finds the pairs of overlapping images, which have the same date and time of acquisition
+    (first 22 characters of the filenames). The filenames are grouped in a dictionnary keyed on
+    the time of acquisition, so that each filename is only visited once.
+    Groups of more than 2 images are reported and each of their images is paired with the
+    first image of the group (the one with the shortest filename).
+
+    Arguments:
+    -----------
+        filenames: list of str
+            filenames of the images
+
+    Returns:
+    -----------
+        pairs: list of list
+            indices of each pair of overlapping images, the image that is merged into the other
+            one (longer filename, i.e. '_dup', '_dup2', ...) in second position
+
+    """
+
+    # group the images by time of acquisition
+    groups = dict([])
+    for i,fn in enumerate(filenames):
+        if not fn[:22] in groups.keys():
+            groups[fn[:22]] = []
+        groups[fn[:22]].append(i)
+
+    pairs = []
+    for key in groups.keys():
+        idx_group = groups[key]
+        if len(idx_group) < 2:
+            continue
+        elif len(idx_group) > 2:
+            print('%d overlapping images acquired at %s: %s' % (len(idx_group), key[:19],
+                  ', '.join([filenames[_] for _ in idx_group])))
+        # the image with the shortest filename is kept, the other ones are merged into it
+        idx_first = idx_group[0]
+        for i in idx_group[1:]:
+            if len(filenames[i]) < len(filenames[idx_first]):
+                idx_first = i
+        for i in idx_group:
+            if not i == idx_first:
+                pairs.append([idx_first,i])
+
+    return pairs
+
+
 def merge_overlapping_images(metadata,inputs):
     """
     When the area of interest is located at the boundary between 2 images, there will be overlap 
@@ -752,119 +2276,216 @@ def merge_overlapping_images(metadata,inputs):
     
     # find the images that are overlapping (same date in S2 filenames)
     filenames = metadata[sat]['filenames']
-    filenames_copy = filenames.copy()
-    # loop through all the filenames and find the pairs of overlapping images (same date and time of acquisition)
-    pairs = []
-    for i,fn in enumerate(filenames):
-        filenames_copy[i] = []
-        # find duplicate
-        boolvec = [fn[:22] == _[:22] for _ in filenames_copy]
-        if np.any(boolvec):
-            idx_dup = np.where(boolvec)[0][0]
-            if len(filenames[i]) > len(filenames[idx_dup]): 
-                pairs.append([idx_dup,i])
-            else:
-                pairs.append([i,idx_dup])
-                
-    # for each pair of images, merge them into one complete image
-    for i,pair in enumerate(pairs):
-        
-        fn_im = []
-        for index in range(len(pair)):            
-            # read image
-            fn_im.append([os.path.join(filepath, 'S2', '10m', filenames[pair[index]]),
-                  os.path.join(filepath, 'S2', '20m',  filenames[pair[index]].replace('10m','20m')),
-                  os.path.join(filepath, 'S2', '60m',  filenames[pair[index]].replace('10m','60m')),
-                  os.path.join(filepath, 'S2', 'meta', filenames[pair[index]].replace('_10m','').replace('.tif','.txt'))])
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single(fn_im[index], sat, False) 
-        
-            # in Sentinel2 images close to the edge of the image there are some artefacts, 
-            # that are squares with constant pixel intensities. They need to be masked in the 
-            # raster (GEOTIFF). It can be done using the image standard deviation, which 
-            # indicates values close to 0 for the artefacts.
-            
-            # First mask the 10m bands
-            if len(im_ms) > 0:
-                im_std = SDS_tools.image_std(im_ms[:,:,0],1)
-                im_binary = np.logical_or(im_std < 1e-6, np.isnan(im_std))
-                mask = morphology.dilation(im_binary, morphology.square(3))
-                for k in range(im_ms.shape[2]):
-                    im_ms[mask,k] = np.nan
-                
-                SDS_tools.mask_raster(fn_im[index][0], mask)
+    pairs = find_overlapping_pairs(filenames)
                 
-                # Then mask the 20m band
-                im_std = SDS_tools.image_std(im_extra,1)
-                im_binary = np.logical_or(im_std < 1e-6, np.isnan(im_std))
-                mask = morphology.dilation(im_binary, morphology.square(3))     
-                im_extra[mask] = np.nan
-                
-                SDS_tools.mask_raster(fn_im[index][1], mask) 
-            else:
-                continue
-            
-            # make a figure for quality control
-#            plt.figure()
-#            plt.subplot(221)
-#            plt.imshow(im_ms[:,:,[2,1,0]])
-#            plt.title('imRGB')
-#            plt.subplot(222)
-#            plt.imshow(im20, cmap='gray')
-#            plt.title('im20')
-#            plt.subplot(223)
-#            plt.imshow(imQA, cmap='gray')
-#            plt.title('imQA')
-#            plt.subplot(224)
-#            plt.title(fn_im[index][0][-30:])
-                        
-        # merge masked 10m bands
-        fn_merged = os.path.join(os.getcwd(), 'merged.tif')
-        gdal_merge.main(['', '-o', fn_merged, '-n', '0', fn_im[0][0], fn_im[1][0]])
-        os.chmod(fn_im[0][0], 0o777)
-        os.remove(fn_im[0][0])
-        os.chmod(fn_im[1][0], 0o777)
-        os.remove(fn_im[1][0])
-        os.rename(fn_merged, fn_im[0][0])
+    # load the manifest to record the merged images
+    fn_manifest = os.path.join(filepath, inputs['sitename'] + '_manifest' + '.jsonl')
+    manifest = load_manifest(fn_manifest)
+    fn_index = os.path.join(filepath, inputs['sitename'] + '_metadata' + '.db')
+    im_ids = dict([(manifest[_]['files'][0]['filename'], _) for _ in manifest.keys()
+                   if manifest[_]['satname'] == sat])
+
+    # filepaths of the files of each image of the pairs (10m, 20m, 60m and metadata)
+    def get_files(fn):
+        return [os.path.join(filepath, 'S2', '10m', fn),
+                os.path.join(filepath, 'S2', '20m', fn.replace('10m','20m')),
+                os.path.join(filepath, 'S2', '60m', fn.replace('10m','60m')),
+                os.path.join(filepath, 'S2', 'meta', fn.replace('_10m','').replace('.tif','.txt'))]
+
+    # pairs that share an image (same time of acquisition) are merged one after the other
+    groups = dict([])
+    # indices of the duplicates that are merged (removed from the metadata)
+    idx_dup = []
+    for pair in pairs:
+        # skip the pairs that were already merged in a previous run
+        if not os.path.exists(os.path.join(filepath, 'S2', '10m', filenames[pair[1]])):
+            idx_dup.append(pair[1])
+            continue
+        key = filenames[pair[0]][:22]
+        if not key in groups.keys():
+            groups[key] = []
+        groups[key].append(pair)
         
-        # merge masked 20m band (SWIR band)
-        fn_merged = os.path.join(os.getcwd(), 'merged.tif')
-        gdal_merge.main(['', '-o', fn_merged, '-n', '0', fn_im[0][1], fn_im[1][1]])
-        os.chmod(fn_im[0][1], 0o777)
-        os.remove(fn_im[0][1])
-        os.chmod(fn_im[1][1], 0o777)
-        os.remove(fn_im[1][1])
-        os.rename(fn_merged, fn_im[0][1])
-    
-        # merge QA band (60m band)
-        fn_merged = os.path.join(os.getcwd(), 'merged.tif')
-        gdal_merge.main(['', '-o', fn_merged, '-n', 'nan', fn_im[0][2], fn_im[1][2]])
-        os.chmod(fn_im[0][2], 0o777)
-        os.remove(fn_im[0][2])
-        os.chmod(fn_im[1][2], 0o777)
-        os.remove(fn_im[1][2])
-        os.rename(fn_merged, fn_im[0][2])
+    def merge_group(pairs_group):
+        errors = []
+        for pair in pairs_group:
+            try:
+                merge_image_pair([get_files(filenames[_]) for _ in pair], sat, compression)
+                errors.append(None)
+            except Exception as error:
+                errors.append(error)
+        return errors
         
-        # remove the metadata .txt file of the duplicate image
-        os.chmod(fn_im[1][3], 0o777)
-        os.remove(fn_im[1][3])
-          
-    print('%d pairs of overlapping Sentinel-2 images were merged' % len(pairs))
+    # for each pair of images, merge them into one complete image (pairs merged concurrently)
+    if 'n_workers' in inputs.keys():
+        n_workers = inputs['n_workers']
+    else:
+        n_workers = 1
+    if 'compression' in inputs.keys():
+        compression = inputs['compression']
+    else:
+        compression = None
+    n_merged = 0
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = dict([(executor.submit(merge_group, groups[key]), key) for key in groups.keys()])
+        for future in as_completed(futures):
+            pairs_group = groups[futures[future]]
+            for pair, error in zip(pairs_group, future.result()):
+                if error is not None:
+                    print('Could not merge %s and %s: %s' % (filenames[pair[0]],
+                                                             filenames[pair[1]], error))
+                    continue
+                # update the manifest (new files of the merged image and duplicate flagged as merged)
+                if filenames[pair[0]] in im_ids.keys() and filenames[pair[1]] in im_ids.keys():
+                    record = manifest[im_ids[filenames[pair[0]]]]
+                    record['files'] = [get_file_info(_, fn_manifest)
+                                       for _ in get_files(filenames[pair[0]])[:3]]
+                    update_manifest(fn_manifest, record)
+                    record = manifest[im_ids[filenames[pair[1]]]]
+                    record['status'] = 'merged'
+                    update_manifest(fn_manifest, record)
+                # remove the duplicate image from the metadata index
+                remove_from_metadata_index(fn_index, sat, [filenames[pair[1]]])
+                idx_dup.append(pair[1])
+                n_merged = n_merged + 1
+
+    print('%d pairs of overlapping Sentinel-2 images were merged' % n_merged)
     
-    # update the metadata dict (delete all the duplicates)
+    # update the metadata dict (delete the duplicates that were merged, the images of the pairs
+    # that could not be merged are kept as in the metadata index)
     metadata_updated = copy.deepcopy(metadata)
-    filenames_copy = metadata_updated[sat]['filenames']
-    index_list = []
-    for i in range(len(filenames_copy)):
-            if filenames_copy[i].find('dup') == -1:
-                index_list.append(i)
+    index_list = [_ for _ in range(len(filenames)) if not _ in idx_dup]
     for key in metadata_updated[sat].keys():
         metadata_updated[sat][key] = [metadata_updated[sat][key][_] for _ in index_list]
         
     return metadata_updated 
 
+def update_metadata_index(fn_index, metadata):
+    """
+    Adds images to the metadata index of a site (SQLite database with one row per image). The
+    images already in the index are replaced.
+
+    Arguments:
+    -----------
+        fn_index: str
+            filepath + filename of the metadata index
+        metadata: dict
+            metadata of the images to add (same format as the output of retrieve_images)
+
+    Returns:
+    -----------
+
+    """
+
+    rows = []
+    for satname in metadata.keys():
+        for k in range(len(metadata[satname]['filenames'])):
+            rows.append((metadata[satname]['filenames'][k], satname,
+                         metadata[satname]['dates'][k].strftime('%Y-%m-%d %H:%M:%S'),
+                         float(metadata[satname]['acc_georef'][k]),
+                         int(metadata[satname]['epsg'][k])))
+    conn = sqlite3.connect(fn_index)
+    try:
+        # all the images are added in a single transaction
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS images (filename TEXT PRIMARY KEY, '
+                         'satname TEXT, date TEXT, acc_georef REAL, epsg INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS images_satname_date ON images (satname, date)')
+            conn.executemany('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?)', rows)
+    finally:
+        conn.close()
+
+
+def remove_from_metadata_index(fn_index, satname, filenames):
+    """
+    Removes images from the metadata index of a site.
+
+    Arguments:
+    -----------
+        fn_index: str
+            filepath + filename of the metadata index
+        satname: str
+            short name of the satellite mission
+        filenames: list of str
+            filenames of the images to remove
+
+    Returns:
+    -----------
+
+    """
+
+    if not os.path.exists(fn_index):
+        return
+    conn = sqlite3.connect(fn_index)
+    try:
+        with conn:
+            conn.executemany('DELETE FROM images WHERE satname = ? AND filename = ?',
+                             [(satname, _) for _ in filenames])
+    finally:
+        conn.close()
+
+
+def load_metadata_index(fn_index, sat_list=None, dates=None):
+    """
+    Loads the metadata of the images in the metadata index of a site, optionally only for some
+    satellite missions and/or a range of dates (the other images are not read).
+
+    Arguments:
+    -----------
+        fn_index: str
+            filepath + filename of the metadata index
+        sat_list: list of str (optional)
+            satellite missions to load, e.g. ['L8', 'S2'] (default is all the missions)
+        dates: list of str (optional)
+            initial and final dates in format 'yyyy-mm-dd' (final date excluded), e.g.
+            ['2017-12-01', '2018-01-01'] (default is all the dates)
+
+    Returns:
+    -----------
+        metadata: dict
+            contains the information about the satellite images: filename, georeferencing
+            accuracy, image coordinate reference system and date, sorted chronologically
+
+    """
+
+    if sat_list is None:
+        sat_list = list(SATELLITES.keys())
+    query = 'SELECT satname, filename, acc_georef, epsg, date FROM images WHERE satname IN (%s)' \
+            % ','.join(['?']*len(sat_list))
+    params = list(sat_list)
+    if dates is not None:
+        query = query + ' AND date >= ? AND date < ?'
+        params = params + [dates[0], dates[1]]
+    query = query + ' ORDER BY date, filename'
+    conn = sqlite3.connect(fn_index)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    # initialize metadata dict (missions in the usual order)
+    metadata = dict([])
+    for satname in SATELLITES.keys():
+        if satname in [_[0] for _ in rows]:
+            metadata[satname] = {'filenames':[], 'acc_georef':[], 'epsg':[], 'dates':[]}
+    for satname, filename, acc_georef, epsg, date in rows:
+        metadata[satname]['filenames'].append(filename)
+        metadata[satname]['acc_georef'].append(acc_georef)
+        metadata[satname]['epsg'].append(epsg)
+        # dates to the second, as in the filenames and the .txt files (the indexes created by
+        # the previous versions also stored the microseconds)
+        metadata[satname]['dates'].append(pytz.utc.localize(datetime.strptime(date[:19],
+                                                                              '%Y-%m-%d %H:%M:%S')))
+
+    return metadata
+
+
 def get_metadata(inputs):
     """
-    Gets the metadata from the downloaded .txt files in the \meta folders. 
+    Gets the metadata of the downloaded images from the metadata index of the site
+    (sitename_metadata.db). If the site has no metadata index yet (images downloaded with a
+    previous version), the metadata is read from the .txt files in the \meta folders and the
+    index is created.
     
     KV WRL 2018
         
@@ -886,6 +2507,40 @@ def get_metadata(inputs):
     """
     # directory containing the images
     filepath = os.path.join(inputs['filepath'],inputs['sitename'])
+    fn_index = os.path.join(filepath, inputs['sitename'] + '_metadata' + '.db')
+    if os.path.exists(fn_index):
+        # load the metadata index in one query
+        metadata = load_metadata_index(fn_index)
+    else:
+        # read the .txt files and create the metadata index
+        metadata = get_metadata_txt(filepath)
+        update_metadata_index(fn_index, metadata)
+
+    # save a .pkl file containing the metadata dict
+    with open(os.path.join(filepath, inputs['sitename'] + '_metadata' + '.pkl'), 'wb') as f:
+        pickle.dump(metadata, f)
+
+    return metadata
+
+
+def get_metadata_txt(filepath):
+    """
+    Gets the metadata from the downloaded .txt files in the \meta folders.
+
+    KV WRL 2018
+
+    Arguments:
+    -----------
+        filepath: str
+            directory of the site
+
+    Returns:
+    -----------
+        metadata: dict
+            contains the information about the satellite images that were downloaded: filename,
+            georeferencing accuracy and image coordinate reference system
+
+    """
     # initialize metadata dict
     metadata = dict([])
     # loop through the satellite missions
@@ -917,9 +2572,5 @@ def get_metadata(inputs):
                 metadata[satname]['epsg'].append(epsg)
                 metadata[satname]['dates'].append(date)
                 
-    # save a .pkl file containing the metadata dict
-    with open(os.path.join(filepath, inputs['sitename'] + '_metadata' + '.pkl'), 'wb') as f:
-        pickle.dump(metadata, f)
-    
     return metadata
                  
\ No newline at end of file
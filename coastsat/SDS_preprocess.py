@@ -14,13 +14,15 @@ import pdb
 # image processing modules
 import skimage.transform as transform
 import skimage.morphology as morphology
-import sklearn.decomposition as decomposition
 import skimage.exposure as exposure
 
 # other modules
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 from pylab import ginput
 import pickle
+import hashlib
+import tempfile
+import time
 import geopandas as gpd
 from shapely import geometry
 
@@ -29,9 +31,132 @@ from coastsat import SDS_tools
 
 np.seterr(all='ignore') # raise/ignore divisions by 0 and nans
 
+# values of the QA band corresponding to cloudy pixels (the bits allocated to cloud cover vary
+# depending on the satellite mission), for S2 1024 = dense cloud, 2048 = cirrus clouds
+CLOUD_VALUES = {'L4':[752, 756, 760, 764], 'L5':[752, 756, 760, 764], 'L7':[752, 756, 760, 764],
+                'L8':[2800, 2804, 2808, 2812, 6896, 6900, 6904, 6908], 'S2':[1024, 2048]}
+
+# bits of the QA band decoded into the other layers of the QA mask (see decode_QA), as
+# [first bit, number of bits, minimum value]: fill = designated fill, shadow = high confidence
+# cloud shadow and cirrus = high confidence cirrus for Landsat (collection 1 BQA band), cirrus
+# = cirrus bit for S2 (QA60 band). The cloud layer is given by CLOUD_VALUES.
+QA_BITS = {'L4':{'fill':[0, 1, 1], 'shadow':[7, 2, 3]},
+           'L5':{'fill':[0, 1, 1], 'shadow':[7, 2, 3]},
+           'L7':{'fill':[0, 1, 1], 'shadow':[7, 2, 3]},
+           'L8':{'fill':[0, 1, 1], 'shadow':[7, 2, 3], 'cirrus':[11, 2, 3]},
+           'S2':{'cirrus':[11, 1, 1]}}
+# flag of each layer in the lookup tables of the QA values (see get_QA_table)
+QA_FLAGS = {'cloud':1, 'cirrus':2, 'shadow':4, 'fill':8}
+# lookup tables of the QA values of each mission, computed when first used
+QA_TABLES = dict([])
+
+# default data type of the bands of the preprocessed images (np.float64 gives the same results
+# as older versions, np.float32 halves the memory but its shorelines have not been validated on
+# a downloaded site yet, see benchmarks/benchmark_dtype.py)
+DTYPE = np.float64
+
+# default number of bins of the histogram matching in the pansharpening (see hist_match), None
+# for the exact matching
+HIST_BINS = None
+
+# pansharpening methods of the Landsat 7 and 8 images (see pansharpen), 'none' keeps the
+# bands upsampled with a bilinear interpolation, and default method
+PANSHARPEN_METHODS = ['pca', 'brovey', 'ihs', 'none']
+PANSHARPEN_METHOD = 'pca'
+# default number of rows of the blocks of the pansharpening (None to pansharpen the whole image
+# at once) and number of bins of the histogram matching by blocks (see pansharpen_blocks)
+PANSHARPEN_BLOCK_SIZE = None
+BLOCK_HIST_BINS = 4096
+
+# default size (in bytes) of the cache of preprocessed images (see load_preprocessed), the least
+# recently used images are removed above this size
+CACHE_SIZE = 2*2**30
+# when the cache is too large, the least recently used images are removed until it is below
+# this fraction of its maximum size (so that the cache directory is not scanned at every write)
+CACHE_CLEAN_FRACTION = 0.9
+# estimated size (in bytes) of each cache directory, updated after each write of this process,
+# and time of the last scan of the directory (see clean_cache)
+CACHE_USAGE = dict([])
+# maximum time (in seconds) between two scans of a cache directory, so that the files written by
+# other processes sharing the cache are taken into account
+CACHE_RESCAN_INTERVAL = 60
+# version of the preprocessing, included in the keys of the cache so that the images cached by
+# an older version are not used
+CACHE_VERSION = 1
+
+def get_QA_table(satname):
+    """
+    Returns the lookup table of the flags (QA_FLAGS) of all the 16-bit values of the QA band of
+    a satellite mission: cloud if the value is in CLOUD_VALUES, cirrus, shadow and fill decoded
+    from the bits in QA_BITS. The table is computed once per mission.
+
+    Arguments:
+    -----------
+        satname: string
+            short name for the satellite (L5, L7, L8 or S2)
+
+    Returns:
+    -----------
+        table: np.array
+            array of 65536 uint8 with the flags of each QA value
+
+    """
+
+    if not satname in QA_TABLES.keys():
+        values = np.arange(2**16)
+        table = np.zeros(2**16, dtype=np.uint8)
+        table[np.isin(values, CLOUD_VALUES[satname])] |= QA_FLAGS['cloud']
+        for layer in QA_BITS[satname].keys():
+            first_bit, n_bits, min_value = QA_BITS[satname][layer]
+            layer_values = (values >> first_bit) & (2**n_bits - 1)
+            table[layer_values >= min_value] |= QA_FLAGS[layer]
+        QA_TABLES[satname] = table
+
+    return QA_TABLES[satname]
+
+def decode_QA(im_QA, satname, layers=None):
+    """
+    Decodes the QA band into boolean layers (cloud, cirrus, shadow and fill) with a single
+    indexing of the lookup table of the mission (see get_QA_table). The pixels with a value
+    that is not a 16-bit integer (e.g. NaN) are False in all the layers.
+
+    Arguments:
+    -----------
+        im_QA: np.array
+            Image containing the QA band
+        satname: string
+            short name for the satellite (L5, L7, L8 or S2)
+        layers: list of str (optional)
+            layers to return (keys of QA_FLAGS), all the layers if None
+
+    Returns:
+    -----------
+        QA_layers: dict
+            boolean array of each layer, True where the flag is set
+
+    """
+
+    table = get_QA_table(satname)
+    # the QA band is read with the data type of the other bands (usually float), the values
+    # that are changed by the conversion to uint16 are not valid QA values
+    if im_QA.dtype == np.uint16 or im_QA.dtype == np.uint8:
+        flags = table[im_QA]
+    else:
+        im_QA_int = im_QA.astype(np.uint16)
+        flags = table[im_QA_int]*(im_QA_int == im_QA)
+    if layers is None:
+        layers = list(QA_FLAGS.keys())
+    QA_layers = dict([])
+    for layer in layers:
+        QA_layers[layer] = (flags & QA_FLAGS[layer]) > 0
+
+    return QA_layers
+
 def create_cloud_mask(im_QA, satname, cloud_mask_issue):
     """
     Creates a cloud mask using the information contained in the QA band.
+    The cloud pixels are the ones with a value in CLOUD_VALUES, found with the lookup table of
+    the QA values (see decode_QA).
 
     KV WRL 2018
 
@@ -50,20 +175,13 @@ def create_cloud_mask(im_QA, satname, cloud_mask_issue):
             A boolean array with True if a pixel is cloudy and False otherwise
     """
 
-    # convert QA bits (the bits allocated to cloud cover vary depending on the satellite mission)
-    if satname == 'L8':
-        cloud_values = [2800, 2804, 2808, 2812, 6896, 6900, 6904, 6908]
-    elif satname == 'L7' or satname == 'L5' or satname == 'L4':
-        cloud_values = [752, 756, 760, 764]
-    elif satname == 'S2':
-        cloud_values = [1024, 2048] # 1024 = dense cloud, 2048 = cirrus clouds
-
-    # find which pixels have bits corresponding to cloud values
-    cloud_mask = np.isin(im_QA, cloud_values)
+    # find which pixels have bits corresponding to cloud values (the bits allocated to cloud
+    # cover vary depending on the satellite mission)
+    cloud_mask = decode_QA(im_QA, satname, ['cloud'])['cloud']
 
     # remove cloud pixels that form very thin features. These are beach or swash pixels that are
     # erroneously identified as clouds by the CFMASK algorithm applied to the images by the USGS.
-    if sum(sum(cloud_mask)) > 0 and sum(sum(~cloud_mask)) > 0:
+    if np.any(cloud_mask) and not np.all(cloud_mask):
         morphology.remove_small_objects(cloud_mask, min_size=10, connectivity=1, in_place=True)
 
         if cloud_mask_issue:
@@ -74,10 +192,18 @@ def create_cloud_mask(im_QA, satname, cloud_mask_issue):
 
     return cloud_mask
 
-def hist_match(source, template):
+def hist_match(source, template, n_bins=None):
     """
     Adjust the pixel values of a grayscale image such that its histogram matches that of a
     target image.
+    By default the match is exact (cumulative distributions computed on the unique values of the
+    images, i.e. a full sort of both images). With n_bins, the cumulative distributions are
+    computed on histograms of n_bins equal bins (linear time, no large index arrays) and
+    interpolated linearly within the bins. The quantile of each pixel is then off by at most the
+    fraction of the source pixels in its bin, and the value of the template at a quantile by at
+    most one template bin ((max - min)/n_bins of the template): the error on each matched value
+    is at most one template bin plus the range of template values spanned by the fraction of
+    source pixels in the most populated bin.
 
     Arguments:
     -----------
@@ -86,6 +212,8 @@ def hist_match(source, template):
             array
         template: np.array
             Template image; can have different dimensions to source
+        n_bins: int (optional)
+            number of bins of the approximate histogram matching, None for the exact matching
     Returns:
     -----------
         matched: np.array
@@ -96,6 +224,27 @@ def hist_match(source, template):
     source = source.ravel()
     template = template.ravel()
 
+    if n_bins is not None:
+        # a constant image is matched to the maximum of the template (as in the exact matching)
+        s_min = np.min(source)
+        s_max = np.max(source)
+        if s_min == s_max:
+            return np.full(oldshape, np.max(template))
+        # bin of each pixel of the source (the bins are equal so the bin is found directly, the
+        # maximum goes in the last bin) and histograms of both images
+        position = (source - s_min)*(n_bins/(s_max - s_min))
+        idx = np.minimum(position.astype(np.intp), n_bins - 1)
+        s_counts = np.bincount(idx, minlength=n_bins)
+        t_counts, t_edges = np.histogram(template, bins=n_bins)
+        # cumulative distributions at the edges of the bins of each image
+        s_quantiles = np.append(0, np.cumsum(s_counts))/len(source)
+        t_quantiles = np.append(0, np.cumsum(t_counts))/len(template)
+        # template value of the quantile of each source edge, interpolated linearly between the
+        # edges of the bin of each pixel
+        edge_t_values = np.interp(s_quantiles, t_quantiles, t_edges)
+        slope = np.diff(edge_t_values)
+        return (edge_t_values[idx] + slope[idx]*(position - idx)).reshape(oldshape)
+
     # get the set of unique pixel values and their corresponding indices and
     # counts
     s_values, bin_idx, s_counts = np.unique(source, return_inverse=True,
@@ -116,12 +265,17 @@ def hist_match(source, template):
 
     return interp_t_values[bin_idx].reshape(oldshape)
 
-def pansharpen(im_ms, im_pan, cloud_mask):
+def pansharpen(im_ms, im_pan, cloud_mask, hist_bins=None, method='pca', block_size=None,
+               out=None):
     """
     Pansharpens a multispectral image, using the panchromatic band and a cloud mask.
-    A PCA is applied to the image, then the 1st PC is replaced with the panchromatic band.
-    Note that it is essential to match the histrograms of the 1st PC and the panchromatic band
-    before replacing and inverting the PCA.
+    The cloud pixels are removed from the bands and from the panchromatic band, the cloud-free
+    pixels are pansharpened with the selected method (see pansharpen_pca, pansharpen_brovey and
+    pansharpen_ihs) and the cloud pixels are set to NaN in the output. With method 'none' the
+    bands are not pansharpened (only the cloud mask is applied).
+    With block_size, the image is pansharpened by blocks of rows (see pansharpen_blocks) to limit
+    the memory used on large images. The histogram matching is then always approximate
+    (BLOCK_HIST_BINS bins if hist_bins is None).
 
     KV WRL 2018
 
@@ -133,6 +287,16 @@ def pansharpen(im_ms, im_pan, cloud_mask):
             Panchromatic band (2D)
         cloud_mask: np.array
             2D cloud mask with True where cloud pixels are
+        hist_bins: int (optional)
+            number of bins of the histogram matching (see hist_match), None for the exact
+            matching
+        method: str (optional)
+            pansharpening method, one of PANSHARPEN_METHODS ('pca', 'brovey', 'ihs' or 'none')
+        block_size: int (optional)
+            number of rows of the blocks, None to pansharpen the whole image at once
+        out: np.array (optional)
+            array (or view of an array) with the same shape as im_ms where the pansharpened
+            image is written, a new array is created if None
 
     Returns:
     -----------
@@ -140,27 +304,323 @@ def pansharpen(im_ms, im_pan, cloud_mask):
             Pansharpened multispectral image (3D)
     """
 
+    if not method in PANSHARPEN_METHODS:
+        raise ValueError('unknown pansharpening method %s, use one of %s' %
+                         (method, ', '.join(PANSHARPEN_METHODS)))
+    if block_size is not None:
+        return pansharpen_blocks(im_ms, im_pan, cloud_mask, hist_bins, method, block_size, out)
+
     # reshape image into vector and apply cloud mask
     vec = im_ms.reshape(im_ms.shape[0] * im_ms.shape[1], im_ms.shape[2])
     vec_mask = cloud_mask.reshape(im_ms.shape[0] * im_ms.shape[1])
     vec = vec[~vec_mask, :]
-    # apply PCA to multispectral bands
-    pca = decomposition.PCA()
-    vec_pcs = pca.fit_transform(vec)
-
-    # replace 1st PC with pan band (after matching histograms)
+    if vec.shape[0] < 2:
+        raise ValueError('not enough cloud-free pixels to pansharpen the image')
     vec_pan = im_pan.reshape(im_pan.shape[0] * im_pan.shape[1])
     vec_pan = vec_pan[~vec_mask]
-    vec_pcs[:,0] = hist_match(vec_pan, vec_pcs[:,0])
-    vec_ms_ps = pca.inverse_transform(vec_pcs)
 
-    # reshape vector into image
-    vec_ms_ps_full = np.ones((len(vec_mask), im_ms.shape[2])) * np.nan
-    vec_ms_ps_full[~vec_mask,:] = vec_ms_ps
-    im_ms_ps = vec_ms_ps_full.reshape(im_ms.shape[0], im_ms.shape[1], im_ms.shape[2])
+    # pansharpen the cloud-free pixels
+    if method == 'pca':
+        vec = pansharpen_pca(vec, vec_pan, hist_bins)
+    elif method == 'brovey':
+        vec = pansharpen_brovey(vec, vec_pan, hist_bins)
+    elif method == 'ihs':
+        vec = pansharpen_ihs(vec, vec_pan, hist_bins)
+
+    # write the pansharpened pixels in the output image (NaN for the cloud pixels)
+    if out is None:
+        out = np.empty(im_ms.shape, dtype=im_ms.dtype)
+    im_ms_ps = out
+    im_ms_ps[cloud_mask] = np.nan
+    im_ms_ps[~cloud_mask] = vec
+
+    return im_ms_ps
+
+def pansharpen_pca(vec, vec_pan, hist_bins=None):
+    """
+    PCA pansharpening of the cloud-free pixels of a multispectral image: a PCA is applied to the
+    bands, then the 1st PC is replaced with the panchromatic band.
+    Note that it is essential to match the histrograms of the 1st PC and the panchromatic band
+    before replacing and inverting the PCA.
+    The PCA is computed in closed form: the covariance matrix of the bands (3x3 or 4x4) is
+    eigen-decomposed directly. As all the components are kept, inverting the PCA after replacing
+    the 1st PC only adds (new PC1 - PC1) times the 1st component to the bands, so the other
+    components are never computed. The sign of the 1st component is chosen so that the 1st PC
+    is positively correlated with the panchromatic band (otherwise the brightness of the image
+    would be inverted). The result is the same as with sklearn.decomposition.PCA when sklearn
+    gives the 1st component this sign (its sign convention depends on the version).
+
+    Arguments:
+    -----------
+        vec: np.array
+            2D array (pixels x bands) of the cloud-free pixels, modified in place
+        vec_pan: np.array
+            1D array with the panchromatic band of the same pixels
+        hist_bins: int (optional)
+            number of bins of the histogram matching (see hist_match)
+
+    Returns:
+    -----------
+        vec: np.array
+            pansharpened pixels (pixels x bands)
+    """
+
+    # covariance matrix of the bands and 1st principal component (largest eigenvalue)
+    vec_mean = np.mean(vec, axis=0, dtype=np.float64)
+    vec_centered = vec - vec_mean.astype(vec.dtype)
+    covariance = np.dot(vec_centered.T, vec_centered)/(vec.shape[0] - 1)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    component = eigenvectors[:,-1].astype(vec.dtype)
+    vec_pc1 = np.dot(vec_centered, component)
+    del vec_centered
+    # sign of the component chosen so that the 1st PC is positively correlated with the pan band
+    if np.dot(vec_pc1, vec_pan - np.mean(vec_pan, dtype=np.float64)) < 0:
+        component = -component
+        vec_pc1 = -vec_pc1
+
+    # replace 1st PC with pan band (after matching histograms) and invert the PCA
+    vec_diff = (hist_match(vec_pan, vec_pc1, hist_bins) - vec_pc1).astype(vec.dtype)
+    vec += np.outer(vec_diff, component)
+
+    return vec
+
+def pansharpen_brovey(vec, vec_pan, hist_bins=None):
+    """
+    Brovey pansharpening of the cloud-free pixels of a multispectral image: each band is
+    multiplied by the ratio of the panchromatic band to the intensity (mean of the bands).
+    The histogram of the panchromatic band is first matched to the one of the intensity so that
+    the reflectances keep the same range. Pixels with a null intensity are not modified.
+
+    Arguments:
+    -----------
+        vec: np.array
+            2D array (pixels x bands) of the cloud-free pixels, modified in place
+        vec_pan: np.array
+            1D array with the panchromatic band of the same pixels
+        hist_bins: int (optional)
+            number of bins of the histogram matching (see hist_match)
+
+    Returns:
+    -----------
+        vec: np.array
+            pansharpened pixels (pixels x bands)
+    """
+
+    intensity = np.mean(vec, axis=1)
+    vec_pan = hist_match(vec_pan, intensity, hist_bins).astype(vec.dtype)
+    ratio = np.ones(len(intensity), dtype=vec.dtype)
+    np.divide(vec_pan, intensity, out=ratio, where=intensity != 0)
+    vec *= ratio[:,np.newaxis]
+
+    return vec
+
+def pansharpen_ihs(vec, vec_pan, hist_bins=None):
+    """
+    IHS (additive) pansharpening of the cloud-free pixels of a multispectral image: the
+    difference between the panchromatic band and the intensity (mean of the bands) is added to
+    each band (fast IHS transform). The histogram of the panchromatic band is first matched to the
+    one of the intensity.
+
+    Arguments:
+    -----------
+        vec: np.array
+            2D array (pixels x bands) of the cloud-free pixels, modified in place
+        vec_pan: np.array
+            1D array with the panchromatic band of the same pixels
+        hist_bins: int (optional)
+            number of bins of the histogram matching (see hist_match)
+
+    Returns:
+    -----------
+        vec: np.array
+            pansharpened pixels (pixels x bands)
+    """
+
+    intensity = np.mean(vec, axis=1)
+    vec_diff = (hist_match(vec_pan, intensity, hist_bins) - intensity).astype(vec.dtype)
+    vec += vec_diff[:,np.newaxis]
+
+    return vec
+
+
+def pansharpen_blocks(im_ms, im_pan, cloud_mask, hist_bins=None, method='pca', block_size=1000,
+                      out=None):
+    """
+    Pansharpens a multispectral image by blocks of rows, so that only the output image and a few
+    copies of one block are in memory (instead of several copies of the whole image).
+    The statistics of the cloud-free pixels are computed in a first pass over the blocks: the
+    mean and covariance matrix of the bands (method 'pca', covariance computed around the mean
+    in a second pass as with pansharpen_pca), the range of the panchromatic band and of the
+    band that it replaces (1st PC or intensity), and their histograms. The blocks are then
+    transformed with the same formulas as pansharpen_pca, pansharpen_brovey and pansharpen_ihs
+    and written into the output (preallocated or given). The histogram matching uses hist_match with
+    n_bins (BLOCK_HIST_BINS if hist_bins is None, the exact matching needs the whole image): the
+    result is the same as pansharpen with the same hist_bins, up to rounding errors.
+
+    Arguments:
+    -----------
+        im_ms: np.array
+            Multispectral image to pansharpen (3D)
+        im_pan: np.array
+            Panchromatic band (2D)
+        cloud_mask: np.array
+            2D cloud mask with True where cloud pixels are
+        hist_bins: int (optional)
+            number of bins of the histogram matching (default is BLOCK_HIST_BINS)
+        method: str (optional)
+            pansharpening method, one of PANSHARPEN_METHODS
+        block_size: int (optional)
+            number of rows of the blocks
+        out: np.array (optional)
+            array (or view of an array) with the same shape as im_ms where the pansharpened
+            image is written, a new array is created if None. Each block is read before it is
+            written, so out can also be im_ms itself
+
+    Returns:
+    -----------
+        im_ms_ps: np.ndarray
+            Pansharpened multispectral image (3D)
+    """
+
+    if hist_bins is None:
+        hist_bins = BLOCK_HIST_BINS
+    n_bands = im_ms.shape[2]
+    blocks = [slice(row, row + block_size) for row in range(0, im_ms.shape[0], block_size)]
+
+    # number of cloud-free pixels, mean of the bands and range of the pan band
+    n_pixels = 0
+    vec_sum = np.zeros(n_bands)
+    pan_sum = 0
+    pan_min = np.inf
+    pan_max = -np.inf
+    for block in blocks:
+        vec, vec_pan = get_block_pixels(im_ms, im_pan, cloud_mask, block)
+        if len(vec) == 0:
+            continue
+        n_pixels = n_pixels + len(vec)
+        vec_sum += np.sum(vec, axis=0, dtype=np.float64)
+        pan_sum = pan_sum + np.sum(vec_pan, dtype=np.float64)
+        pan_min = min(pan_min, np.min(vec_pan))
+        pan_max = max(pan_max, np.max(vec_pan))
+    if n_pixels < 2:
+        raise ValueError('not enough cloud-free pixels to pansharpen the image')
+
+    # statistics of the pansharpening (no pansharpening with method 'none')
+    if method != 'none':
+
+        # band replaced by the pan band: 1st PC for the PCA, intensity (mean of the bands) for
+        # the other methods
+        if method == 'pca':
+            vec_mean = vec_sum/n_pixels
+            covariance = np.zeros((n_bands, n_bands))
+            for block in blocks:
+                vec_centered = get_block_pixels(im_ms, im_pan, cloud_mask, block)[0] - vec_mean
+                covariance += np.dot(vec_centered.T, vec_centered)
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance/(n_pixels - 1))
+            component = eigenvectors[:,-1]
+        else:
+            vec_mean = np.zeros(n_bands)
+            component = np.ones(n_bands)/n_bands
+        vec_mean = vec_mean.astype(im_ms.dtype)
+        component = component.astype(im_ms.dtype)
+
+        # range of the replaced band and histogram of the pan band
+        pc_min = np.inf
+        pc_max = -np.inf
+        pc_pan_covariance = 0
+        pan_counts = np.zeros(hist_bins, dtype=np.int64)
+        for block in blocks:
+            vec, vec_pan = get_block_pixels(im_ms, im_pan, cloud_mask, block)
+            if len(vec) == 0:
+                continue
+            vec_pc = np.dot(vec - vec_mean, component)
+            pc_min = min(pc_min, np.min(vec_pc))
+            pc_max = max(pc_max, np.max(vec_pc))
+            pc_pan_covariance = pc_pan_covariance + np.dot(vec_pc, vec_pan - pan_sum/n_pixels)
+            if pan_max > pan_min:
+                position = (vec_pan - pan_min)*(hist_bins/(pan_max - pan_min))
+                pan_counts += np.bincount(np.minimum(position.astype(np.intp), hist_bins - 1),
+                                          minlength=hist_bins)
+        # sign of the 1st component chosen so that the 1st PC is positively correlated with the
+        # pan band (as in pansharpen_pca)
+        if method == 'pca' and pc_pan_covariance < 0:
+            component = -component
+            pc_min, pc_max = -pc_max, -pc_min
+
+        # histogram of the replaced band and values of the replaced band at the edges of the
+        # bins of the pan band (see hist_match)
+        pc_counts = np.zeros(hist_bins, dtype=np.int64)
+        for block in blocks:
+            vec_pc = np.dot(get_block_pixels(im_ms, im_pan, cloud_mask, block)[0] - vec_mean,
+                            component)
+            block_counts, pc_edges = np.histogram(vec_pc, bins=hist_bins, range=(pc_min, pc_max))
+            pc_counts += block_counts
+        pan_quantiles = np.append(0, np.cumsum(pan_counts))/n_pixels
+        pc_quantiles = np.append(0, np.cumsum(pc_counts))/n_pixels
+        if pan_max > pan_min:
+            edge_pc_values = np.interp(pan_quantiles, pc_quantiles, pc_edges)
+        else: # a constant pan band is matched to the maximum (as in hist_match)
+            pan_max = pan_min + 1
+            edge_pc_values = np.full(hist_bins + 1, pc_max)
+        slope = np.diff(edge_pc_values)
+
+    # pansharpen each block and write it in the output (NaN for the cloud pixels)
+    if out is None:
+        out = np.empty(im_ms.shape, dtype=im_ms.dtype)
+    im_ms_ps = out
+    for block in blocks:
+        vec, vec_pan = get_block_pixels(im_ms, im_pan, cloud_mask, block)
+        block_mask = cloud_mask[block]
+        im_ms_ps[block][block_mask] = np.nan
+        if len(vec) == 0:
+            continue
+        if method != 'none':
+            # histogram matching of the pan band to the replaced band
+            position = (vec_pan - pan_min)*(hist_bins/(pan_max - pan_min))
+            idx = np.minimum(position.astype(np.intp), hist_bins - 1)
+            vec_pan = (edge_pc_values[idx] + slope[idx]*(position - idx)).astype(vec.dtype)
+            vec_pc = np.dot(vec - vec_mean, component)
+        if method == 'pca':
+            vec += np.outer(vec_pan - vec_pc, component)
+        elif method == 'brovey':
+            ratio = np.ones(len(vec_pc), dtype=vec.dtype)
+            np.divide(vec_pan, vec_pc, out=ratio, where=vec_pc != 0)
+            vec *= ratio[:,np.newaxis]
+        elif method == 'ihs':
+            vec += (vec_pan - vec_pc)[:,np.newaxis]
+        im_ms_ps[block][~block_mask] = vec
 
     return im_ms_ps
 
+def get_block_pixels(im_ms, im_pan, cloud_mask, block):
+    """
+    Returns the cloud-free pixels of a block of rows of a multispectral image and of the
+    panchromatic band (see pansharpen_blocks).
+
+    Arguments:
+    -----------
+        im_ms: np.array
+            Multispectral image (3D)
+        im_pan: np.array
+            Panchromatic band (2D)
+        cloud_mask: np.array
+            2D cloud mask with True where cloud pixels are
+        block: slice
+            rows of the block
+
+    Returns:
+    -----------
+        vec: np.array
+            2D array (pixels x bands) with the cloud-free pixels of the block (copy)
+        vec_pan: np.array
+            1D array with the panchromatic band of the same pixels
+    """
+
+    block_mask = cloud_mask[block]
+    vec = im_ms[block][~block_mask]
+    vec_pan = im_pan[block][~block_mask]
+
+    return vec, vec_pan
 
 def rescale_image_intensity(im, cloud_mask, prob_high):
     """
@@ -196,7 +656,7 @@ def rescale_image_intensity(im, cloud_mask, prob_high):
         # reshape into a vector
         vec =  im.reshape(im.shape[0] * im.shape[1], im.shape[2])
         # initiliase with NaN values
-        vec_adj = np.ones((len(vec_mask), im.shape[2])) * np.nan
+        vec_adj = np.full((len(vec_mask), im.shape[2]), np.nan, dtype=im.dtype)
         # loop through the bands
         for i in range(im.shape[2]):
             # find the higher percentile (based on prob)
@@ -211,7 +671,7 @@ def rescale_image_intensity(im, cloud_mask, prob_high):
     # if image only has 1 bands (grayscale image)
     else:
         vec =  im.reshape(im.shape[0] * im.shape[1])
-        vec_adj = np.ones(len(vec_mask)) * np.nan
+        vec_adj = np.full(len(vec_mask), np.nan, dtype=im.dtype)
         prc_high = np.percentile(vec[~vec_mask], prob_high)
         vec_rescaled = exposure.rescale_intensity(vec[~vec_mask], in_range=(prc_low, prc_high))
         vec_adj[~vec_mask] = vec_rescaled
@@ -219,7 +679,71 @@ def rescale_image_intensity(im, cloud_mask, prob_high):
 
     return im_adj
 
-def preprocess_single(fn, satname, cloud_mask_issue):
+def configure_gdal(cache_size=None, n_threads=None):
+    """
+    Sets the size of the GDAL block cache and the number of threads used by GDAL to read the
+    images (e.g. decompression of the compressed GeoTIFFs).
+
+    Arguments:
+    -----------
+        cache_size: int (optional)
+            size of the GDAL block cache in bytes (GDAL default if None)
+        n_threads: int or str (optional)
+            number of threads used by GDAL, or 'ALL_CPUS' (GDAL default if None)
+
+    Returns:
+    -----------
+
+    """
+
+    if cache_size is not None:
+        gdal.SetCacheMax(int(cache_size))
+    if n_threads is not None:
+        gdal.SetConfigOption('GDAL_NUM_THREADS', str(n_threads))
+
+
+def read_image(fn, band_list=None):
+    """
+    Reads the bands of a .TIF file in a single call, directly into a preallocated
+    (rows, columns, bands) array (no intermediate list of bands and no copy when stacking them).
+
+    Arguments:
+    -----------
+        fn: str
+            filepath + filename of the .TIF file
+        band_list: list of int (optional)
+            bands to read (starting at 1), all the bands if None
+
+    Returns:
+    -----------
+        im: np.array
+            3D array containing the bands (same data type as the first band read)
+        georef: np.array
+            vector of 6 elements [Xtr, Xscale, Xshear, Ytr, Yshear, Yscale] defining the
+            coordinates of the top-left pixel of the image
+
+    """
+
+    data = gdal.Open(fn, gdal.GA_ReadOnly)
+    georef = np.array(data.GetGeoTransform())
+    if band_list is None:
+        band_list = list(range(1, data.RasterCount + 1))
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(data.GetRasterBand(band_list[0]).DataType)
+    im = np.empty((data.RasterYSize, data.RasterXSize, len(band_list)), dtype=dtype)
+    # GDAL writes the bands through the strides of the (bands, rows, columns) view, i.e.
+    # directly in the pixel-interleaved array
+    if band_list == list(range(1, data.RasterCount + 1)):
+        data.ReadAsArray(buf_obj=np.moveaxis(im, 2, 0))
+    else:
+        for k in range(len(band_list)):
+            data.GetRasterBand(band_list[k]).ReadAsArray(buf_obj=im[:,:,k])
+    data = None
+
+    return im, georef
+
+
+def preprocess_single(fn, satname, cloud_mask_issue, dtype=DTYPE, hist_bins=HIST_BINS,
+                      pansharpen_method=PANSHARPEN_METHOD, block_size=PANSHARPEN_BLOCK_SIZE):
     """
     Reads the image and outputs the pansharpened/down-sampled multispectral bands, the
     georeferencing vector of the image (coordinates of the upper left pixel), the cloud mask and
@@ -238,6 +762,18 @@ def preprocess_single(fn, satname, cloud_mask_issue):
             name of the satellite mission (e.g., 'L5')
         cloud_mask_issue: boolean
             True if there is an issue with the cloud mask and sand pixels are being masked on the images
+        dtype: data type (optional)
+            data type of the bands (im_ms and im_extra), np.float64 by default
+        hist_bins: int (optional)
+            number of bins of the approximate histogram matching in the pansharpening of
+            Landsat 7 and 8 (see hist_match), None for the exact matching
+        pansharpen_method: str (optional)
+            pansharpening method of Landsat 7 and 8 (see pansharpen), 'pca' by default or
+            'brovey', 'ihs' and 'none' (bilinear upsampling only)
+        block_size: int (optional)
+            number of rows of the blocks of the pansharpening (see pansharpen_blocks), None to
+            pansharpen the whole image at once (by blocks, the histogram matching uses
+            BLOCK_HIST_BINS bins if hist_bins is None)
 
     Returns:
     -----------
@@ -258,16 +794,18 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
     """
 
+    # check the pansharpening method here, as pansharpening errors are ignored below
+    if not pansharpen_method in PANSHARPEN_METHODS:
+        raise ValueError('unknown pansharpening method %s, use one of %s' %
+                         (pansharpen_method, ', '.join(PANSHARPEN_METHODS)))
+
     #=============================================================================================#
     # L5 images
     #=============================================================================================#
     if satname == 'L5':
 
         # read all bands
-        data = gdal.Open(fn, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_ms = np.stack(bands, 2)
+        im_ms, georef = read_image(fn)
 
         # down-sample to 15 m (half of the original pixel size)
         nrows = im_ms.shape[0]*2
@@ -280,7 +818,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # resize the image using bilinear interpolation (order 1)
         im_ms = transform.resize(im_ms,(nrows, ncols), order=1, preserve_range=True,
-                                 mode='constant')
+                                 mode='constant').astype(dtype)
         # resize the image using nearest neighbour interpolation (order 0)
         cloud_mask = transform.resize(cloud_mask, (nrows, ncols), order=0, preserve_range=True,
                                       mode='constant').astype('bool_')
@@ -317,10 +855,8 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # read pan image
         fn_pan = fn[0]
-        data = gdal.Open(fn_pan, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_pan = np.stack(bands, 2)[:,:,0]
+        im_pan, georef = read_image(fn_pan, [1])
+        im_pan = im_pan[:,:,0].astype(dtype)
 
         # size of pan image
         nrows = im_pan.shape[0]
@@ -328,9 +864,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # read ms image
         fn_ms = fn[1]
-        data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_ms = np.stack(bands, 2)
+        im_ms = read_image(fn_ms)[0]
 
         # create cloud mask
         im_QA = im_ms[:,:,5]
@@ -339,7 +873,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # resize the image using bilinear interpolation (order 1)
         im_ms = im_ms[:,:,:5]
         im_ms = transform.resize(im_ms,(nrows, ncols), order=1, preserve_range=True,
-                                 mode='constant')
+                                 mode='constant').astype(dtype)
         # resize the image using nearest neighbour interpolation (order 0)
         cloud_mask = transform.resize(cloud_mask, (nrows, ncols), order=0, preserve_range=True,
                                       mode='constant').astype('bool_')
@@ -359,16 +893,18 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         cloud_mask = np.logical_or(im_zeros, cloud_mask)
         im_nodata = np.logical_or(im_zeros, im_nodata)
 
-        # pansharpen Green, Red, NIR (where there is overlapping with pan band in L7)
+        # pansharpen Green, Red, NIR (where there is overlapping with pan band in L7), written
+        # directly in the output image with the downsampled Blue and SWIR1 bands
+        im_ms_ps = np.empty(im_ms.shape, dtype=im_ms.dtype)
+        im_ms_ps[:,:,0] = im_ms[:,:,0]
+        im_ms_ps[:,:,4] = im_ms[:,:,4]
         try:
-            im_ms_ps = pansharpen(im_ms[:,:,[1,2,3]], im_pan, cloud_mask)
+            pansharpen(im_ms[:,:,1:4], im_pan, cloud_mask, hist_bins, pansharpen_method,
+                       block_size, out=im_ms_ps[:,:,1:4])
         except: # if pansharpening fails, keep downsampled bands (for long runs)
-            im_ms_ps = im_ms[:,:,[1,2,3]]
-        # add downsampled Blue and SWIR1 bands
-        im_ms_ps = np.append(im_ms[:,:,[0]], im_ms_ps, axis=2)
-        im_ms_ps = np.append(im_ms_ps, im_ms[:,:,[4]], axis=2)
+            im_ms_ps[:,:,1:4] = im_ms[:,:,1:4]
 
-        im_ms = im_ms_ps.copy()
+        im_ms = im_ms_ps
         # the extra image is the 15m panchromatic band
         im_extra = im_pan
 
@@ -379,10 +915,8 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # read pan image
         fn_pan = fn[0]
-        data = gdal.Open(fn_pan, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_pan = np.stack(bands, 2)[:,:,0]
+        im_pan, georef = read_image(fn_pan, [1])
+        im_pan = im_pan[:,:,0].astype(dtype)
 
         # size of pan image
         nrows = im_pan.shape[0]
@@ -390,9 +924,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # read ms image
         fn_ms = fn[1]
-        data = gdal.Open(fn_ms, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im_ms = np.stack(bands, 2)
+        im_ms = read_image(fn_ms)[0]
 
         # create cloud mask
         im_QA = im_ms[:,:,5]
@@ -401,7 +933,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         # resize the image using bilinear interpolation (order 1)
         im_ms = im_ms[:,:,:5]
         im_ms = transform.resize(im_ms,(nrows, ncols), order=1, preserve_range=True,
-                                 mode='constant')
+                                 mode='constant').astype(dtype)
         # resize the image using nearest neighbour interpolation (order 0)
         cloud_mask = transform.resize(cloud_mask, (nrows, ncols), order=0, preserve_range=True,
                                       mode='constant').astype('bool_')
@@ -421,15 +953,17 @@ def preprocess_single(fn, satname, cloud_mask_issue):
         cloud_mask = np.logical_or(im_zeros, cloud_mask)
         im_nodata = np.logical_or(im_zeros, im_nodata)
 
-        # pansharpen Blue, Green, Red (where there is overlapping with pan band in L8)
+        # pansharpen Blue, Green, Red (where there is overlapping with pan band in L8), written
+        # directly in the output image with the downsampled NIR and SWIR1 bands
+        im_ms_ps = np.empty(im_ms.shape, dtype=im_ms.dtype)
+        im_ms_ps[:,:,3:5] = im_ms[:,:,3:5]
         try:
-            im_ms_ps = pansharpen(im_ms[:,:,[0,1,2]], im_pan, cloud_mask)
+            pansharpen(im_ms[:,:,0:3], im_pan, cloud_mask, hist_bins, pansharpen_method,
+                       block_size, out=im_ms_ps[:,:,0:3])
         except: # if pansharpening fails, keep downsampled bands (for long runs)
-            im_ms_ps = im_ms[:,:,[0,1,2]]
-        # add downsampled NIR and SWIR1 bands
-        im_ms_ps = np.append(im_ms_ps, im_ms[:,:,[3,4]], axis=2)
+            im_ms_ps[:,:,0:3] = im_ms[:,:,0:3]
 
-        im_ms = im_ms_ps.copy()
+        im_ms = im_ms_ps
         # the extra image is the 15m panchromatic band
         im_extra = im_pan
 
@@ -440,11 +974,8 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # read 10m bands (R,G,B,NIR)
         fn10 = fn[0]
-        data = gdal.Open(fn10, gdal.GA_ReadOnly)
-        georef = np.array(data.GetGeoTransform())
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im10 = np.stack(bands, 2)
-        im10 = im10/10000 # TOA scaled to 10000
+        im10, georef = read_image(fn10)
+        im10 = im10.astype(dtype)/10000 # TOA scaled to 10000
 
         # if image contains only zeros (can happen with S2), skip the image
         if sum(sum(sum(im10))) < 1:
@@ -460,15 +991,12 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # read 20m band (SWIR1)
         fn20 = fn[1]
-        data = gdal.Open(fn20, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im20 = np.stack(bands, 2)
-        im20 = im20[:,:,0]
-        im20 = im20/10000 # TOA scaled to 10000
+        im20 = read_image(fn20, [1])[0][:,:,0]
+        im20 = im20.astype(dtype)/10000 # TOA scaled to 10000
 
         # resize the image using bilinear interpolation (order 1)
         im_swir = transform.resize(im20, (nrows, ncols), order=1, preserve_range=True,
-                                   mode='constant')
+                                   mode='constant').astype(dtype)
         im_swir = np.expand_dims(im_swir, axis=2)
 
         # append down-sampled SWIR1 band to the other 10m bands
@@ -476,10 +1004,7 @@ def preprocess_single(fn, satname, cloud_mask_issue):
 
         # create cloud mask using 60m QA band (not as good as Landsat cloud cover)
         fn60 = fn[2]
-        data = gdal.Open(fn60, gdal.GA_ReadOnly)
-        bands = [data.GetRasterBand(k + 1).ReadAsArray() for k in range(data.RasterCount)]
-        im60 = np.stack(bands, 2)
-        im_QA = im60[:,:,0]
+        im_QA = read_image(fn60, [1])[0][:,:,0]
         cloud_mask = create_cloud_mask(im_QA, satname, cloud_mask_issue)
         # resize the cloud mask using nearest neighbour interpolation (order 0)
         cloud_mask = transform.resize(cloud_mask,(nrows, ncols), order=0, preserve_range=True,
@@ -507,6 +1032,278 @@ def preprocess_single(fn, satname, cloud_mask_issue):
     return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata
 
 
+def get_cache_key(fn, satname, cloud_mask_issue, dtype=DTYPE, hist_bins=HIST_BINS,
+                  pansharpen_method=PANSHARPEN_METHOD, block_size=PANSHARPEN_BLOCK_SIZE):
+    """
+    Computes the key of an image in the cache of preprocessed images, from the path, size and
+    modification time of its files and the preprocessing options. The key changes when a file is
+    modified (e.g. merged with an overlapping image).
+
+    Arguments:
+    -----------
+        fn: str or list of str
+            filename(s) of the .TIF file(s) of the image (see preprocess_single)
+        satname: str
+            name of the satellite mission (e.g., 'L5')
+        cloud_mask_issue: boolean
+            True if there is an issue with the cloud mask and sand pixels are being masked on the images
+        dtype: data type (optional)
+            data type of the bands of the preprocessed image
+        hist_bins: int (optional)
+            number of bins of the histogram matching (see hist_match)
+        pansharpen_method: str (optional)
+            pansharpening method (see pansharpen)
+        block_size: int (optional)
+            number of rows of the blocks of the pansharpening (see pansharpen_blocks)
+
+    Returns:
+    -----------
+        key: str
+            md5 hash identifying the preprocessed image
+
+    """
+
+    if type(fn) is str:
+        fn = [fn]
+    description = [satname, str(bool(cloud_mask_issue)), np.dtype(dtype).name, str(hist_bins),
+                   pansharpen_method, str(block_size), str(CACHE_VERSION)]
+    for fn_file in fn:
+        stat = os.stat(fn_file)
+        description = description + [os.path.abspath(fn_file), str(stat.st_size),
+                                     str(stat.st_mtime_ns)]
+    key = hashlib.md5('|'.join(description).encode('utf-8')).hexdigest()
+
+    return key
+
+
+def save_preprocessed(fn_cache, im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata):
+    """
+    Saves the outputs of preprocess_single in the cache (.npz file). The bands are stored in
+    float32 and the masks as packed bits. The file is written in a temporary file which is then
+    renamed, so that an interrupted run does not leave a corrupted file.
+
+    Arguments:
+    -----------
+        fn_cache: str
+            filepath + filename of the .npz file
+        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata:
+            outputs of preprocess_single
+
+    Returns:
+    -----------
+
+    """
+
+    if len(im_ms) == 0:
+        # empty image (only the cloud mask is returned)
+        arrays = {'empty':np.array(True), 'shape':np.array(cloud_mask.shape),
+                  'cloud_mask':np.packbits(cloud_mask)}
+    else:
+        arrays = {'empty':np.array(False), 'shape':np.array(cloud_mask.shape),
+                  'im_ms':im_ms.astype(np.float32), 'georef':georef,
+                  'cloud_mask':np.packbits(cloud_mask), 'im_extra':np.array(im_extra, np.float32),
+                  'im_QA':im_QA, 'im_nodata':np.packbits(im_nodata)}
+    fd, fn_temp = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(fn_cache))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(fn_temp, fn_cache)
+    except:
+        if os.path.exists(fn_temp):
+            os.remove(fn_temp)
+        raise
+
+
+def read_preprocessed(fn_cache, dtype=DTYPE):
+    """
+    Reads the outputs of preprocess_single from the cache (see save_preprocessed).
+
+    Arguments:
+    -----------
+        fn_cache: str
+            filepath + filename of the .npz file
+        dtype: data type (optional)
+            data type of the bands returned
+
+    Returns:
+    -----------
+        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata:
+            outputs of preprocess_single
+
+    """
+
+    with np.load(fn_cache) as data:
+        shape = tuple(data['shape'])
+        n_pixels = shape[0]*shape[1]
+        cloud_mask = np.unpackbits(data['cloud_mask'])[:n_pixels].reshape(shape).astype(bool)
+        if data['empty']:
+            return [], [], cloud_mask, [], [], []
+        im_ms = data['im_ms'].astype(dtype)
+        georef = data['georef']
+        im_extra = data['im_extra'].astype(dtype)
+        if im_extra.size == 0:
+            im_extra = []
+        im_QA = data['im_QA']
+        im_nodata = np.unpackbits(data['im_nodata'])[:n_pixels].reshape(shape).astype(bool)
+
+    return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata
+
+
+def clean_cache(filepath_cache, max_size, new_size=0):
+    """
+    Keeps the cache of preprocessed images below max_size. The size of the cache is estimated
+    by adding the size of each new file (CACHE_USAGE), the cache directory is only scanned the
+    first time, when this estimate is above max_size and when the last scan is older than
+    CACHE_RESCAN_INTERVAL: the least recently used images are then removed until the size of
+    the cache is below CACHE_CLEAN_FRACTION*max_size.
+    The estimate only counts the files written by this process, if other processes share the
+    cache directory it can exceed max_size by the size of the files they wrote since the last
+    scan (at most CACHE_RESCAN_INTERVAL seconds of writes).
+
+    Arguments:
+    -----------
+        filepath_cache: str
+            directory of the cache
+        max_size: int
+            maximum size of the cache in bytes
+        new_size: int
+            size in bytes of the file that was just added to the cache
+
+    Returns:
+    -----------
+
+    """
+
+    if filepath_cache in CACHE_USAGE.keys():
+        usage = CACHE_USAGE[filepath_cache]
+        usage['size'] = usage['size'] + new_size
+        if (usage['size'] <= max_size and
+            time.time() - usage['scanned'] < CACHE_RESCAN_INTERVAL):
+            return
+
+    scanned = time.time()
+    files = []
+    for fn in os.listdir(filepath_cache):
+        if not fn.endswith('.npz'):
+            continue
+        try:
+            stat = os.stat(os.path.join(filepath_cache, fn))
+        except OSError: # removed by another process
+            continue
+        files.append([stat.st_mtime, stat.st_size, fn])
+    total_size = sum([_[1] for _ in files])
+    # remove the least recently used files first
+    if total_size > max_size:
+        for mtime, size, fn in sorted(files):
+            if total_size <= CACHE_CLEAN_FRACTION*max_size:
+                break
+            try:
+                os.remove(os.path.join(filepath_cache, fn))
+            except OSError:
+                continue
+            total_size = total_size - size
+    CACHE_USAGE[filepath_cache] = {'size':total_size, 'scanned':scanned}
+
+
+def load_preprocessed(fn, satname, settings):
+    """
+    Returns the outputs of preprocess_single for an image, using a persistent cache of the
+    preprocessed images if settings['cache_dir'] is defined. The cached images are identified by
+    the path, size and modification time of their files and by settings['cloud_mask_issue'] (see
+    get_cache_key), so that save_jpg, get_reference_sl and extract_shorelines (and later runs)
+    preprocess each image only once. The bands are cached in float32 (with settings['dtype'] =
+    np.float64 they are rounded to float32 precision), the same values are returned whether the
+    image was already in the cache or not. The least recently used images
+    are removed when the cache is larger than settings['cache_size'].
+
+    Arguments:
+    -----------
+        fn: str or list of str
+            filename(s) of the .TIF file(s) of the image (see preprocess_single)
+        satname: str
+            name of the satellite mission (e.g., 'L5')
+        settings: dict
+            contains the following fields:
+        'cloud_mask_issue': boolean
+            True if there is an issue with the cloud mask and sand pixels are being masked on the images
+        'dtype': data type (optional)
+            data type of the bands (default is DTYPE, np.float64)
+        'hist_bins': int (optional)
+            number of bins of the approximate histogram matching in the pansharpening (default
+            is HIST_BINS, None for the exact matching)
+        'pansharpen_method': str (optional)
+            pansharpening method of Landsat 7 and 8, one of PANSHARPEN_METHODS (default is
+            PANSHARPEN_METHOD, 'pca')
+        'pansharpen_block_size': int (optional)
+            number of rows of the blocks of the pansharpening of Landsat 7 and 8 (default is
+            PANSHARPEN_BLOCK_SIZE, None to pansharpen the whole image at once), the histogram
+            matching by blocks uses BLOCK_HIST_BINS bins if 'hist_bins' is None
+        'cache_dir': str (optional)
+            directory of the cache of preprocessed images (no cache if not defined or None)
+        'cache_size': int (optional)
+            maximum size of the cache in bytes (default is CACHE_SIZE)
+
+    Returns:
+    -----------
+        im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata:
+            outputs of preprocess_single
+
+    """
+
+    cloud_mask_issue = settings['cloud_mask_issue']
+    if 'dtype' in settings.keys():
+        dtype = settings['dtype']
+    else:
+        dtype = DTYPE
+    if 'hist_bins' in settings.keys():
+        hist_bins = settings['hist_bins']
+    else:
+        hist_bins = HIST_BINS
+    if 'pansharpen_method' in settings.keys():
+        pansharpen_method = settings['pansharpen_method']
+    else:
+        pansharpen_method = PANSHARPEN_METHOD
+    if 'pansharpen_block_size' in settings.keys():
+        block_size = settings['pansharpen_block_size']
+    else:
+        block_size = PANSHARPEN_BLOCK_SIZE
+    if not 'cache_dir' in settings.keys() or settings['cache_dir'] is None:
+        return preprocess_single(fn, satname, cloud_mask_issue, dtype, hist_bins,
+                                 pansharpen_method, block_size)
+    if 'cache_size' in settings.keys():
+        max_size = settings['cache_size']
+    else:
+        max_size = CACHE_SIZE
+    filepath_cache = settings['cache_dir']
+    if not os.path.exists(filepath_cache):
+        os.makedirs(filepath_cache)
+
+    key = get_cache_key(fn, satname, cloud_mask_issue, dtype, hist_bins, pansharpen_method,
+                        block_size)
+    fn_cache = os.path.join(filepath_cache, key + '.npz')
+    if os.path.exists(fn_cache):
+        try:
+            outputs = read_preprocessed(fn_cache, dtype)
+            # mark the image as recently used
+            os.utime(fn_cache)
+            return outputs
+        except: # corrupted or removed file, preprocess the image again
+            pass
+
+    outputs = preprocess_single(fn, satname, cloud_mask_issue, dtype, hist_bins,
+                                pansharpen_method, block_size)
+    save_preprocessed(fn_cache, *outputs)
+    clean_cache(filepath_cache, max_size, os.path.getsize(fn_cache))
+    # same values as when the image is read from the cache
+    im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = outputs
+    if len(im_ms) > 0:
+        im_ms = im_ms.astype(np.float32).astype(dtype)
+        if len(im_extra) > 0:
+            im_extra = im_extra.astype(np.float32).astype(dtype)
+
+    return im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata
+
+
 def create_jpg(im_ms, cloud_mask, date, satname, filepath):
     """
     Saves a .jpg file with the RGB image as well as the NIR and SWIR1 grayscale images.
@@ -617,7 +1414,7 @@ def save_jpg(metadata, settings):
             # image filename
             fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
             # read and preprocess image
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings['cloud_mask_issue'])
+            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = load_preprocessed(fn, satname, settings)
             # calculate cloud cover
             cloud_cover = np.divide(sum(sum(cloud_mask.astype(int))),
                                     (cloud_mask.shape[0]*cloud_mask.shape[1]))
@@ -697,7 +1494,7 @@ def get_reference_sl(metadata, settings):
 
             # read image
             fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = preprocess_single(fn, satname, settings['cloud_mask_issue'])
+            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = load_preprocessed(fn, satname, settings)
 
             # calculate cloud cover
             cloud_cover = np.divide(sum(sum(cloud_mask.astype(int))),
@@ -25,6 +25,10 @@ import matplotlib.cm as cm
 from matplotlib import gridspec
 from pylab import ginput
 import pickle
+import queue
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # own modules
 from coastsat import SDS_tools, SDS_preprocess
@@ -57,41 +61,25 @@ def calculate_features(im_ms, cloud_mask, im_bool):
             the pixels (rows) indicated in im_bool
     """
 
+    # the features are written in a preallocated matrix (same precision as the image):
+    # multispectral bands, spectral indices, standard deviation of the bands and of the indices
+    n_bands = im_ms.shape[2]
+    features = np.empty((np.sum(im_bool), 2*n_bands + 10), dtype=im_ms.dtype)
     # add all the multispectral bands
-    features = np.expand_dims(im_ms[im_bool,0],axis=1)
-    for k in range(1,im_ms.shape[2]):
-        feature = np.expand_dims(im_ms[im_bool,k],axis=1)
-        features = np.append(features, feature, axis=-1)
-    # NIR-G
-    im_NIRG = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRG[im_bool],axis=1), axis=-1)
-    # SWIR-G
-    im_SWIRG = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRG[im_bool],axis=1), axis=-1)
-    # NIR-R
-    im_NIRR = SDS_tools.nd_index(im_ms[:,:,3], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_NIRR[im_bool],axis=1), axis=-1)
-    # SWIR-NIR
-    im_SWIRNIR = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,3], cloud_mask)
-    features = np.append(features, np.expand_dims(im_SWIRNIR[im_bool],axis=1), axis=-1)
-    # B-R
-    im_BR = SDS_tools.nd_index(im_ms[:,:,0], im_ms[:,:,2], cloud_mask)
-    features = np.append(features, np.expand_dims(im_BR[im_bool],axis=1), axis=-1)
+    features[:,:n_bands] = im_ms[im_bool,:]
+    # NIR-G, SWIR-G, NIR-R, SWIR-NIR and B-R
+    im_indices = []
+    for k,(b1, b2) in enumerate([[3,1], [4,1], [3,2], [4,3], [0,2]]):
+        im_indices.append(SDS_tools.nd_index(im_ms[:,:,b1], im_ms[:,:,b2], cloud_mask))
+        features[:,n_bands+k] = im_indices[k][im_bool]
     # calculate standard deviation of individual bands
-    for k in range(im_ms.shape[2]):
+    for k in range(n_bands):
         im_std =  SDS_tools.image_std(im_ms[:,:,k], 1)
-        features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+        features[:,n_bands+5+k] = im_std[im_bool]
     # calculate standard deviation of the spectral indices
-    im_std = SDS_tools.image_std(im_NIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRG, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_NIRR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_SWIRNIR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
-    im_std = SDS_tools.image_std(im_BR, 1)
-    features = np.append(features, np.expand_dims(im_std[im_bool],axis=1), axis=-1)
+    for k in range(len(im_indices)):
+        im_std = SDS_tools.image_std(im_indices[k], 1)
+        features[:,2*n_bands+5+k] = im_std[im_bool]
 
     return features
 
@@ -141,7 +129,7 @@ def classify_image_NN(im_ms, im_extra, cloud_mask, min_beach_area, clf):
     labels = clf.predict(vec_features)
 
     # recompose image
-    vec_classif = np.nan*np.ones((cloud_mask.shape[0]*cloud_mask.shape[1]))
+    vec_classif = np.full(cloud_mask.shape[0]*cloud_mask.shape[1], np.nan)
     vec_classif[~vec_mask] = labels
     im_classif = vec_classif.reshape((cloud_mask.shape[0], cloud_mask.shape[1]))
 
@@ -632,7 +620,140 @@ def show_detection(im_ms, cloud_mask, im_labels, shoreline,image_epsg, georef,
     return skip_image
 
 
-def extract_shorelines(metadata, settings):
+def load_classifier(satname, settings):
+    """
+    Loads the classifier of a satellite mission (see classify_image_NN).
+
+    Arguments:
+    -----------
+        satname: str
+            short name of the satellite mission
+        settings: dict
+            contains the field 'sand_color' ('default', 'dark' or 'bright')
+
+    Returns:
+    -----------
+        clf: classifier
+        pixel_size: int
+            size of the pixels (m) of the preprocessed images
+
+    """
+
+    if satname in ['L5','L7','L8']:
+        pixel_size = 15
+        if settings['sand_color'] == 'dark':
+            clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_Landsat_dark.pkl'))
+        elif settings['sand_color'] == 'bright':
+            clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_Landsat_bright.pkl'))
+        else:
+            clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_Landsat.pkl'))
+
+    elif satname == 'S2':
+        pixel_size = 10
+        clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_S2.pkl'))
+
+    return clf, pixel_size
+
+
+def map_shoreline(filename, filepath, satname, image_epsg, settings, clf, pixel_size):
+    """
+    Maps the shoreline on one satellite image (see extract_shorelines).
+
+    Arguments:
+    -----------
+        filename: str
+            filename of the image
+        filepath: str or list of str
+            directory of the image (see SDS_tools.get_filepath)
+        satname: str
+            short name of the satellite mission
+        image_epsg: int
+            epsg code of the spatial reference system of the image
+        settings: dict
+            settings of the shoreline extraction (see extract_shorelines)
+        clf: classifier
+        pixel_size: int
+            size of the pixels (m) of the preprocessed images
+
+    Returns:
+    -----------
+        result: tuple or None
+            shoreline (np.array with the coordinates of the shoreline points) and cloud cover of
+            the image, None if the image was skipped (too cloudy, no shoreline or rejected by
+            the user)
+
+    """
+
+    # convert settings['min_beach_area'] and settings['buffer_size'] from metres to pixels
+    buffer_size_pixels = np.ceil(settings['buffer_size']/pixel_size)
+    min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
+
+    # get image filename
+    fn = SDS_tools.get_filenames(filename,filepath, satname)
+    # preprocess image (cloud mask + pansharpening/downsampling)
+    im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.load_preprocessed(fn, satname, settings)
+    # define an advanced cloud mask (for L7 it takes into account the fact that diagonal
+    # bands of no data are not clouds)
+    if not satname == 'L7' or sum(sum(im_nodata)) == 0 or sum(sum(im_nodata)) > 0.5*im_nodata.size:
+        cloud_mask_adv = cloud_mask
+    else:
+        cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
+
+    # calculate cloud cover
+    cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
+                            (cloud_mask.shape[0]*cloud_mask.shape[1]))
+    # skip image if cloud cover is above threshold
+    if cloud_cover > settings['cloud_thresh']:
+        return None
+
+    # calculate a buffer around the reference shoreline (if any has been digitised)
+    im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
+                                            pixel_size, settings)
+
+    # when running the automated mode, skip image if cloudy pixels are found in the shoreline buffer
+    if not settings['check_detection'] and 'reference_shoreline' in settings.keys():
+        if sum(sum(np.logical_and(im_ref_buffer, cloud_mask_adv))) > 0:
+            return None
+
+    # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
+    im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask,
+                            min_beach_area_pixels, clf)
+
+    # there are two options to map the contours:
+    # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
+    # otherwise use find_wl_contours2 (traditional)
+    try: # use try/except structure for long runs
+        if sum(sum(im_labels[:,:,0])) == 0 :
+            # compute MNDWI image (SWIR-G)
+            im_mndwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
+            # find water contours on MNDWI grayscale image
+            contours_mwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
+        else:
+            # use classification to refine threshold and extract the sand/water interface
+            contours_wi, contours_mwi = find_wl_contours2(im_ms, im_labels,
+                                        cloud_mask, buffer_size_pixels, im_ref_buffer)
+    except:
+        print('Could not map shoreline for this image: ' + filename)
+        return None
+
+    # process the water contours into a shoreline
+    shoreline = process_shoreline(contours_mwi, cloud_mask, georef, image_epsg, settings)
+
+    # visualise the mapped shorelines, there are two options:
+    # if settings['check_detection'] = True, shows the detection to the user for accept/reject
+    # if settings['save_figure'] = True, saves a figure for each mapped shoreline
+    if settings['check_detection'] or settings['save_figure']:
+        date = filename[:19]
+        skip_image = show_detection(im_ms, cloud_mask, im_labels, shoreline,
+                                    image_epsg, georef, settings, date, satname)
+        # if the user decides to skip the image, continue and do not save the mapped shoreline
+        if skip_image:
+            return None
+
+    return shoreline, cloud_cover
+
+
+def extract_shorelines(metadata, settings, results=None):
     """
     Extracts shorelines from satellite images.
 
@@ -661,6 +782,9 @@ def extract_shorelines(metadata, settings):
         check_detection: boolean
             True to show each invidual detection and let the user validate the mapped shoreline
 
+        results: dict (optional)
+            shorelines already mapped (see map_shoreline), the keys are (satname, filename)
+
     Returns:
     -----------
         output: dict
@@ -668,6 +792,8 @@ def extract_shorelines(metadata, settings):
 
     """
 
+    if results is None:
+        results = dict([])
     sitename = settings['inputs']['sitename']
     filepath_data = settings['inputs']['filepath']
     # initialise output structure
@@ -697,91 +823,23 @@ def extract_shorelines(metadata, settings):
         output_idxkeep = []    # index that were kept during the analysis (cloudy images are skipped)
 
         # load classifiers and
-        if satname in ['L5','L7','L8']:
-            pixel_size = 15
-            if settings['sand_color'] == 'dark':
-                clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_Landsat_dark.pkl'))
-            elif settings['sand_color'] == 'bright':
-                clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_Landsat_bright.pkl'))
-            else:
-                clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_Landsat.pkl'))
-
-        elif satname == 'S2':
-            pixel_size = 10
-            clf = joblib.load(os.path.join(os.getcwd(), 'classifiers', 'NN_4classes_S2.pkl'))
-
-        # convert settings['min_beach_area'] and settings['buffer_size'] from metres to pixels
-        buffer_size_pixels = np.ceil(settings['buffer_size']/pixel_size)
-        min_beach_area_pixels = np.ceil(settings['min_beach_area']/pixel_size**2)
+        clf, pixel_size = load_classifier(satname, settings)
 
         # loop through the images
         for i in range(len(filenames)):
 
             print('\r%s:   %d%%' % (satname,int(((i+1)/len(filenames))*100)), end='')
 
-            # get image filename
-            fn = SDS_tools.get_filenames(filenames[i],filepath, satname)
-            # preprocess image (cloud mask + pansharpening/downsampling)
-            im_ms, georef, cloud_mask, im_extra, im_QA, im_nodata = SDS_preprocess.preprocess_single(fn, satname, settings['cloud_mask_issue'])
-            # get image spatial reference system (epsg code) from metadata dict
-            image_epsg = metadata[satname]['epsg'][i]
-            # define an advanced cloud mask (for L7 it takes into account the fact that diagonal
-            # bands of no data are not clouds)
-            if not satname == 'L7' or sum(sum(im_nodata)) == 0 or sum(sum(im_nodata)) > 0.5*im_nodata.size:
-                cloud_mask_adv = cloud_mask
+            # map the shoreline (unless it was already mapped)
+            if (satname, filenames[i]) in results.keys():
+                result = results[(satname, filenames[i])]
             else:
-                cloud_mask_adv = np.logical_xor(cloud_mask, im_nodata)
-
-            # calculate cloud cover
-            cloud_cover = np.divide(sum(sum(cloud_mask_adv.astype(int))),
-                                    (cloud_mask.shape[0]*cloud_mask.shape[1]))
-            # skip image if cloud cover is above threshold
-            if cloud_cover > settings['cloud_thresh']:
+                result = map_shoreline(filenames[i], filepath, satname,
+                                       metadata[satname]['epsg'][i], settings, clf, pixel_size)
+            # skipped image
+            if result is None:
                 continue
-
-            # calculate a buffer around the reference shoreline (if any has been digitised)
-            im_ref_buffer = create_shoreline_buffer(cloud_mask.shape, georef, image_epsg,
-                                                    pixel_size, settings)
-
-            # when running the automated mode, skip image if cloudy pixels are found in the shoreline buffer
-            if not settings['check_detection'] and 'reference_shoreline' in settings.keys():
-                if sum(sum(np.logical_and(im_ref_buffer, cloud_mask_adv))) > 0:
-                    continue
-
-            # classify image in 4 classes (sand, whitewater, water, other) with NN classifier
-            im_classif, im_labels = classify_image_NN(im_ms, im_extra, cloud_mask,
-                                    min_beach_area_pixels, clf)
-
-            # there are two options to map the contours:
-            # if there are pixels in the 'sand' class --> use find_wl_contours2 (enhanced)
-            # otherwise use find_wl_contours2 (traditional)
-            try: # use try/except structure for long runs
-                if sum(sum(im_labels[:,:,0])) == 0 :
-                    # compute MNDWI image (SWIR-G)
-                    im_mndwi = SDS_tools.nd_index(im_ms[:,:,4], im_ms[:,:,1], cloud_mask)
-                    # find water contours on MNDWI grayscale image
-                    contours_mwi = find_wl_contours1(im_mndwi, cloud_mask, im_ref_buffer)
-                else:
-                    # use classification to refine threshold and extract the sand/water interface
-                    contours_wi, contours_mwi = find_wl_contours2(im_ms, im_labels,
-                                                cloud_mask, buffer_size_pixels, im_ref_buffer)
-            except:
-                print('Could not map shoreline for this image: ' + filenames[i])
-                continue
-
-            # process the water contours into a shoreline
-            shoreline = process_shoreline(contours_mwi, cloud_mask, georef, image_epsg, settings)
-
-            # visualise the mapped shorelines, there are two options:
-            # if settings['check_detection'] = True, shows the detection to the user for accept/reject
-            # if settings['save_figure'] = True, saves a figure for each mapped shoreline
-            if settings['check_detection'] or settings['save_figure']:
-                date = filenames[i][:19]
-                skip_image = show_detection(im_ms, cloud_mask, im_labels, shoreline,
-                                            image_epsg, georef, settings, date, satname)
-                # if the user decides to skip the image, continue and do not save the mapped shoreline
-                if skip_image:
-                    continue
+            shoreline, cloud_cover = result
 
             # append to output variables
             output_timestamp.append(metadata[satname]['dates'][i])
@@ -822,3 +880,139 @@ def extract_shorelines(metadata, settings):
     gdf.to_file(os.path.join(filepath, sitename + '_output.geojson'), driver='GeoJSON', encoding='utf-8')
 
     return output
+
+
+def extract_shorelines_pipeline(settings, queue_size=10):
+    """
+    Downloads the satellite images (see SDS_download.retrieve_images) and extracts the
+    shorelines at the same time: the images are downloaded in a background thread and each image
+    is queued for preprocessing and shoreline mapping as soon as its files are on disk. The
+    queue is bounded (the download waits when queue_size images are waiting to be processed)
+    and the images are processed one at a time, so the memory used does not grow with the
+    number of images. The output is the same as downloading all the images and then running
+    extract_shorelines.
+    If the processing is interrupted (error, KeyboardInterrupt or the user quitting the check of
+    the detections), the download is cancelled and the error is raised without waiting for
+    the download thread (the files being downloaded are finished in the background).
+
+    Arguments:
+    -----------
+        settings: dict
+            settings of the shoreline extraction (see extract_shorelines), including the
+            inputs of the download in 'inputs' (see SDS_download.retrieve_images)
+        queue_size: int
+            maximum number of downloaded images waiting to be processed
+
+    Returns:
+    -----------
+        metadata: dict
+            contains all the information about the satellite images that were downloaded
+        output: dict
+            contains the extracted shorelines and corresponding dates.
+
+    """
+
+    # create a subfolder to store the .jpg images showing the detection
+    filepath_jpg = os.path.join(settings['inputs']['filepath'], settings['inputs']['sitename'],
+                                'jpg_files', 'detection')
+    if not os.path.exists(filepath_jpg):
+            os.makedirs(filepath_jpg)
+    plt.close('all')
+
+    # imported here so that the ee module is only needed to download the images
+    from coastsat import SDS_download
+
+    # images downloaded and waiting to be processed (None once the download is finished)
+    images = queue.Queue(maxsize=queue_size)
+    # set to stop the download if the processing is interrupted
+    cancel = threading.Event()
+    def put_image(image):
+        # wait for a free place in the queue, unless the download was cancelled
+        while not cancel.is_set():
+            try:
+                images.put(image, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    results = dict([])
+    classifiers = dict([])
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(SDS_download.retrieve_images, settings['inputs'], put_image, cancel)
+    future.add_done_callback(lambda _: put_image(None))
+    try:
+        image = images.get()
+        while image is not None:
+            # map the shoreline of each image as soon as it is downloaded
+            satname = image['satname']
+            if not satname in classifiers.keys():
+                classifiers[satname] = load_classifier(satname, settings)
+            clf, pixel_size = classifiers[satname]
+            filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+            results[(satname, image['filename'])] = map_shoreline(image['filename'],
+                    filepath, satname, image['epsg'], settings, clf, pixel_size)
+            image = images.get()
+    except BaseException:
+        # stop the download and raise the error without waiting for the download thread
+        cancel.set()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+    metadata = future.result()
+
+    print('%d images processed during the download' % len(results))
+    # assemble the output in the same order as extract_shorelines (and save it)
+    output = extract_shorelines(metadata, settings, results)
+
+    return metadata, output
+
+
+def measure_processing_rate(metadata, settings, n_images=5):
+    """
+    Measures the time needed to map the shoreline (preprocessing included) on the first
+    n_images images of each satellite mission, to estimate the processing time of other runs
+    (see SDS_download.estimate_cost). The detections are neither shown nor saved.
+
+    Arguments:
+    -----------
+        metadata: dict
+            contains all the information about the satellite images that were downloaded
+        settings: dict
+            settings of the shoreline extraction (see extract_shorelines)
+        n_images: int
+            number of images processed for each mission
+
+    Returns:
+    -----------
+        processing_rate: dict
+            time (in seconds) needed to process one megapixel of the preprocessed images of
+            each mission
+
+    """
+
+    settings_test = settings.copy()
+    settings_test['check_detection'] = False
+    settings_test['save_figure'] = False
+    settings_test['cache_dir'] = None
+    # size of the images (area of interest)
+    from coastsat import SDS_download
+    width, height = SDS_download.get_bbox_size(settings['inputs']['polygon'])
+
+    processing_rate = dict([])
+    for satname in metadata.keys():
+        filenames = metadata[satname]['filenames'][:n_images]
+        if len(filenames) == 0:
+            continue
+        filepath = SDS_tools.get_filepath(settings['inputs'],satname)
+        clf, pixel_size = load_classifier(satname, settings)
+        t0 = time.time()
+        for i in range(len(filenames)):
+            map_shoreline(filenames[i], filepath, satname, metadata[satname]['epsg'][i],
+                          settings_test, clf, pixel_size)
+        duration = (time.time() - t0)/len(filenames)
+        megapixels = width*height/pixel_size**2/1e6
+        processing_rate[satname] = duration/megapixels
+        print('%s: %.2f seconds per image (%.2f seconds per megapixel)' % (satname, duration,
+              processing_rate[satname]))
+
+    return processing_rate
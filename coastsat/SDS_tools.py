@@ -174,8 +174,9 @@ def nd_index(im1, im2, cloud_mask):
 
     # reshape the cloud mask
     vec_mask = cloud_mask.reshape(im1.shape[0] * im1.shape[1])
-    # initialise with NaNs
-    vec_nd = np.ones(len(vec_mask)) * np.nan
+    # initialise with NaNs (same floating point precision as the images)
+    dtype = np.result_type(im1.dtype, im2.dtype, np.float32)
+    vec_nd = np.full(len(vec_mask), np.nan, dtype=dtype)
     # reshape the two images
     vec1 = im1.reshape(im1.shape[0] * im1.shape[1])
     vec2 = im2.reshape(im2.shape[0] * im2.shape[1])
@@ -207,6 +208,12 @@ def image_std(image, radius):
         
     """  
     
+    # the output has the same floating point precision as the image, but the variance is
+    # computed in double precision (difference of two close values)
+    if np.issubdtype(image.dtype, np.floating):
+        dtype = image.dtype
+    else:
+        dtype = np.float64
     # convert to float
     image = image.astype(float)
     # first pad the image
@@ -222,7 +229,7 @@ def image_std(image, radius):
     win_var = win_sqr_mean - win_mean**2
     win_std = np.sqrt(win_var)
     # remove padding
-    win_std = win_std[radius:-radius, radius:-radius]
+    win_std = win_std[radius:-radius, radius:-radius].astype(dtype)
 
     return win_std
 
@@ -72,6 +72,7 @@ settings = {
     'min_length_sl': 200,       # minimum length (in metres) of shoreline perimeter to be valid
     'cloud_mask_issue': False,  # switch this parameter to True if sand pixels are masked (in black) on many images  
     'sand_color': 'default',    # 'default', 'dark' (for grey/black sand beaches) or 'bright' (for white sand beaches)
+    'cache_dir': None,          # directory to cache the preprocessed images (up to 2 GB), e.g. os.path.join(filepath_data, sitename, 'cache')
 }
 
 # [OPTIONAL] preprocess images (cloud masking, pansharpening/down-sampling)
@@ -0,0 +1,25 @@
+"""Configuration of the tests. When GDAL (osgeo) or the Earth Engine API (ee) are not installed,
+empty modules are registered in their place so that the tests that do not use them still run
+(the download tests replace the ee module of SDS_download with fake_ee.FakeEE and do not write
+GeoTIFFs)."""
+
+import sys
+import types
+
+try:
+    import osgeo
+except ImportError:
+    osgeo = types.ModuleType('osgeo')
+    for name in ['gdal', 'gdal_array', 'ogr', 'osr']:
+        module = types.ModuleType('osgeo.' + name)
+        setattr(osgeo, name, module)
+        sys.modules['osgeo.' + name] = module
+    sys.modules['osgeo'] = osgeo
+
+try:
+    import ee
+except ImportError:
+    import fake_ee
+    ee = types.ModuleType('ee')
+    ee.EEException = fake_ee.EEException
+    sys.modules['ee'] = ee
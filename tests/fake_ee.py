@@ -0,0 +1,441 @@
+"""This module contains an offline stand-in for the Google Earth Engine python API (ee), used to
+benchmark and test the download functions of SDS_download without a connection to the GEE server.
+
+It serves realistic collection metadata for the Landsat and Sentinel-2 collections used by
+SDS_download and zipped GeoTIFFs (from a local HTTP server), and can simulate latency, throttling
+and failures. It is part of the tests (not of the coastsat package), to use it add the tests
+directory to the path and replace the ee module used by SDS_download:
+
+    sys.path.insert(0, 'tests')
+    import fake_ee
+    from coastsat import SDS_download
+    SDS_download.ee = fake_ee.FakeEE(latency=0.2, max_concurrent=4)
+    metadata = SDS_download.retrieve_images(inputs)
+
+Only the requests used by SDS_download are supported: querying the collections, downloading
+the images and computing the cloud cover of the images for the screening (see
+SDS_download.add_cloud_cover), which is derived from the cloud cover property of each image.
+"""
+
+# load modules
+import os
+import numpy as np
+import io
+import json
+import zipfile
+import tempfile
+import threading
+import random
+import time
+from datetime import datetime, timedelta
+import pytz
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from osgeo import gdal, osr
+
+# bands of each collection: (band id, pixel size in metres, data type)
+COLLECTIONS = {
+    'LANDSAT/LT05/C01/T1_TOA': {
+        'prefix':'LT05', 'revisit':16, 'cloud_property':'CLOUD_COVER',
+        'bands':[('B1',30,'float'), ('B2',30,'float'), ('B3',30,'float'), ('B4',30,'float'),
+                 ('B5',30,'float'), ('B6',30,'float'), ('B7',30,'float'), ('BQA',30,'int')]},
+    'LANDSAT/LE07/C01/T1_RT_TOA': {
+        'prefix':'LE07', 'revisit':16, 'cloud_property':'CLOUD_COVER',
+        'bands':[('B1',30,'float'), ('B2',30,'float'), ('B3',30,'float'), ('B4',30,'float'),
+                 ('B5',30,'float'), ('B6_VCID_1',30,'float'), ('B6_VCID_2',30,'float'),
+                 ('B7',30,'float'), ('B8',15,'float'), ('BQA',30,'int')]},
+    'LANDSAT/LC08/C01/T1_RT_TOA': {
+        'prefix':'LC08', 'revisit':16, 'cloud_property':'CLOUD_COVER',
+        'bands':[('B1',30,'float'), ('B2',30,'float'), ('B3',30,'float'), ('B4',30,'float'),
+                 ('B5',30,'float'), ('B6',30,'float'), ('B7',30,'float'), ('B8',15,'float'),
+                 ('B9',30,'float'), ('B10',30,'float'), ('B11',30,'float'), ('BQA',30,'int')]},
+    'COPERNICUS/S2': {
+        'prefix':'', 'revisit':5, 'cloud_property':'CLOUDY_PIXEL_PERCENTAGE',
+        'bands':[('B1',60,'int'), ('B2',10,'int'), ('B3',10,'int'), ('B4',10,'int'),
+                 ('B5',20,'int'), ('B6',20,'int'), ('B7',20,'int'), ('B8',10,'int'),
+                 ('B8A',20,'int'), ('B9',60,'int'), ('B10',60,'int'), ('B11',20,'int'),
+                 ('B12',20,'int'), ('QA10',10,'int'), ('QA20',20,'int'), ('QA60',60,'int')]},
+    }
+
+# value of the QA bands for a clear pixel
+QA_CLEAR = {'LT05':672, 'LE07':672, 'LC08':2720, '':0}
+
+
+class EEException(Exception):
+    """Error raised by the fake ee server (same name as the error of the ee module)."""
+    pass
+
+
+class Geometry:
+    """Geometries of the fake ee module (polygons and buffered lines)."""
+
+    class Polygon:
+        def __init__(self, coords):
+            self.coords = coords
+
+    class LineString:
+        def __init__(self, coords, proj=None, geodesic=None):
+            self.coords = coords
+
+        def buffer(self, distance):
+            return self
+
+
+class Reducer:
+    """Reducers of the fake ee module (only the mean is supported)."""
+
+    @staticmethod
+    def mean():
+        return 'mean'
+
+
+class FakeImage:
+    """Image of the fake ee module, identified by its id. The band and projection operations
+    (select, remap, rename, reproject and reduceResolution) are ignored, the reductions return
+    the cloud cover of the image."""
+
+    def __init__(self, backend, im_id):
+        self.backend = backend
+        self.im_id = im_id
+
+    def serialize(self):
+        return json.dumps({'id':self.im_id})
+
+    def select(self, band):
+        return self
+
+    def remap(self, values_from, values_to, default_value=None):
+        return self
+
+    def rename(self, name):
+        return self
+
+    def projection(self):
+        return None
+
+    def reproject(self, crs, crsTransform=None, scale=None):
+        return self
+
+    def reduceResolution(self, reducer, bestEffort=False, maxPixels=None):
+        return self
+
+    def reduceRegion(self, reducer, geometry, scale=None, maxPixels=None, bestEffort=False):
+        return FakeReduction(self.backend, self.im_id, geometry)
+
+
+class FakeReduction:
+    """Result of a reduction, computed when the request is sent (getInfo of a FakeList)."""
+
+    def __init__(self, backend, im_id, geometry):
+        self.backend = backend
+        self.im_id = im_id
+        self.geometry = geometry
+
+    def get(self, key):
+        return self
+
+    def evaluate(self):
+        return self.backend.get_cloud_cover(self.im_id, self.geometry)
+
+
+class FakeList:
+    """List of the fake ee module, its reductions are computed by getInfo."""
+
+    def __init__(self, backend, values):
+        self.backend = backend
+        self.values = values
+
+    def evaluate(self):
+        return [_.evaluate() if hasattr(_, 'evaluate') else _ for _ in self.values]
+
+    def getInfo(self):
+        self.backend.simulate_request('getInfo')
+        return self.evaluate()
+
+
+class FakeImageCollection:
+    """Image collection of the fake ee module, filtered by dates (the location is ignored)."""
+
+    def __init__(self, backend, name, dates=None):
+        if not name in COLLECTIONS.keys():
+            raise EEException('ImageCollection.load: ImageCollection asset \'%s\' not found.' % name)
+        self.backend = backend
+        self.name = name
+        self.dates = dates
+
+    def filterBounds(self, geometry):
+        return FakeImageCollection(self.backend, self.name, self.dates)
+
+    def filterDate(self, start, end):
+        return FakeImageCollection(self.backend, self.name, [start, end])
+
+    def getInfo(self):
+        return self.backend.get_collection_info(self.name, self.dates)
+
+
+class FakeData:
+    """Functions of ee.data used to download the images."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def getDownloadId(self, params):
+        return self.backend.get_download_id(params)
+
+    def makeDownloadUrl(self, download_id):
+        return '%s/download?docid=%s' % (self.backend.url, download_id['docid'])
+
+
+class FakeEE:
+    """
+    Offline stand-in for the ee module. The collection metadata is generated deterministically
+    (one image per revisit period, with random cloud cover and some Sentinel-2 duplicates in a
+    neighbouring UTM zone) and the images are served as zipped GeoTIFFs by a local HTTP server.
+
+    Arguments:
+    -----------
+        latency: float
+            delay (in seconds) added to each request (getInfo, getDownloadId and download)
+        bandwidth: float
+            maximum download speed of each request in bytes/second (None for no limit)
+        max_concurrent: int
+            maximum number of downloads at the same time, the other requests are throttled
+            (HTTP error 429), None for no limit
+        failure_rate: float
+            probability that a request fails (server error or truncated download)
+        max_pixels: int
+            maximum number of pixels along each side of the downloaded images
+        seed: int
+            seed of the random number generator
+
+    """
+
+    def __init__(self, latency=0, bandwidth=None, max_concurrent=None, failure_rate=0,
+                 max_pixels=2000, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_concurrent = max_concurrent
+        self.failure_rate = failure_rate
+        self.max_pixels = max_pixels
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.lock = threading.Lock()
+        # same attributes as the ee module
+        self.EEException = EEException
+        self.Geometry = Geometry
+        self.Reducer = Reducer
+        self.data = FakeData(self)
+        # statistics of the requests
+        self.stats = {'getInfo':0, 'getDownloadId':0, 'downloads':0, 'bytes':0,
+                      'throttled':0, 'failed':0}
+        self.active = 0
+        self.requests = dict([])
+        self.zip_cache = dict([])
+        self.features = dict([])
+        # local HTTP server serving the zipped images
+        backend = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                backend.serve_download(self)
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def Initialize(self, *args, **kwargs):
+        pass
+
+    def ImageCollection(self, name):
+        return FakeImageCollection(self, name)
+
+    def Image(self, im_id):
+        return FakeImage(self, im_id)
+
+    def List(self, values):
+        return FakeList(self, values)
+
+    def close(self):
+        """Stops the local HTTP server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def simulate_request(self, name):
+        """Adds the latency and raises a random failure."""
+        with self.lock:
+            self.stats[name] = self.stats[name] + 1
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.stats['failed'] = self.stats['failed'] + 1
+        time.sleep(self.latency)
+        if failed:
+            raise EEException('Internal error.')
+
+    def get_collection_info(self, name, dates):
+        """Returns the features of the images of a collection acquired between 2 dates."""
+        self.simulate_request('getInfo')
+        collection = COLLECTIONS[name]
+        date_start = pytz.utc.localize(datetime.strptime(dates[0], '%Y-%m-%d'))
+        date_end = pytz.utc.localize(datetime.strptime(dates[1], '%Y-%m-%d'))
+        # first acquisition after the start date (fixed revisit cycle since 2000-01-01)
+        epoch = pytz.utc.localize(datetime(2000, 1, 1, 0, 0, 0))
+        revisit = collection['revisit']
+        date = epoch + timedelta(days=revisit*int(np.ceil((date_start - epoch).days/revisit)))
+        features = []
+        while date < date_end:
+            # same random properties for an acquisition in every query
+            rng = random.Random('%s%s%d' % (name, date.strftime('%Y%m%d'), self.seed))
+            t = date + timedelta(hours=rng.uniform(-0.5, 0.5)) + timedelta(hours=23.5)
+            utm_zones = [32756]
+            # some Sentinel-2 images are also provided in the neighbouring UTM zone
+            if collection['prefix'] == '' and rng.random() < 0.3:
+                utm_zones.append(32755)
+            for epsg in utm_zones:
+                features.append(self.get_feature(name, t, epsg, rng))
+            date = date + timedelta(days=revisit)
+        return {'type':'ImageCollection', 'id':name, 'features':features}
+
+    def get_feature(self, name, t, epsg, rng):
+        """Returns the feature (metadata) of an image."""
+        collection = COLLECTIONS[name]
+        if collection['prefix'] == '':
+            im_id = '%s/%s_%s_T%dHLH' % (name, t.strftime('%Y%m%dT%H%M%S'),
+                                         t.strftime('%Y%m%dT%H%M%S'), epsg - 32700)
+        else:
+            im_id = '%s/%s_089083_%s' % (name, collection['prefix'], t.strftime('%Y%m%d'))
+        bands = []
+        for band_id, res, data_type in collection['bands']:
+            bands.append({'id':band_id, 'crs':'EPSG:%d' % epsg,
+                          'crs_transform':[res, 0, 300000, 0, -res, 6300000],
+                          'data_type':{'type':'PixelType', 'precision':data_type},
+                          'dimensions':[int(300000/res), int(300000/res)]})
+        properties = {'system:time_start':int(t.timestamp()*1000),
+                      'system:index':im_id.split('/')[-1],
+                      collection['cloud_property']:round(rng.uniform(0, 100)**2/100, 2)}
+        if collection['prefix'] == '':
+            properties['GEOMETRIC_QUALITY_FLAG'] = 'PASSED'
+        else:
+            properties['GEOMETRIC_RMSE_MODEL'] = round(rng.uniform(3, 12), 3)
+        feature = {'type':'Image', 'id':im_id, 'bands':bands, 'properties':properties}
+        with self.lock:
+            self.features[im_id] = json.loads(json.dumps(feature))
+        return feature
+
+    def get_cloud_cover(self, im_id, geometry):
+        """Returns the cloud cover (fraction) of an image inside a geometry, derived from the
+        cloud cover property of the image (same value in every query)."""
+        with self.lock:
+            if not im_id in self.features.keys():
+                raise EEException('Image.load: Image asset \'%s\' not found.' % im_id)
+            feature = self.features[im_id]
+        collection = COLLECTIONS['/'.join(im_id.split('/')[:-1])]
+        cloud_cover = feature['properties'][collection['cloud_property']]/100
+        rng = random.Random('%s%s%d' % (im_id, type(geometry).__name__, self.seed))
+        return min(cloud_cover*rng.uniform(0, 2), 1)
+
+    def get_download_id(self, params):
+        """Registers a download request and returns its id."""
+        self.simulate_request('getDownloadId')
+        with self.lock:
+            docid = '%08x' % len(self.requests)
+            self.requests[docid] = params
+        return {'docid':docid, 'token':''}
+
+    def get_zip(self, params):
+        """Returns the zipped GeoTIFF of a download request (cached by size and bands)."""
+        im_id = json.loads(params['image'])['id']
+        prefix = COLLECTIONS['/'.join(im_id.split('/')[:-1])]['prefix']
+        bands = params['bands']
+        epsg = int(bands[0]['crs'][5:])
+        res = bands[0]['crs_transform'][0]
+        # size of the region of interest in pixels
+        polygon = np.array(params['region'][0])
+        lat = np.mean(polygon[:,1])
+        width = (np.max(polygon[:,0]) - np.min(polygon[:,0]))*111320*np.cos(np.radians(lat))
+        height = (np.max(polygon[:,1]) - np.min(polygon[:,1]))*110540
+        nx = int(min(max(width/res, 1), self.max_pixels))
+        ny = int(min(max(height/res, 1), self.max_pixels))
+        key = (prefix, epsg, res, nx, ny, tuple([_['id'] for _ in bands]))
+        with self.lock:
+            if key in self.zip_cache.keys():
+                return self.zip_cache[key]
+        # write the GeoTIFF with GDAL
+        rng = np.random.RandomState(self.seed)
+        if bands[0]['data_type']['precision'] == 'float':
+            data_type = gdal.GDT_Float32
+        else:
+            data_type = gdal.GDT_UInt16
+        fd, fn_tif = tempfile.mkstemp(suffix='.tif')
+        os.close(fd)
+        data = gdal.GetDriverByName('GTiff').Create(fn_tif, nx, ny, len(bands), data_type)
+        data.SetGeoTransform((300000, res, 0, 6300000, 0, -res))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(epsg)
+        data.SetProjection(srs.ExportToWkt())
+        for k, band in enumerate(bands):
+            if band['id'].startswith('QA') or band['id'] == 'BQA':
+                im = np.full((ny, nx), QA_CLEAR[prefix])
+            elif data_type == gdal.GDT_Float32:
+                im = rng.uniform(0, 0.5, (ny, nx))
+            else:
+                im = rng.randint(0, 5000, (ny, nx))
+            data.GetRasterBand(k+1).WriteArray(im)
+        data = None
+        with open(fn_tif, 'rb') as f:
+            im_bytes = f.read()
+        os.remove(fn_tif)
+        f_zip = io.BytesIO()
+        with zipfile.ZipFile(f_zip, 'w', zipfile.ZIP_DEFLATED) as local_zipfile:
+            local_zipfile.writestr('data.tif', im_bytes)
+        with self.lock:
+            self.zip_cache[key] = f_zip.getvalue()
+        return self.zip_cache[key]
+
+    def serve_download(self, handler):
+        """Sends the zipped GeoTIFF of a download request (called by the HTTP server)."""
+        docid = parse_qs(urlparse(handler.path).query).get('docid', [''])[0]
+        if not docid in self.requests.keys():
+            handler.send_error(400, 'Invalid docid')
+            return
+        with self.lock:
+            self.stats['downloads'] = self.stats['downloads'] + 1
+            throttled = self.max_concurrent is not None and self.active >= self.max_concurrent
+            if throttled:
+                self.stats['throttled'] = self.stats['throttled'] + 1
+            else:
+                self.active = self.active + 1
+            failed = not throttled and self.random.random() < self.failure_rate
+            if failed:
+                self.stats['failed'] = self.stats['failed'] + 1
+        if throttled:
+            handler.send_response(429)
+            handler.send_header('Retry-After', '1')
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        try:
+            time.sleep(self.latency)
+            data = self.get_zip(self.requests[docid])
+            if failed and self.random.random() < 0.5:
+                handler.send_error(500, 'Internal error')
+                return
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/zip')
+            handler.send_header('Content-Length', str(len(data)))
+            handler.end_headers()
+            # the other failures are downloads interrupted half way
+            n_bytes = len(data)//2 if failed else len(data)
+            chunk_size = 2**16
+            for k in range(0, n_bytes, chunk_size):
+                chunk = data[k:min(k+chunk_size, n_bytes)]
+                handler.wfile.write(chunk)
+                if self.bandwidth is not None:
+                    time.sleep(len(chunk)/self.bandwidth)
+            with self.lock:
+                self.stats['bytes'] = self.stats['bytes'] + n_bytes
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.lock:
+                self.active = self.active - 1
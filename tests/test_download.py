@@ -0,0 +1,407 @@
+"""Tests of the download functions of SDS_download, run against the offline stand-in for the
+ee module (fake_ee.FakeEE). The zipped images are random bytes instead of GeoTIFFs (the
+images are stored as downloaded, without compression), so that GDAL is not used."""
+
+import os
+import sys
+import time
+import threading
+import io
+import json
+import zipfile
+import pytest
+import numpy as np
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from coastsat import SDS_download
+import fake_ee
+
+
+class FakeServer(fake_ee.FakeEE):
+    """FakeEE serving a zip archive with a random payload in place of the GeoTIFFs."""
+
+    def get_zip(self, params):
+        with self.lock:
+            if not 'payload' in self.zip_cache.keys():
+                rng = np.random.RandomState(self.seed)
+                f_zip = io.BytesIO()
+                with zipfile.ZipFile(f_zip, 'w', zipfile.ZIP_DEFLATED) as local_zipfile:
+                    local_zipfile.writestr('data.tif', rng.bytes(200000))
+                self.zip_cache['payload'] = f_zip.getvalue()
+            return self.zip_cache['payload']
+
+
+class ScriptedRandom:
+    """Random number generator returning a fixed sequence of values (then 0.9)."""
+
+    def __init__(self, values):
+        self.values = list(values)
+
+    def random(self):
+        if len(self.values) > 0:
+            return self.values.pop(0)
+        return 0.9
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(SDS_download, 'ee', server)
+    # short pauses between the attempts
+    monkeypatch.setitem(SDS_download.RETRY_POLICY, 'base_delay', 0.01)
+    monkeypatch.setitem(SDS_download.RETRY_POLICY, 'max_delay', 0.1)
+    monkeypatch.setitem(SDS_download.RETRY_POLICY, 'rate_limit_delay', 0.1)
+    monkeypatch.setitem(SDS_download.RATE_LIMIT, 'until', 0)
+    yield server
+    server.close()
+
+
+def get_inputs(filepath, sat_list=['L8'], n_workers=2):
+    polygon = [[[151.30, -33.70], [151.31, -33.70], [151.31, -33.71], [151.30, -33.71],
+                [151.30, -33.70]]]
+    return {'sitename':'TEST', 'polygon':polygon, 'dates':['2019-01-01', '2019-03-01'],
+            'sat_list':sat_list, 'filepath':str(filepath), 'n_workers':n_workers}
+
+
+def get_payload(fake):
+    with zipfile.ZipFile(io.BytesIO(fake.get_zip(None))) as local_zipfile:
+        return local_zipfile.read('data.tif')
+
+
+def test_resume_from_manifest(fake, tmp_path):
+    inputs = get_inputs(tmp_path)
+    metadata = SDS_download.retrieve_images(inputs)
+    n_img = len(metadata['L8']['filenames'])
+    n_downloads = fake.stats['downloads']
+    assert n_img > 1
+    assert n_downloads == 2*n_img
+
+    # all the images are complete: nothing is downloaded again
+    SDS_download.retrieve_images(inputs)
+    assert fake.stats['downloads'] == n_downloads
+
+    # the image whose file does not have the size recorded in the manifest is downloaded again
+    fn = os.path.join(str(tmp_path), 'TEST', 'L8', 'ms',
+                      metadata['L8']['filenames'][0].replace('_pan', '_ms'))
+    with open(fn, 'r+b') as f:
+        f.truncate(100)
+    metadata = SDS_download.retrieve_images(inputs)
+    assert fake.stats['downloads'] == n_downloads + 2
+    assert len(metadata['L8']['filenames']) == n_img
+    with open(fn, 'rb') as f:
+        assert f.read() == get_payload(fake)
+
+
+def test_cancel(fake, tmp_path):
+    # the download is cancelled after the first image
+    cancel = threading.Event()
+    images = []
+    def callback(image):
+        images.append(image)
+        cancel.set()
+    fake.latency = 0.2
+    inputs = get_inputs(tmp_path, n_workers=1)
+    with pytest.raises(SDS_download.DownloadCancelled):
+        SDS_download.retrieve_images(inputs, callback, cancel)
+    assert len(images) == 1
+    n_img = len(SDS_download.query_collection('L8', inputs['polygon'], inputs['dates']))
+    assert fake.stats['downloads'] < 2*n_img
+
+
+def test_rate_limit_retried(fake, tmp_path):
+    # only one download at a time, the other requests are throttled (HTTP error 429)
+    fake.max_concurrent = 1
+    metadata = SDS_download.retrieve_images(get_inputs(tmp_path, n_workers=4))
+    assert fake.stats['throttled'] > 0
+    # the requests were paused (Retry-After header) and all the images were downloaded
+    assert SDS_download.RATE_LIMIT['until'] > 0
+    manifest = SDS_download.load_manifest(os.path.join(str(tmp_path), 'TEST',
+                                                       'TEST_manifest.jsonl'))
+    assert len(manifest) == len(metadata['L8']['filenames'])
+    assert all([_['status'] == 'complete' for _ in manifest.values()])
+
+
+def test_client_error_not_retried(fake):
+    calls = []
+    def request():
+        calls.append(1)
+        return urlopen(fake.url + '/download?docid=invalid')
+    with pytest.raises(HTTPError) as error:
+        SDS_download.retry(request, [])
+    assert error.value.code == 400
+    assert len(calls) == 1
+
+
+def test_max_rate():
+    # the requests sharing a rate limit are spaced, the other requests are not limited
+    rate_limit = SDS_download.get_rate_limit(10)
+    times = [SDS_download.retry(time.time, [], rate_limit=rate_limit) for _ in range(3)]
+    assert times[2] - times[0] > 0.19
+    t0 = time.time()
+    SDS_download.retry(time.time, [])
+    assert time.time() - t0 < 0.05
+    assert SDS_download.get_rate_limit(None) is None
+
+
+def test_truncated_zip_retried(fake, tmp_path):
+    # getDownloadId succeeds, the download fails and is truncated, then the next attempt works
+    im_col = fake.ImageCollection('COPERNICUS/S2').filterDate('2019-01-01', '2019-01-10')
+    im_dic = im_col.getInfo()['features'][0]
+    fake.failure_rate = 0.5
+    fake.random = ScriptedRandom([0.9, 0.0, 0.9])
+    polygon = get_inputs(tmp_path)['polygon']
+    fn = SDS_download.download_image_file(im_dic['id'], polygon, im_dic['bands'][1:4],
+                                          str(tmp_path), 'image.tif')
+    assert fake.stats['downloads'] == 2
+    assert fake.stats['failed'] == 1
+    with open(fn, 'rb') as f:
+        assert f.read() == get_payload(fake)
+    assert os.listdir(str(tmp_path)) == ['image.tif']
+
+
+def get_duplicates(fake, tmp_path):
+    # 3 Sentinel-2 images acquired at the same time
+    im_col = fake.ImageCollection('COPERNICUS/S2').filterDate('2019-01-01', '2019-01-10')
+    im_dic = im_col.getInfo()['features'][0]
+    im_col = []
+    for k in range(3):
+        im_col.append(json.loads(json.dumps(im_dic)))
+        im_col[-1]['id'] = im_dic['id'] + '_%d' % k
+    filepath_site = os.path.join(str(tmp_path), 'TEST')
+    im_meta, jobs = SDS_download.plan_downloads('S2', im_col, dict([]), 'TEST', filepath_site)
+
+    # files, manifest and metadata index of the downloaded images
+    fn_manifest = os.path.join(filepath_site, 'TEST_manifest.jsonl')
+    fn_index = os.path.join(filepath_site, 'TEST_metadata.db')
+    for job in jobs:
+        for bands, filepath, filename in job['files']:
+            os.makedirs(filepath, exist_ok=True)
+            with open(os.path.join(filepath, filename), 'wb') as f:
+                f.write(b'data')
+        os.makedirs(job['filepath_meta'], exist_ok=True)
+        with open(os.path.join(job['filepath_meta'], job['filename_txt'] + '.txt'), 'w') as f:
+            f.write('')
+        files = [SDS_download.get_file_info(os.path.join(_[1], _[2]), fn_manifest)
+                 for _ in job['files']]
+        SDS_download.update_manifest(fn_manifest, {'id':job['id'], 'satname':'S2',
+                                     'date':job['date'], 'status':'complete', 'files':files})
+    metadata = {'S2':dict([(key, im_meta[key]) for key in
+                           ['dates', 'acc_georef', 'epsg', 'filenames']])}
+    SDS_download.update_metadata_index(fn_index, metadata)
+    return im_col, metadata, fn_manifest, fn_index
+
+
+def test_duplicates_named_and_merged(fake, tmp_path, monkeypatch):
+    im_col, metadata, fn_manifest, fn_index = get_duplicates(fake, tmp_path)
+    filenames = metadata['S2']['filenames']
+    assert filenames[1] == filenames[0].replace('.tif', '_dup.tif')
+    assert filenames[2] == filenames[0].replace('.tif', '_dup2.tif')
+
+    # both duplicates are merged into the first image
+    merged = []
+    monkeypatch.setattr(SDS_download, 'merge_image_pair',
+                        lambda fn_im, satname, compression: merged.append(fn_im[1][0]))
+    metadata = SDS_download.merge_overlapping_images(metadata, get_inputs(tmp_path))
+    assert sorted([os.path.basename(_) for _ in merged]) == filenames[1:]
+    assert metadata['S2']['filenames'] == filenames[:1]
+    manifest = SDS_download.load_manifest(fn_manifest)
+    assert [manifest[_['id']]['status'] for _ in im_col] == ['complete', 'merged', 'merged']
+    index = SDS_download.load_metadata_index(fn_index)
+    assert index['S2']['filenames'] == filenames[:1]
+
+
+def test_duplicates_merge_failed(fake, tmp_path, monkeypatch):
+    im_col, metadata, fn_manifest, fn_index = get_duplicates(fake, tmp_path)
+    filenames = metadata['S2']['filenames']
+    # the merge of the second duplicate fails: it is kept in the metadata and in the index
+    def merge_image_pair(fn_im, satname, compression):
+        if fn_im[1][0].endswith('_dup2.tif'):
+            raise RuntimeError('merge failed')
+    monkeypatch.setattr(SDS_download, 'merge_image_pair', merge_image_pair)
+    metadata = SDS_download.merge_overlapping_images(metadata, get_inputs(tmp_path))
+    assert metadata['S2']['filenames'] == [filenames[0], filenames[2]]
+    manifest = SDS_download.load_manifest(fn_manifest)
+    assert [manifest[_['id']]['status'] for _ in im_col] == ['complete', 'merged', 'complete']
+    index = SDS_download.load_metadata_index(fn_index)
+    assert index['S2']['filenames'] == metadata['S2']['filenames']
+
+
+def test_screening(fake, tmp_path):
+    inputs = get_inputs(tmp_path)
+    inputs['screening'] = {'cloud_thresh':0.5}
+    metadata = SDS_download.retrieve_images(inputs)
+    # the images too cloudy in the area of interest are not downloaded
+    im_col = SDS_download.query_collection('L8', inputs['polygon'], inputs['dates'])
+    cloud_cover = [fake.get_cloud_cover(_['id'], fake.Geometry.Polygon(inputs['polygon']))
+                   for _ in im_col]
+    n_kept = len([_ for _ in cloud_cover if _ <= 0.5 + SDS_download.SCREENING_MARGIN])
+    assert 0 < n_kept < len(im_col)
+    assert len(metadata['L8']['filenames']) == n_kept
+
+
+def test_screening_failure(fake, tmp_path, monkeypatch):
+    # the cloud cover cannot be computed: all the images are downloaded without screening
+    def get_cloud_cover(im_id, geometry):
+        raise fake_ee.EEException('User memory limit exceeded.')
+    monkeypatch.setattr(fake, 'get_cloud_cover', get_cloud_cover)
+    inputs = get_inputs(tmp_path)
+    inputs['screening'] = {'cloud_thresh':0.5}
+    metadata = SDS_download.retrieve_images(inputs)
+    im_col = SDS_download.query_collection('L8', inputs['polygon'], inputs['dates'])
+    assert len(metadata['L8']['filenames']) == len(im_col)
+
+
+class Unseekable:
+    """Write-only stream that cannot be seeked (zipfile then writes data descriptors)."""
+
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def write(self, data):
+        return self.data.write(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        raise AttributeError('unseekable stream')
+
+    def seekable(self):
+        return False
+
+
+def make_zip(entries, seekable=True, force_zip64=False):
+    # zip archive with the given entries (list of [name, data, compression])
+    f_zip = io.BytesIO() if seekable else Unseekable()
+    with zipfile.ZipFile(f_zip, 'w') as local_zipfile:
+        for name, data, compression in entries:
+            zinfo = zipfile.ZipInfo(name, (2019, 1, 1, 0, 0, 0))
+            zinfo.compress_type = compression
+            with local_zipfile.open(zinfo, 'w', force_zip64=force_zip64) as f:
+                f.write(data)
+    return f_zip.getvalue() if seekable else f_zip.data.getvalue()
+
+
+def extract(data, member):
+    f_out = io.BytesIO()
+    SDS_download.extract_zip_stream(io.BytesIO(data), member, f_out)
+    return f_out.getvalue()
+
+
+def test_extract_zip_stream():
+    rng = np.random.RandomState(0)
+    payload = rng.bytes(3*2**20) + b'0'*2**20
+    entries = [['other.txt', b'other file', zipfile.ZIP_STORED],
+               ['data.tif', payload, zipfile.ZIP_DEFLATED],
+               ['last.tif', payload[:1000], zipfile.ZIP_STORED]]
+    # stored and deflated entries (the requested file is not the first one)
+    data = make_zip(entries)
+    assert extract(data, 'data.tif') == payload
+    assert extract(data, 'last.tif') == payload[:1000]
+    # deflated entries with a data descriptor, with the sizes on 8 bytes (zip64)
+    for force_zip64 in [False, True]:
+        data = make_zip(entries[1:2] + [['last.tif', payload[:1000], zipfile.ZIP_DEFLATED]],
+                        seekable=False, force_zip64=force_zip64)
+        assert extract(data, 'data.tif') == payload
+        assert extract(data, 'last.tif') == payload[:1000]
+
+
+def test_extract_zip_stream_errors():
+    entries = [['other.txt', b'other file', zipfile.ZIP_STORED],
+               ['data.tif', b'1'*100000, zipfile.ZIP_DEFLATED]]
+    data = make_zip(entries)
+    # the archive does not contain the file: not retried
+    with pytest.raises(SDS_download.ZipMemberNotFound) as error:
+        extract(data, 'missing.tif')
+    assert SDS_download.classify_error(error.value) == 'fatal'
+    # truncated archive: retried
+    for n in [10, 100, len(data) - len(data)//2]:
+        with pytest.raises(zipfile.BadZipFile) as error:
+            extract(data[:n], 'data.tif')
+        assert SDS_download.classify_error(error.value) == 'transient'
+    # entries that cannot be read sequentially
+    for data in [make_zip([['data.tif', b'1'*1000, zipfile.ZIP_BZIP2]]),
+                 make_zip([['data.tif', b'1'*1000, zipfile.ZIP_STORED]], seekable=False)]:
+        with pytest.raises(SDS_download.StreamNotSupported):
+            extract(data, 'data.tif')
+
+
+def filter_S2_reference(im_list):
+    # loop used in the previous versions to remove the duplicates of the S2 collection
+    timestamps = [_['properties']['system:time_start'] for _ in im_list]
+    utm_zones = np.array([int(_['bands'][0]['crs'][5:]) for _ in im_list])
+    utm_zone_selected = np.max(np.unique(utm_zones))
+    idx_all = np.arange(0,len(im_list),1)
+    idx_covered = np.ones(len(im_list)).astype(bool)
+    idx_delete = []
+    i = 0
+    while 1:
+        same_time = np.abs([timestamps[i] - _ for _ in timestamps]) < 24*60*60*1000
+        idx_same_time = np.where(same_time)[0]
+        same_utm = utm_zones == utm_zone_selected
+        idx_temp = np.where([same_time[j] == True and same_utm[j] == False for j in idx_all])[0]
+        idx_keep = idx_same_time[[_ not in idx_temp for _ in idx_same_time]]
+        if len(idx_keep) > 2:
+            idx_temp = np.append(idx_temp,idx_keep[-(len(idx_keep)-2):])
+        for j in idx_temp:
+            idx_delete.append(j)
+        idx_covered[idx_same_time] = False
+        if np.any(idx_covered):
+            i = np.where(idx_covered)[0][0]
+        else:
+            break
+    return [x for k,x in enumerate(im_list) if k not in idx_delete]
+
+
+def test_filter_S2_collection():
+    rng = np.random.RandomState(0)
+    one_day = 24*60*60*1000
+    for k in range(50):
+        # images acquired in clusters of a few hours (some clusters less than one day apart),
+        # projected in 2 utm zones
+        n_img = rng.randint(1, 40)
+        t_clusters = rng.randint(0, 30, rng.randint(1, 10))*one_day//2
+        timestamps = (rng.choice(t_clusters, n_img) +
+                      rng.randint(0, 3*60*60*1000, n_img)).astype(int)
+        if k % 5 == 0:
+            timestamps[-1] = timestamps[0] + one_day
+        im_list = [{'id':'image_%d' % i,
+                    'properties':{'system:time_start':int(timestamps[i])},
+                    'bands':[{'crs':'EPSG:%d' % rng.choice([32755, 32756])}]}
+                   for i in range(n_img)]
+        assert SDS_download.filter_S2_collection(im_list) == filter_S2_reference(im_list)
+    assert SDS_download.filter_S2_collection([]) == []
+
+
+def test_find_overlapping_pairs():
+    filenames = ['2019-01-01-00-00-00_S2_TEST_ms.tif',
+                 '2019-01-02-00-00-00_S2_TEST_dup.tif',
+                 '2019-01-02-00-00-00_S2_TEST.tif',
+                 '2019-01-03-00-00-00_S2_TEST_dup2.tif',
+                 '2019-01-03-00-00-00_S2_TEST.tif',
+                 '2019-01-03-00-00-00_S2_TEST_dup.tif',
+                 '2019-01-04-00-00-00_S2_TEST.tif']
+    # the image with the shortest filename is kept, the single images are not paired
+    pairs = SDS_download.find_overlapping_pairs(filenames)
+    assert sorted(pairs) == [[2,1], [4,3], [4,5]]
+    assert SDS_download.find_overlapping_pairs(filenames[:1] + filenames[-1:]) == []
+
+
+def test_metadata_index_dates(tmp_path):
+    # the dates loaded from the index are to the second, as the dates read from the .txt files
+    filepath_meta = os.path.join(str(tmp_path), 'TEST', 'L8', 'meta')
+    os.makedirs(filepath_meta)
+    filename = '2019-01-02-23-59-59_L8_TEST_ms.tif'
+    with open(os.path.join(filepath_meta, filename[:-7] + '.txt'), 'w') as f:
+        f.write('filename\t%s\nacc_georef\t4.5\nepsg\t32656\n' % filename)
+    inputs = {'sitename':'TEST', 'filepath':str(tmp_path)}
+    metadata_txt = SDS_download.get_metadata(inputs)
+    metadata = SDS_download.get_metadata(inputs)
+    assert metadata == metadata_txt
+    # index written with a date in microseconds
+    fn_index = os.path.join(str(tmp_path), 'TEST', 'TEST_metadata.db')
+    metadata_txt['L8']['dates'][0] = metadata_txt['L8']['dates'][0].replace(microsecond=999)
+    SDS_download.update_metadata_index(fn_index, metadata_txt)
+    assert SDS_download.load_metadata_index(fn_index) == metadata
@@ -0,0 +1,164 @@
+"""Tests of the preprocessing functions of SDS_preprocess (on synthetic images)."""
+
+import os
+import sys
+import pytest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from coastsat import SDS_preprocess
+
+
+def test_clean_cache(tmp_path, monkeypatch):
+    filepath_cache = str(tmp_path)
+    scans = []
+    listdir = os.listdir
+    def listdir_count(path):
+        scans.append(path)
+        return listdir(path)
+    monkeypatch.setattr(SDS_preprocess.os, 'listdir', listdir_count)
+    for i in range(100):
+        fn = os.path.join(filepath_cache, '%03d.npz' % i)
+        with open(fn, 'wb') as f:
+            f.write(b'0'*1000)
+        os.utime(fn, (i, i))
+        SDS_preprocess.clean_cache(filepath_cache, 20000, 1000)
+    # the least recently used files were removed and the directory was not scanned every time
+    filenames = sorted(listdir(filepath_cache))
+    assert len(filenames) <= 20
+    assert filenames[-1] == '099.npz'
+    assert int(filenames[0][:3]) == 100 - len(filenames)
+    assert len(scans) < 50
+    assert SDS_preprocess.CACHE_USAGE[filepath_cache]['size'] == 1000*len(filenames)
+
+    # files written by another process are found when the last scan is too old
+    for i in range(100, 120):
+        with open(os.path.join(filepath_cache, '%03d.npz' % i), 'wb') as f:
+            f.write(b'0'*1000)
+    SDS_preprocess.clean_cache(filepath_cache, 20000, 0)
+    assert len(listdir(filepath_cache)) == len(filenames) + 20
+    monkeypatch.setitem(SDS_preprocess.CACHE_USAGE[filepath_cache], 'scanned',
+                        SDS_preprocess.time.time() - SDS_preprocess.CACHE_RESCAN_INTERVAL)
+    SDS_preprocess.clean_cache(filepath_cache, 20000, 0)
+    assert len(listdir(filepath_cache)) <= 20
+
+
+def get_image(rng, shape=(120, 100)):
+    # positively correlated bands with a right-skewed distribution, a panchromatic band close
+    # to their mean and a cloud mask covering a corner of the image
+    base = rng.exponential(0.05, shape) + 0.05
+    im_ms = np.stack([base*(1 + 0.2*k) + rng.uniform(0, 0.02, shape) for k in range(3)],
+                     axis=2)
+    im_pan = np.mean(im_ms, axis=2) + rng.normal(0, 0.01, shape)
+    cloud_mask = np.zeros(shape, dtype=bool)
+    cloud_mask[:20,:30] = True
+    return im_ms, im_pan, cloud_mask
+
+
+def pansharpen_svd(im_ms, im_pan, cloud_mask):
+    # PCA pansharpening with an SVD of the cloud-free pixels (all the components, 1st PC
+    # positively correlated with the pan band)
+    vec = im_ms[~cloud_mask]
+    vec_pan = im_pan[~cloud_mask]
+    vec_mean = np.mean(vec, axis=0)
+    u, s, vt = np.linalg.svd(vec - vec_mean, full_matrices=False)
+    vec_pcs = np.dot(vec - vec_mean, vt.T)
+    if np.corrcoef(vec_pcs[:,0], vec_pan)[0,1] < 0:
+        vt[0] = -vt[0]
+        vec_pcs[:,0] = -vec_pcs[:,0]
+    vec_pcs[:,0] = SDS_preprocess.hist_match(vec_pan, vec_pcs[:,0])
+    im_ms_ps = np.full(im_ms.shape, np.nan)
+    im_ms_ps[~cloud_mask] = np.dot(vec_pcs, vt) + vec_mean
+    return im_ms_ps
+
+
+def test_pansharpen_closed_form():
+    im_ms, im_pan, cloud_mask = get_image(np.random.RandomState(0))
+    im_ms_ps = SDS_preprocess.pansharpen(im_ms, im_pan, cloud_mask)
+    expected = pansharpen_svd(im_ms, im_pan, cloud_mask)
+    assert np.array_equal(np.isnan(im_ms_ps), np.isnan(expected))
+    assert np.nanmax(np.abs(im_ms_ps - expected)) < 1e-10
+
+
+def test_pansharpen_sklearn():
+    decomposition = pytest.importorskip('sklearn.decomposition')
+    im_ms, im_pan, cloud_mask = get_image(np.random.RandomState(1))
+    im_ms_ps = SDS_preprocess.pansharpen(im_ms, im_pan, cloud_mask)
+    # PCA pansharpening of the previous versions (1st PC oriented like the pan band)
+    vec = im_ms[~cloud_mask]
+    vec_pan = im_pan[~cloud_mask]
+    pca = decomposition.PCA()
+    vec_pcs = pca.fit_transform(vec)
+    if np.corrcoef(vec_pcs[:,0], vec_pan)[0,1] < 0:
+        vec_pcs[:,0] = -vec_pcs[:,0]
+        pca.components_[0] = -pca.components_[0]
+    vec_pcs[:,0] = SDS_preprocess.hist_match(vec_pan, vec_pcs[:,0])
+    assert np.max(np.abs(im_ms_ps[~cloud_mask] - pca.inverse_transform(vec_pcs))) < 1e-10
+
+
+@pytest.mark.parametrize('block_size', [None, 64])
+def test_pansharpen_sign(block_size):
+    # scene of benchmarks/benchmark_pansharpen.py, whose largest projection on the 1st
+    # component is negative: the brightness of the pansharpened bands follows the pan band
+    rng = np.random.RandomState(0)
+    im_pan = rng.rand(200, 200)
+    im_ms = np.stack([0.5*im_pan + 0.1*rng.rand(200, 200) + 0.05*k for k in range(3)], 2)
+    cloud_mask = rng.rand(200, 200) < 0.1
+    im_ms_ps = SDS_preprocess.pansharpen(im_ms, im_pan, cloud_mask, block_size=block_size)
+    for k in range(3):
+        assert np.corrcoef(im_ms_ps[~cloud_mask,k], im_pan[~cloud_mask])[0,1] > 0.9
+
+
+def test_hist_match_bins():
+    rng = np.random.RandomState(0)
+    source = rng.normal(0, 1, 200000)
+    template = rng.gamma(2, 1, 100000)
+    exact = SDS_preprocess.hist_match(source, template)
+    approx = SDS_preprocess.hist_match(source, template, n_bins=1024)
+    # the approximate matching is monotonic and close to the exact one
+    order = np.argsort(source)
+    assert np.all(np.diff(approx[order]) >= -1e-12)
+    assert np.median(np.abs(approx - exact)) < 1e-3
+    assert np.percentile(np.abs(approx - exact), 99) < 0.005*np.ptp(template)
+    assert np.min(approx) >= np.min(template) - 1e-12
+    assert np.max(approx) <= np.max(template) + 1e-12
+    # a constant source is matched to the maximum of the template (as the exact matching)
+    constant = np.full(10, 3.0)
+    assert np.all(SDS_preprocess.hist_match(constant, template, n_bins=64) == np.max(template))
+    assert np.all(SDS_preprocess.hist_match(constant, template) == np.max(template))
+
+
+@pytest.mark.parametrize('method', SDS_preprocess.PANSHARPEN_METHODS)
+def test_pansharpen_blocks(method):
+    im_ms, im_pan, cloud_mask = get_image(np.random.RandomState(2))
+    im_ms = im_ms.astype(np.float32)
+    im_pan = im_pan.astype(np.float32)
+    expected = SDS_preprocess.pansharpen(im_ms, im_pan, cloud_mask, hist_bins=1024,
+                                         method=method)
+    # same result by blocks (the last block is smaller), also written in a view of an array
+    im_ms_ps = SDS_preprocess.pansharpen(im_ms, im_pan, cloud_mask, hist_bins=1024,
+                                         method=method, block_size=32)
+    out = np.zeros(im_ms.shape[:2] + (5,), dtype=np.float32)
+    SDS_preprocess.pansharpen(im_ms, im_pan, cloud_mask, hist_bins=1024, method=method,
+                              block_size=32, out=out[:,:,1:4])
+    for result in [im_ms_ps, out[:,:,1:4]]:
+        assert np.array_equal(np.isnan(result), np.isnan(expected))
+        assert np.nanmax(np.abs(result - expected)) < 1e-5
+    assert np.all(out[:,:,[0,4]] == 0)
+    if method == 'none':
+        assert np.array_equal(im_ms_ps[~cloud_mask], im_ms[~cloud_mask])
+
+
+def test_decode_QA():
+    # same cloud mask as np.isin with the cloud values, for integer and float QA bands
+    im_QA = np.arange(2**16, dtype=np.uint16).reshape(256, 256)
+    for satname in ['L4', 'L5', 'L7', 'L8', 'S2']:
+        cloud_values = SDS_preprocess.CLOUD_VALUES[satname]
+        for im in [im_QA, im_QA.astype(np.float32), im_QA.astype(np.float64) + 0.5]:
+            layers = SDS_preprocess.decode_QA(im, satname)
+            assert np.array_equal(layers['cloud'], np.isin(im, cloud_values))
+        # other layers decoded from the bits
+        layers = SDS_preprocess.decode_QA(im_QA, satname)
+        for name, (bit, n_bits, min_value) in SDS_preprocess.QA_BITS[satname].items():
+            expected = ((im_QA.astype(np.int64) >> bit) & (2**n_bits - 1)) >= min_value
+            assert np.array_equal(layers[name], expected)